@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from src.database import create_db, crud
+
+'''Benchmark: database token paths under many simultaneous users, SQLite WAL vs the default rollback journal
+
+callback: upsert user then upsert tokens, as the OAuth callback does
+token:    read the token row in a fresh session, as the token manager does on a cold cache
+mixed:    callbacks and token reads interleaved, writers and readers contend for the file
+
+Reports throughput, p50/p95/p99 latency, failures, and the worst event loop stall seen by a 1 ms ticker.
+
+Usage: python -m benchmarks.bench_db --users 500 --concurrency 100
+'''
+
+
+async def measure_loop_lag(stop: asyncio.Event, interval: float = 0.001) -> float:
+    '''Returns the largest delay past interval seen while sleeping in a loop until stop is set'''
+
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def callback_path(sessions, user_index: int):
+    async with sessions() as db_session:
+        user = await crud.create_nebula_user(db_session, f'bench_user_{user_index}', f'Bench {user_index}')
+        await crud.update_tokens(db_session, user.id, f'access_{user_index}', f'refresh_{user_index}')
+
+
+async def token_path(sessions, user_index: int):
+    async with sessions() as db_session:
+        await crud.get_token(db_session, user_index + 1)
+
+
+async def mixed_path(sessions, user_index: int):
+    if user_index % 4 == 0:
+        await callback_path(sessions, user_index)
+    else:
+        await token_path(sessions, user_index)
+
+
+async def run_scenario(sessions, path, users: int, concurrency: int) -> dict:
+    '''Runs path for every user with at most concurrency in flight'''
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def run_user(user_index: int):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await path(sessions, user_index)
+            except Exception as e:
+                failures += 1
+                if failures == 1:
+                    print(f'    first failure: {type(e).__name__}: {str(e)[:120]}')
+                return
+            latencies.append(time.perf_counter() - start)
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(run_user(user_index) for user_index in range(users)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    max_lag = await lag_task
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    return {
+        'ops_per_s': len(latencies) / elapsed,
+        'p50_ms': quantiles[49] * 1000,
+        'p95_ms': quantiles[94] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'failures': failures,
+        'max_loop_lag_ms': max_lag * 1000,
+    }
+
+
+async def bench_journal(wal: bool, users: int, concurrency: int):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_db.build_engine(f'sqlite+aiosqlite:///{os.path.join(directory, "bench.db")}', wal=wal)
+        await create_db.init_db(engine)
+        sessions = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
+
+        print(f"journal {'WAL' if wal else 'DELETE'}")
+        for name, path in (('callback', callback_path), ('token', token_path), ('mixed', mixed_path)):
+            result = await run_scenario(sessions, path, users, concurrency)
+            print(f"  {name:>8}: {result['ops_per_s']:8.0f} ops/s  p50 {result['p50_ms']:7.1f} ms  p95 {result['p95_ms']:7.1f} ms  "
+                  f"p99 {result['p99_ms']:7.1f} ms  failures {result['failures']}  max loop lag {result['max_loop_lag_ms']:.1f} ms")
+
+        await engine.dispose()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=100)
+    args = parser.parse_args()
+
+    for wal in (False, True):
+        await bench_journal(wal, args.users, args.concurrency)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+from benchmarks.stub_server import create_stub_app, run_stub_server
+from src import http_clients
+
+'''Benchmark: connections (TLS handshakes upstream) and latency per nebula build, per-call clients vs pooled clients
+
+Usage: python -m benchmarks.bench_http_clients --builds 5 --tracks 100 --latency 0.02
+'''
+
+
+async def nebula_build(base_url: str, get, tracks: int, concurrency: int):
+    '''Replays the request pattern of one nebula build: two top track pages then one feature lookup per track'''
+
+    top = []
+    for offset in (0, 50):
+        response = await get(f'{base_url}/v1/me/top/tracks', params={'time_range': 'short_term', 'limit': 50, 'offset': offset})
+        top += response.json()['items']
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def features(track_id):
+        async with semaphore:
+            response = await get(f'{base_url}/pktx/spotify/{track_id}')
+            response.raise_for_status()
+
+    await asyncio.gather(*(features(item['id']) for item in top[:tracks]))
+
+
+async def run_mode(base_url: str, mode: str, builds: int, tracks: int, concurrency: int) -> dict:
+    '''Runs builds with either a new client per call (previous behaviour) or one pooled client'''
+
+    pooled = http_clients.build_client(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async def per_call_get(url, **kwargs):
+        async with httpx.AsyncClient() as client:
+            return await client.get(url, **kwargs)
+
+    get = pooled.get if mode == 'pooled' else per_call_get
+
+    async with httpx.AsyncClient() as control:
+        await control.post(f'{base_url}/_reset')
+        latencies = []
+        for _ in range(builds):
+            start = time.perf_counter()
+            await nebula_build(base_url, get, tracks, concurrency)
+            latencies.append(time.perf_counter() - start)
+        stats = (await control.get(f'{base_url}/_stats')).json()
+
+    await pooled.aclose()
+
+    # The control client holds one connection and made the stats request
+    connections = stats['connections'] - 1
+    return {
+        'mode': mode,
+        'connections_per_build': connections / builds,
+        'requests_per_build': (stats['requests'] - 1) / builds,
+        'median_build_s': statistics.median(latencies),
+        'max_build_s': max(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--builds', type=int, default=5)
+    parser.add_argument('--tracks', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated upstream latency per request in seconds')
+    args = parser.parse_args()
+
+    with run_stub_server(create_stub_app(latency=args.latency)) as base_url:
+        for mode in ('per_call', 'pooled'):
+            result = asyncio.run(run_mode(base_url, mode, args.builds, args.tracks, args.concurrency))
+            print(f"{result['mode']:>9}: {result['connections_per_build']:7.1f} connections/build, "
+                  f"{result['requests_per_build']:6.1f} requests/build, "
+                  f"median {result['median_build_s'] * 1000:8.1f} ms, max {result['max_build_s'] * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import argparse
+import time
+from benchmarks.synthetic import synthetic_tracks
+from src import math_utils
+
+'''Benchmark: nebula pipeline on large synthetic libraries, full fit vs subsample fit + transform
+
+Usage: python -m benchmarks.bench_large --sizes 1000 5000 20000 --full-max 5000
+'''
+
+
+def timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--fit-size', type=int, default=math_utils.LIBRARY_FIT_SIZE)
+    parser.add_argument('--full-max', type=int, default=20000, help='skip the full fit above this many tracks')
+    args = parser.parse_args()
+
+    # Compile the exact and approximate (pynndescent) kNN paths and the transform path before timing
+    math_utils.warmup()
+    math_utils.library_pipline(synthetic_tracks(math_utils.LARGE_NEBULA_SIZE + 500)[0], math_utils.LARGE_NEBULA_SIZE)
+
+    for n_tracks in args.sizes:
+        tracks, _ = synthetic_tracks(n_tracks)
+        feature_matrix = math_utils.build_feature_matrix(tracks)
+        build_s = timed(math_utils.build_feature_matrix, tracks)
+
+        full_s = timed(math_utils.fit_models, feature_matrix) if n_tracks <= args.full_max else None
+        library_s = timed(math_utils.library_pipline, tracks, args.fit_size)
+
+        full = f'{full_s:7.2f} s' if full_s is not None else '  skipped'
+        print(f'{n_tracks:>6} tracks: feature matrix {build_s * 1000:7.1f} ms, full fit {full}, '
+              f'library pipline (fit {min(n_tracks, args.fit_size)}) {library_s:7.2f} s')
+
+
+if __name__ == '__main__':
+    main()
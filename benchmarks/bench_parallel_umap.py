@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import statistics
+import time
+import numpy as np
+
+'''Benchmark: parallel (unseeded) UMAP against the seeded single threaded fit, and how stable aligned layouts are
+
+speedup    fit time per n_jobs next to the seeded fit, per size
+stability  repeated parallel fits of the same tracks, aligned to the PCA reference: RMSD between runs as a fraction of
+           the layout's spread (before and after alignment), share of tracks keeping their cluster id, and ARI
+refit      a refit after replacing part of the tracks, aligned to the previous layout on the tracks both share
+
+Usage: python -m benchmarks.bench_parallel_umap --sizes 100 1000 5000 --jobs 1 2 4 8 --out parallel.json
+'''
+
+
+def relative_rmsd(coords: np.ndarray, reference: np.ndarray) -> float:
+    spread = np.sqrt(((reference - reference.mean(axis=0)) ** 2).sum(axis=1).mean())
+    return float(np.sqrt(((coords - reference) ** 2).sum(axis=1).mean()) / spread)
+
+
+def time_fit(feature_matrix: np.ndarray, repeat: int, **fit_args) -> float:
+    from src import math_utils
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        math_utils.fit_models(feature_matrix, **fit_args)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def aligned_fit(feature_matrix: np.ndarray, matrix_scaled: np.ndarray, n_jobs: int, reference: tuple | None = None):
+    '''Returns (aligned coords, aligned labels, raw coords) of one parallel fit'''
+
+    from src import math_utils
+
+    _, _, _, projection, labels = math_utils.fit_models(feature_matrix, parallel=True, n_jobs=n_jobs)
+    alignment = math_utils.align_layout(matrix_scaled, projection, labels, reference)
+    coords, aligned_labels = math_utils.apply_alignment(alignment, projection, labels)
+    return coords, aligned_labels, projection
+
+
+def stability(feature_matrix: np.ndarray, matrix_scaled: np.ndarray, runs: int, n_jobs: int) -> dict:
+    from sklearn.metrics import adjusted_rand_score
+
+    fits = [aligned_fit(feature_matrix, matrix_scaled, n_jobs) for _ in range(runs)]
+    first_coords, first_labels, first_raw = fits[0]
+    others = fits[1:]
+    return {
+        'raw_rmsd': statistics.mean(relative_rmsd(raw, first_raw) for _, _, raw in others),
+        'aligned_rmsd': statistics.mean(relative_rmsd(coords, first_coords) for coords, _, _ in others),
+        'same_cluster_id': statistics.mean(float((labels == first_labels).mean()) for _, labels, _ in others),
+        'ari': statistics.mean(adjusted_rand_score(first_labels, labels) for _, labels, _ in others),
+    }
+
+
+def refit_stability(tracks: list, replace_fraction: float, n_jobs: int) -> dict:
+    '''Fits, swaps replace_fraction of the tracks for unseen ones, refits aligned to the first layout'''
+
+    from sklearn.preprocessing import StandardScaler
+    from benchmarks.synthetic import synthetic_tracks
+    from src import math_utils
+
+    n_replace = int(len(tracks) * replace_fraction)
+    replacements, _ = synthetic_tracks(n_replace, seed=7)
+    for offset, track in enumerate(replacements):
+        track.spotify_id = f'replacement_{offset}'
+    second = tracks[n_replace:] + replacements
+
+    first_matrix = math_utils.build_feature_matrix(tracks)
+    first_coords, first_labels, _ = aligned_fit(first_matrix, StandardScaler().fit_transform(first_matrix), n_jobs)
+
+    first_rows = {track.spotify_id: i for i, track in enumerate(tracks)}
+    rows = np.array([i for i, track in enumerate(second) if track.spotify_id in first_rows], dtype=np.intp)
+    previous_rows = np.array([first_rows[second[i].spotify_id] for i in rows], dtype=np.intp)
+
+    second_matrix = math_utils.build_feature_matrix(second)
+    reference = (rows, first_coords[previous_rows], first_labels[previous_rows])
+    coords, labels, raw = aligned_fit(second_matrix, StandardScaler().fit_transform(second_matrix), n_jobs, reference)
+
+    return {
+        'replaced': n_replace,
+        'raw_rmsd': relative_rmsd(raw[rows], first_coords[previous_rows]),
+        'aligned_rmsd': relative_rmsd(coords[rows], first_coords[previous_rows]),
+        'same_cluster_id': float((labels[rows] == first_labels[previous_rows]).mean()),
+    }
+
+
+def bench_size(n_tracks: int, jobs: list[int], repeat: int, runs: int, replace_fraction: float) -> dict:
+    from sklearn.preprocessing import StandardScaler
+    from benchmarks.synthetic import synthetic_tracks
+    from src import math_utils
+
+    tracks, _ = synthetic_tracks(n_tracks)
+    feature_matrix = math_utils.build_feature_matrix(tracks)
+    matrix_scaled = StandardScaler().fit_transform(feature_matrix)
+
+    seeded = time_fit(feature_matrix, repeat, parallel=False)
+    print(f'{n_tracks:>6} tracks: seeded {seeded:6.2f} s')
+
+    parallel = {}
+    for n_jobs in jobs:
+        seconds = time_fit(feature_matrix, repeat, parallel=True, n_jobs=n_jobs)
+        parallel[n_jobs] = {'seconds': seconds, 'speedup': seeded / seconds}
+        print(f'        n_jobs {n_jobs:>3}: {seconds:6.2f} s  speedup {seeded / seconds:5.2f}x')
+
+    stable = stability(feature_matrix, matrix_scaled, runs, jobs[-1])
+    print(f"        stability over {runs} runs: RMSD raw {stable['raw_rmsd']:.3f} -> aligned {stable['aligned_rmsd']:.3f}, "
+          f"same cluster id {stable['same_cluster_id']:.1%}, ARI {stable['ari']:.3f}")
+
+    refit = refit_stability(tracks, replace_fraction, jobs[-1])
+    print(f"        refit with {refit['replaced']} replaced: RMSD raw {refit['raw_rmsd']:.3f} -> aligned {refit['aligned_rmsd']:.3f}, "
+          f"same cluster id {refit['same_cluster_id']:.1%}")
+
+    return {'tracks': n_tracks, 'seeded_seconds': seeded, 'parallel': parallel, 'stability': stable, 'refit': refit}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--jobs', type=int, nargs='+', default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument('--repeat', type=int, default=3, help='timed fits per setting, the median is reported')
+    parser.add_argument('--runs', type=int, default=5, help='parallel fits compared for stability')
+    parser.add_argument('--replace', type=float, default=0.2, help='fraction of tracks swapped before the refit')
+    parser.add_argument('--out', help='JSON file to write results to')
+    args = parser.parse_args()
+
+    from src import math_utils
+
+    # JIT compilation is measured by bench_startup, keep it out of these numbers
+    math_utils.warmup(parallel=False)
+    math_utils.warmup(parallel=True)
+    print(f'{os.cpu_count()} cores')
+
+    results = [bench_size(n_tracks, args.jobs, args.repeat, args.runs, args.replace) for n_tracks in args.sizes]
+
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump({'cpu_count': os.cpu_count(), 'results': results}, file, indent=2)
+        print(f'Saved {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+'''Benchmark suite: nebula pipline on synthetic genre clusters, with regression tracking
+
+run      times the pipline for an engine mode per size, each size in a fresh interpreter so peak RSS is per size.
+         Reports wall time, per stage breakdown (features, scale, umap, hdbscan, wrap, ...), get_esp time,
+         peak RSS and clustering quality (ARI / NMI) against the genre each synthetic track was drawn from
+compare  flags stages slower, memory higher, or quality lower than a baseline run beyond a threshold.
+         Exits 1 when anything regressed, so it can gate CI
+
+Usage: python -m benchmarks.bench_pipeline run --sizes 50 200 1000 5000 20000 --out baseline.json
+       python -m benchmarks.bench_pipeline run --mode fast --out fast.json
+       python -m benchmarks.bench_pipeline compare baseline.json candidate.json --threshold 0.15
+'''
+
+DEFAULT_SIZES = [50, 200, 1000, 5000, 20000]
+ENGINE_MODES = ('quality', 'fast', 'density', 'tsne')  # math_utils.ENGINES, kept here so the CLI does not import src
+TIME_KEYS = ('wall_s', 'features', 'scale', 'pca', 'umap', 'tsne', 'kmeans', 'dbscan', 'hdbscan', 'align', 'wrap', 'get_esp')
+QUALITY_KEYS = ('ari', 'nmi')
+
+
+def measure(n_tracks: int, repeat: int, mode: str = 'quality') -> dict:
+    '''Runs in the child interpreter: warms up, then times the pipline for mode repeat times on n_tracks synthetic tracks'''
+
+    import resource
+    from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+    from sklearn.preprocessing import StandardScaler
+    from benchmarks.synthetic import synthetic_tracks
+    from src import math_utils
+
+    # JIT compilation is measured by bench_startup, keep it out of these numbers
+    math_utils.warmup()
+
+    tracks, true_labels = synthetic_tracks(n_tracks)
+    runs = []
+    for _ in range(repeat):
+        timings = {}
+        start = time.perf_counter()
+        projection = math_utils.engine_pipline(tracks, mode, timings=timings)
+        timings['wall_s'] = time.perf_counter() - start
+        runs.append(timings)
+
+    matrix_scaled = StandardScaler().fit_transform(math_utils.build_feature_matrix(tracks))
+    start = time.perf_counter()
+    math_utils.get_esp(matrix_scaled)
+    get_esp_s = time.perf_counter() - start
+
+    clusters = projection.clusters
+    result = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    result.update({
+        'tracks': n_tracks,
+        'mode': mode,
+        'repeat': repeat,
+        'get_esp': get_esp_s,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # KiB on Linux
+        'ari': adjusted_rand_score(true_labels, clusters),
+        'nmi': normalized_mutual_info_score(true_labels, clusters),
+        'n_clusters': int(len(set(clusters.tolist()) - {-1})),
+        'noise_fraction': float((clusters == -1).mean()),
+    })
+    return result
+
+
+def run_size(n_tracks: int, repeat: int, mode: str) -> dict:
+    '''Runs measure in a fresh interpreter from the repo root and returns its JSON output'''
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    completed = subprocess.run([sys.executable, '-m', 'benchmarks.bench_pipeline', 'measure', str(n_tracks), '--repeat', str(repeat), '--mode', mode],
+                               cwd=repo_root, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def environment() -> dict:
+    '''Versions that explain most run to run differences'''
+
+    from importlib.metadata import version, PackageNotFoundError
+
+    packages = {}
+    for package in ('numpy', 'scikit-learn', 'umap-learn', 'hdbscan', 'numba', 'pynndescent'):
+        try:
+            packages[package] = version(package)
+        except PackageNotFoundError:
+            packages[package] = None
+
+    return {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'packages': packages,
+    }
+
+
+def run(args):
+    results = []
+    for n_tracks in args.sizes:
+        result = run_size(n_tracks, args.repeat, args.mode)
+        results.append(result)
+        stages = ', '.join(f'{key} {result[key] * 1000:.1f} ms' for key in TIME_KEYS[1:-1] if key in result)
+        print(f"{n_tracks:>6} tracks: wall {result['wall_s']:7.2f} s ({stages}), get_esp {result['get_esp']:5.2f} s, "
+              f"peak RSS {result['peak_rss_mb']:7.0f} MB, ARI {result['ari']:.3f}, NMI {result['nmi']:.3f}, clusters {result['n_clusters']}")
+
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump({'environment': environment(), 'results': results}, file, indent=2)
+        print(f'Saved {args.out}')
+
+
+def compare(args) -> int:
+    '''Prints a row per size and metric, returns the number of regressions'''
+
+    with open(args.baseline) as file:
+        baseline = {result['tracks']: result for result in json.load(file)['results']}
+    with open(args.candidate) as file:
+        candidate = {result['tracks']: result for result in json.load(file)['results']}
+
+    regressions = 0
+    for n_tracks in sorted(baseline.keys() & candidate.keys()):
+        before, after = baseline[n_tracks], candidate[n_tracks]
+        checks = [(key, 'higher', args.threshold) for key in TIME_KEYS]
+        checks.append(('peak_rss_mb', 'higher', args.memory_threshold))
+        checks += [(key, 'lower', args.quality_threshold) for key in QUALITY_KEYS]
+
+        for key, worse, threshold in checks:
+            if key not in before or key not in after:
+                continue
+            if worse == 'higher':
+                # Stages under a millisecond are noise, compare relative change above that
+                change = (after[key] - before[key]) / max(before[key], 1e-3)
+                regressed = change > threshold
+                delta = f'{change:+7.1%}'
+            else:
+                change = after[key] - before[key]
+                regressed = -change > threshold
+                delta = f'{change:+7.3f}'
+            regressions += regressed
+            flag = 'REGRESSION' if regressed else ''
+            print(f'{n_tracks:>6} {key:>12}: {before[key]:10.4f} -> {after[key]:10.4f} {delta} {flag}')
+
+    print(f'{regressions} regression(s)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='benchmark the pipline and optionally save results as JSON')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--mode', choices=list(ENGINE_MODES), default='quality')
+    run_parser.add_argument('--out', help='JSON file to write results to')
+
+    compare_parser = commands.add_parser('compare', help='compare two saved runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=0.15, help='relative slowdown that counts as a regression')
+    compare_parser.add_argument('--memory-threshold', type=float, default=0.15, help='relative peak RSS growth that counts as a regression')
+    compare_parser.add_argument('--quality-threshold', type=float, default=0.02, help='absolute ARI / NMI drop that counts as a regression')
+
+    measure_parser = commands.add_parser('measure', help=argparse.SUPPRESS)
+    measure_parser.add_argument('tracks', type=int)
+    measure_parser.add_argument('--repeat', type=int, default=3)
+    measure_parser.add_argument('--mode', choices=list(ENGINE_MODES), default='quality')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        sys.exit(1 if compare(args) else 0)
+    else:
+        print(json.dumps(measure(args.tracks, args.repeat, args.mode)))
+
+
+if __name__ == '__main__':
+    main()
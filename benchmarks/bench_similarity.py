@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import pickle
+import statistics
+import tempfile
+import time
+import numpy as np
+
+'''Benchmark: the similarity index, recall against latency
+
+recall     recall@k of index queries against an exact scan, with per query latency (p50 / p99), per search epsilon
+exact      latency of the exact NumPy scan the index replaces, for comparison
+build      time to build the first version, to merge a buffer of new tracks into it, and to load a saved version
+
+Usage: python -m benchmarks.bench_similarity --sizes 10000 100000 --epsilons 0 0.05 0.1 0.2 0.3 --out similarity.json
+'''
+
+
+def feature_rows(n_tracks: int, seed: int) -> tuple[list[str], np.ndarray]:
+    from benchmarks.synthetic import synthetic_tracks
+    from src import math_utils
+
+    tracks, _ = synthetic_tracks(n_tracks, seed=seed)
+    return [f'{track.spotify_id}_{seed}' for track in tracks], math_utils.build_feature_matrix(tracks)
+
+
+def percentile(values: list[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def exact_neighbours(vectors: np.ndarray, queries: np.ndarray, k: int) -> tuple[np.ndarray, list[float]]:
+    '''Exact k nearest rows for every query and the per query latency of the scan'''
+
+    neighbours, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        distances = np.linalg.norm(vectors - query, axis=1)
+        neighbours.append(np.argpartition(distances, k)[:k])
+        latencies.append(time.perf_counter() - start)
+    return np.array(neighbours), latencies
+
+
+def recall_at(graph, queries: np.ndarray, truth: np.ndarray, k: int, epsilon: float) -> dict:
+    hits, latencies = 0, []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        rows, _ = graph.query(query.reshape(1, -1), k=k, epsilon=epsilon)
+        latencies.append(time.perf_counter() - start)
+        hits += len(set(rows[0].tolist()) & set(expected.tolist()))
+    return {'epsilon': epsilon, 'recall': hits / truth.size,
+            'p50_ms': percentile(latencies, 50) * 1000, 'p99_ms': percentile(latencies, 99) * 1000}
+
+
+def bench_size(n_tracks: int, epsilons: list[float], k: int, n_queries: int, merge_size: int) -> dict:
+    from src import similarity_index
+
+    spotify_ids, raw = feature_rows(n_tracks, seed=2025)
+
+    start = time.perf_counter()
+    state = similarity_index.build_version(None, spotify_ids, raw)
+    build_seconds = time.perf_counter() - start
+
+    # Queries are tracks not in the index, like a lookup by features of a track seen after the build
+    _, query_raw = feature_rows(n_queries, seed=11)
+    queries = ((query_raw - state['mean']) / state['std']).astype(np.float32)
+    truth, exact_latencies = exact_neighbours(np.asarray(state['vectors']), queries, k)
+    exact = {'p50_ms': percentile(exact_latencies, 50) * 1000, 'p99_ms': percentile(exact_latencies, 99) * 1000}
+    print(f'{n_tracks:>8} tracks: build {build_seconds:6.1f} s, exact scan p50 {exact["p50_ms"]:.2f} ms p99 {exact["p99_ms"]:.2f} ms')
+
+    recall = []
+    for epsilon in epsilons:
+        result = recall_at(state['graph'], queries, truth, k, epsilon)
+        recall.append(result)
+        print(f'          epsilon {epsilon:4.2f}: recall@{k} {result["recall"]:.3f}  p50 {result["p50_ms"]:.3f} ms  p99 {result["p99_ms"]:.3f} ms')
+
+    merge_ids, merge_raw = feature_rows(merge_size, seed=7)
+    start = time.perf_counter()
+    merged = similarity_index.build_version(state, merge_ids, merge_raw)
+    merge_seconds = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        version = similarity_index.save_version(directory, merged)
+        size_mb = sum(entry.stat().st_size for entry in os.scandir(os.path.join(directory, version))) / 1e6
+        start = time.perf_counter()
+        similarity_index.load_version(directory, version)
+        load_seconds = time.perf_counter() - start
+    print(f'          merge {merge_size} tracks {merge_seconds:.1f} s, saved {size_mb:.1f} MB, load {load_seconds:.2f} s, '
+          f'graph pickle {len(pickle.dumps(merged["graph"])) / 1e6:.1f} MB')
+
+    return {'tracks': n_tracks, 'k': k, 'queries': n_queries, 'build_seconds': build_seconds, 'exact': exact, 'recall': recall,
+            'merge_size': merge_size, 'merge_seconds': merge_seconds, 'saved_mb': size_mb, 'load_seconds': load_seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--epsilons', type=float, nargs='+', default=[0.0, 0.05, 0.1, 0.2, 0.3])
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--merge-size', type=int, default=5000, help='tracks merged into the built index')
+    parser.add_argument('--out', help='JSON file to write results to')
+    args = parser.parse_args()
+
+    from src import similarity_index
+
+    # Numba compiles pynndescent on first use, keep it out of the build times
+    _, warm_raw = feature_rows(200, seed=1)
+    similarity_index.build_version(None, [str(i) for i in range(len(warm_raw))], warm_raw)['graph'].query(warm_raw[:1], k=5)
+    print(f'{os.cpu_count()} cores')
+
+    results = [bench_size(n_tracks, args.epsilons, args.k, args.queries, args.merge_size) for n_tracks in args.sizes]
+
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump({'cpu_count': os.cpu_count(), 'results': results}, file, indent=2)
+        print(f'Saved {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+'''Benchmark: worker boot time and first nebula pipeline latency, with and without warm-up and numba's disk cache
+
+Every measurement runs in a fresh interpreter so module import and JIT costs are real.
+
+Usage: python -m benchmarks.bench_startup --tracks 100
+'''
+
+IMPORT_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+import src.main
+print(json.dumps({'import_s': time.perf_counter() - start}))
+'''
+
+FIRST_REQUEST_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from src import math_utils
+warmup = sys.argv[1] == 'true'
+if warmup:
+    math_utils.warmup()
+ready = time.perf_counter()
+
+from benchmarks.synthetic import synthetic_tracks
+tracks, _ = synthetic_tracks(int(sys.argv[2]))
+request_start = time.perf_counter()
+math_utils.pipline(tracks)
+print(json.dumps({'startup_s': ready - start, 'first_request_s': time.perf_counter() - request_start}))
+'''
+
+
+def run_script(script: str, *args, env: dict | None = None) -> dict:
+    '''Runs script in a fresh interpreter from the repo root and returns its JSON output'''
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    completed = subprocess.run([sys.executable, '-c', script, *args], cwd=repo_root, env={**os.environ, **(env or {})},
+                               capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tracks', type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"import src.main: {run_script(IMPORT_SCRIPT)['import_s']:.2f} s")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = {'NUMBA_CACHE_DIR': cache_dir}
+        scenarios = [
+            ('no warm-up, cold numba cache', 'false'),
+            ('no warm-up, warm numba cache', 'false'),
+            ('warm-up, warm numba cache', 'true'),
+        ]
+        for label, warmup in scenarios:
+            result = run_script(FIRST_REQUEST_SCRIPT, warmup, str(args.tracks), env=env)
+            print(f"{label:>30}: startup {result['startup_s']:6.2f} s, first request {result['first_request_s']:6.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import secrets
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+'''Load test driver: closed loop virtual users calling /nebula/{term} with fixture JWTs, one stage per user count.
+Reports throughput, p50/p95/p99 latency, status codes, the driver's own event loop lag (its numbers are only as good
+as its loop) and the server's event loop lag from nebula_event_loop_lag_seconds on /metrics. With several uvicorn
+workers each scrape lands on one of them, so the server lag is a sample of one worker
+
+--spawn  starts the stub server, seeds fixtures into a temporary SQLite database and runs uvicorn with --workers,
+         all as subprocesses pointed at each other, then tears them down
+--url    drives a server that is already running, with fixtures from benchmarks.loadtest.fixtures
+
+Usage: python -m benchmarks.loadtest.driver --spawn --workers 2 --users 10 50 100 200 --duration 20 --stub-latency 0.05
+       python -m benchmarks.loadtest.driver --url http://127.0.0.1:8000 --fixtures users.json --users 50 100
+'''
+
+TERMS = ('short_term', 'medium_term', 'long_term')
+LAG_METRIC = 'nebula_event_loop_lag_seconds'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f'{url} did not come up within {timeout:.0f}s')
+
+
+def parse_histogram(text: str, name: str) -> dict:
+    '''Sums a Prometheus histogram over its label sets: {'buckets': {le: cumulative}, 'sum': s, 'count': n}'''
+
+    histogram = {'buckets': {}, 'sum': 0.0, 'count': 0}
+    for line in text.splitlines():
+        if not line.startswith(name):
+            continue
+        metric, value = line.rsplit(' ', 1)
+        if metric.startswith(f'{name}_bucket'):
+            bound = re.search(r'le="([^"]+)"', metric).group(1)
+            bound = float('inf') if bound == '+Inf' else float(bound)
+            histogram['buckets'][bound] = histogram['buckets'].get(bound, 0) + float(value)
+        elif metric.startswith(f'{name}_sum'):
+            histogram['sum'] += float(value)
+        elif metric.startswith(f'{name}_count'):
+            histogram['count'] += float(value)
+    return histogram
+
+
+def lag_summary(before: dict, after: dict) -> dict:
+    '''Mean lag and the bucket bound holding the 99th percentile, between two scrapes'''
+
+    count = after['count'] - before['count']
+    if count <= 0:
+        return {'samples': 0, 'mean_ms': None, 'p99_le_ms': None}
+    p99_bound = float('inf')
+    for bound in sorted(after['buckets']):
+        if after['buckets'][bound] - before['buckets'].get(bound, 0) >= 0.99 * count:
+            p99_bound = bound
+            break
+    return {'samples': int(count), 'mean_ms': (after['sum'] - before['sum']) / count * 1000, 'p99_le_ms': p99_bound * 1000}
+
+
+async def scrape_lag(client: httpx.AsyncClient, base_url: str) -> dict | None:
+    try:
+        response = await client.get(f'{base_url}/metrics')
+    except httpx.HTTPError:
+        return None
+    return parse_histogram(response.text, LAG_METRIC) if response.status_code == 200 else None
+
+
+async def measure_loop_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    '''Largest delay past interval seen by the driver's own loop'''
+
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def run_stage(base_url: str, fixtures: list[dict], n_users: int, duration: float, think: float, params: dict) -> dict:
+    '''n_users virtual users, each on its own fixture, requesting nebulas back to back for duration seconds'''
+
+    limits = httpx.Limits(max_connections=n_users + 1, max_keepalive_connections=n_users + 1)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(120.0)) as client:
+        lag_before = await scrape_lag(client, base_url)
+        latencies = []
+        statuses = {}
+        deadline = time.perf_counter() + duration
+
+        async def virtual_user(index: int):
+            fixture = fixtures[index % len(fixtures)]
+            headers = {'Authorization': f"Bearer {fixture['jwt']}"}
+            request_index = index
+            while time.perf_counter() < deadline:
+                term = TERMS[request_index % len(TERMS)]
+                request_index += 1
+                start = time.perf_counter()
+                try:
+                    response = await client.get(f'{base_url}/nebula/{term}', headers=headers, params=params)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+                if think:
+                    await asyncio.sleep(think)
+
+        stop = asyncio.Event()
+        lag_task = asyncio.create_task(measure_loop_lag(stop))
+        start = time.perf_counter()
+        await asyncio.gather(*(virtual_user(index) for index in range(n_users)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        driver_lag = await lag_task
+        lag_after = await scrape_lag(client, base_url)
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [latencies[0] if latencies else 0.0] * 99
+    return {
+        'users': n_users,
+        'requests': len(latencies),
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': quantiles[49] * 1000,
+        'p95_ms': quantiles[94] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'driver_max_loop_lag_ms': driver_lag * 1000,
+        'server_loop_lag': lag_summary(lag_before, lag_after) if lag_before and lag_after else None,
+    }
+
+
+def print_stage(result: dict):
+    lag = result['server_loop_lag'] or {}
+    server_lag = f"server loop lag mean {lag['mean_ms']:.1f} ms p99 <= {lag['p99_le_ms']:.0f} ms" if lag.get('samples') else 'server loop lag n/a'
+    print(f"{result['users']:>5} users: {result['throughput_rps']:7.1f} req/s  p50 {result['p50_ms']:7.0f} ms  p95 {result['p95_ms']:7.0f} ms  "
+          f"p99 {result['p99_ms']:7.0f} ms  statuses {result['statuses']}  {server_lag}  driver lag {result['driver_max_loop_lag_ms']:.0f} ms")
+
+
+class SpawnedStack:
+    '''Stub server, fixtures and uvicorn workers as subprocesses sharing a temporary directory'''
+
+    def __init__(self, args):
+        self.args = args
+        self.processes = []
+        self.directory = tempfile.TemporaryDirectory()
+        self.log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+
+    def __enter__(self) -> tuple[str, list[dict]]:
+        args = self.args
+        repo_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        stub_port, app_port = free_port(), free_port()
+        stub_url = f'http://127.0.0.1:{stub_port}'
+
+        env = {
+            **os.environ,
+            'DATABASE_URL': f"sqlite+aiosqlite:///{os.path.join(self.directory.name, 'loadtest.db')}",
+            'NEBULA_MODEL_DIR': os.path.join(self.directory.name, 'models'),
+            'SECRET_KEY': secrets.token_hex(16),
+            'CLIENT_ID': 'loadtest', 'CLIENT_SECRET': 'loadtest', 'RAPID_API_KEY': 'loadtest',
+            'SPOTIFY_ACCOUNTS_URL': stub_url, 'SPOTIFY_API_URL': f'{stub_url}/v1', 'RAPID_API_URL': stub_url,
+            'UPSTREAM_RATE': str(args.upstream_rate), 'UPSTREAM_BURST': str(args.upstream_rate),
+            'UPSTREAM_CONCURRENCY': str(args.upstream_concurrency),
+        }
+        if args.no_result_cache:
+            env['RESULT_CACHE_TTL'] = '0'
+
+        self.processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.stub_server', '--port', str(stub_port), '--latency', str(args.stub_latency),
+             '--error-rate', str(args.error_rate), '--rate-limit-rate', str(args.rate_limit_rate), '--catalog-size', str(args.catalog_size)],
+            cwd=repo_root, env=env, stdout=self.log, stderr=self.log))
+        wait_until_up(f'{stub_url}/_stats')
+
+        fixtures_path = os.path.join(self.directory.name, 'users.json')
+        subprocess.run([sys.executable, '-m', 'benchmarks.loadtest.fixtures', '--users', str(max(args.users)), '--out', fixtures_path],
+                       cwd=repo_root, env=env, check=True, stdout=subprocess.DEVNULL)
+        with open(fixtures_path) as file:
+            fixtures = json.load(file)
+
+        self.processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'src.main:app', '--port', str(app_port), '--workers', str(args.workers), '--log-level', 'warning'],
+            cwd=repo_root, env=env, stdout=self.log, stderr=self.log))
+        base_url = f'http://127.0.0.1:{app_port}'
+        wait_until_up(f'{base_url}/metrics', timeout=180)
+        print(f'Spawned stub at {stub_url} and {args.workers} uvicorn worker(s) at {base_url}, {len(fixtures)} fixture users')
+        return base_url, fixtures
+
+    def __exit__(self, *exc):
+        for process in reversed(self.processes):
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.log is not subprocess.DEVNULL:
+            self.log.close()
+        self.directory.cleanup()
+
+
+async def run(base_url: str, fixtures: list[dict], args) -> list[dict]:
+    params = {'mode': args.mode} if args.mode else {}
+    results = []
+    for n_users in args.users:
+        result = await run_stage(base_url, fixtures, n_users, args.duration, args.think, params)
+        print_stage(result)
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--spawn', action='store_true', help='start the stub server and uvicorn workers')
+    target.add_argument('--url', help='base URL of a running server')
+    parser.add_argument('--fixtures', help='JSON from benchmarks.loadtest.fixtures, required with --url')
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 50, 100, 200], help='concurrent users per stage')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per stage')
+    parser.add_argument('--think', type=float, default=0.0, help='seconds a user waits between requests')
+    parser.add_argument('--mode', help='nebula mode query parameter')
+    parser.add_argument('--out', help='JSON file to write results to')
+
+    spawn = parser.add_argument_group('--spawn options')
+    spawn.add_argument('--workers', type=int, default=1, help='uvicorn worker processes')
+    spawn.add_argument('--stub-latency', type=float, default=0.05, help='seconds per upstream response')
+    spawn.add_argument('--error-rate', type=float, default=0.0, help='fraction of upstream calls answered 503')
+    spawn.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of upstream calls answered 429')
+    spawn.add_argument('--catalog-size', type=int, default=20000, help='tracks the stub draws top lists from')
+    spawn.add_argument('--upstream-rate', type=float, default=200.0, help='RapidAPI token bucket rate per worker')
+    spawn.add_argument('--upstream-concurrency', type=int, default=50)
+    spawn.add_argument('--server-log', help='file for stub and server output, discarded by default')
+    spawn.add_argument('--no-result-cache', action='store_true', help='RESULT_CACHE_TTL=0, every request runs the pipeline')
+    args = parser.parse_args()
+
+    if args.url:
+        if not args.fixtures:
+            parser.error('--fixtures is required with --url')
+        with open(args.fixtures) as file:
+            results = asyncio.run(run(args.url.rstrip('/'), json.load(file), args))
+    else:
+        with SpawnedStack(args) as (base_url, fixtures):
+            results = asyncio.run(run(base_url, fixtures, args))
+
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump({'args': {key: value for key, value in vars(args).items()}, 'results': results}, file, indent=2)
+        print(f'Saved {args.out}')
+
+
+if __name__ == '__main__':
+    main()
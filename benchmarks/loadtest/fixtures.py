@@ -0,0 +1,49 @@
+import argparse
+import asyncio
+import json
+from datetime import timedelta
+from benchmarks.stub_server import STUB_ACCESS_PREFIX, STUB_REFRESH_PREFIX
+
+'''Load test fixtures: users with stub Spotify tokens in the database, and a JWT for each from create_access_token.
+Run with the server's DATABASE_URL and SECRET_KEY so it accepts the JWTs and finds the tokens
+
+Usage: DATABASE_URL=... SECRET_KEY=... python -m benchmarks.loadtest.fixtures --users 500 --out users.json
+'''
+
+
+async def seed_users(n_users: int, jwt_minutes: int = 24 * 60, token_expires_in: int = 3600) -> list[dict]:
+    '''Creates or updates n_users users and returns [{nebula_user_id, jwt}]. Stub tokens name the user, so the stub
+    server gives each one its own top tracks and refreshes them'''
+
+    # Imported here so DATABASE_URL and SECRET_KEY from the environment are read when the caller has set them
+    from src.database import create_db, crud
+    from src.routers.spotify import create_access_token
+
+    await create_db.init_db()
+    fixtures = []
+    async with create_db.SessionLocal() as db_session:
+        for index in range(n_users):
+            user = await crud.create_nebula_user(db_session, f'stub_user_{index}', f'Stub {index}')
+            await crud.update_tokens(db_session, user.id, f'{STUB_ACCESS_PREFIX}{index}', f'{STUB_REFRESH_PREFIX}{index}', token_expires_in)
+            jwt = create_access_token(user.id, user.spotify_user_id, user.display_name, timedelta(minutes=jwt_minutes))
+            fixtures.append({'nebula_user_id': user.id, 'jwt': jwt})
+    await create_db.engine.dispose()
+    return fixtures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--jwt-minutes', type=int, default=24 * 60)
+    parser.add_argument('--token-expires-in', type=int, default=3600, help='seconds until the stored Spotify tokens need a refresh')
+    parser.add_argument('--out', default='users.json')
+    args = parser.parse_args()
+
+    fixtures = asyncio.run(seed_users(args.users, args.jwt_minutes, args.token_expires_in))
+    with open(args.out, 'w') as file:
+        json.dump(fixtures, file)
+    print(f'Wrote {len(fixtures)} users to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import hashlib
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+'''Local stand-in for the Spotify accounts service, the Spotify Web API and the RapidAPI track analysis endpoint,
+used by benchmarks and the load test. Latency, 5xx and 429 rates are configurable
+
+Usage: python -m benchmarks.stub_server --port 9000 --latency 0.05 --error-rate 0.01 --rate-limit-rate 0.01 --catalog-size 20000
+'''
+
+STUB_ACCESS_PREFIX = 'stub_access_'
+STUB_REFRESH_PREFIX = 'stub_refresh_'
+
+
+def fake_audio_features(track_id: str) -> dict:
+    '''Returns deterministic RapidAPI shaped audio features for a track id'''
+
+    digest = hashlib.sha256(track_id.encode()).digest()
+    unit = [byte / 255 for byte in digest[:7]]
+    return {
+        'acousticness': round(unit[0], 3),
+        'danceability': round(unit[1], 3),
+        'energy': round(unit[2], 3),
+        'instrumentalness': round(unit[3], 3),
+        'loudness': f'{round(-60 * unit[4], 1)} dB',
+        'tempo': round(60 + 140 * unit[5], 1),
+        'speechiness': round(unit[6], 3),
+    }
+
+
+def fake_track_item(index: int, prefix: str = 'track') -> dict:
+    '''Returns a Spotify shaped track item'''
+
+    return {'id': f'{prefix}{index:05d}', 'name': f'Track {index}', 'artists': [{'name': f'Artist {index % 37}'}]}
+
+
+def user_key(request: Request) -> str:
+    '''The user an access token was issued for: stub_access_{key}'''
+
+    token = request.headers.get('authorization', '').removeprefix('Bearer ')
+    return token.removeprefix(STUB_ACCESS_PREFIX)
+
+
+def catalog_top_items(key: str, time_range: str, catalog_size: int, limit: int, offset: int) -> list[dict]:
+    '''A user's top 100 for a term, drawn from a shared catalog skewed toward popular (low index) tracks, so users overlap'''
+
+    rng = random.Random(f'{key}:{time_range}')
+    picked = {}
+    while len(picked) < min(100, catalog_size):
+        picked.setdefault(int(catalog_size * rng.random() ** 2), None)
+    indices = list(picked)[offset:offset + limit]
+    return [fake_track_item(index, prefix='c') for index in indices]
+
+
+def create_stub_app(latency: float = 0.0, library_size: int = 500, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                    retry_after: float = 1.0, catalog_size: int | None = None, token_expires_in: int = 3600, seed: int = 2025) -> FastAPI:
+    '''Creates the stub app. Every distinct client (host, port) pair is one TCP connection, i.e. one TLS handshake upstream.
+    error_rate and rate_limit_rate are the fractions of upstream calls answered 503 and 429. With catalog_size, top
+    tracks differ per user (by access token) instead of being the same list for everyone'''
+
+    app = FastAPI()
+    app.state.connections = set()
+    app.state.requests = 0
+    app.state.injected = {429: 0, 503: 0}
+    rng = random.Random(seed)
+
+    @app.middleware('http')
+    async def count_connections(request: Request, call_next):
+        app.state.connections.add((request.client.host, request.client.port))
+        app.state.requests += 1
+        if latency:
+            await asyncio.sleep(latency)
+        if not request.url.path.startswith('/_'):
+            draw = rng.random()
+            if draw < rate_limit_rate:
+                app.state.injected[429] += 1
+                return JSONResponse({'error': 'rate limited'}, status_code=429, headers={'Retry-After': str(retry_after)})
+            if draw < rate_limit_rate + error_rate:
+                app.state.injected[503] += 1
+                return JSONResponse({'error': 'unavailable'}, status_code=503)
+        return await call_next(request)
+
+    @app.post('/api/token')
+    async def token(request: Request):
+        # Form body parsed by hand, python-multipart is not a dependency
+        form = {key: values[0] for key, values in parse_qs((await request.body()).decode()).items()}
+        if form.get('grant_type') == 'refresh_token':
+            key = form.get('refresh_token', '').removeprefix(STUB_REFRESH_PREFIX)
+        else:
+            key = form.get('code', '')
+        return {'access_token': f'{STUB_ACCESS_PREFIX}{key}', 'refresh_token': f'{STUB_REFRESH_PREFIX}{key}',
+                'token_type': 'Bearer', 'expires_in': token_expires_in}
+
+    @app.get('/v1/me')
+    async def me(request: Request):
+        key = user_key(request)
+        return {'id': f'stub_user_{key}', 'display_name': f'Stub {key}'}
+
+    @app.get('/pktx/spotify/{track_id}')
+    async def track_analysis(track_id: str):
+        return fake_audio_features(track_id)
+
+    @app.get('/v1/me/top/tracks')
+    async def top_tracks(request: Request, time_range: str = 'medium_term', limit: int = 50, offset: int = 0):
+        if catalog_size:
+            return {'items': catalog_top_items(user_key(request), time_range, catalog_size, limit, offset)}
+        return {'items': [fake_track_item(i, prefix=time_range[:1]) for i in range(offset, offset + limit)]}
+
+    @app.get('/v1/me/tracks')
+    async def saved_tracks(limit: int = 50, offset: int = 0):
+        end = min(offset + limit, library_size)
+        return {'total': library_size, 'items': [{'track': fake_track_item(i, prefix='saved')} for i in range(offset, end)]}
+
+    @app.get('/v1/playlists/{playlist_id}/tracks')
+    async def playlist_tracks(playlist_id: str, limit: int = 100, offset: int = 0):
+        end = min(offset + limit, library_size)
+        return {'total': library_size, 'items': [{'track': fake_track_item(i, prefix=playlist_id)} for i in range(offset, end)]}
+
+    @app.get('/_stats')
+    async def stats():
+        return {'connections': len(app.state.connections), 'requests': app.state.requests,
+                'injected_429': app.state.injected[429], 'injected_503': app.state.injected[503]}
+
+    @app.post('/_reset')
+    async def reset():
+        app.state.connections.clear()
+        app.state.requests = 0
+        app.state.injected = {429: 0, 503: 0}
+        return {}
+
+    return app
+
+
+@contextmanager
+def run_stub_server(app: FastAPI, host: str = '127.0.0.1', port: int = 0):
+    '''Runs app with uvicorn in a background thread and yields its base URL'''
+
+    config = uvicorn.Config(app, host=host, port=port, log_level='warning', lifespan='off')
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    while not server.started:
+        time.sleep(0.01)
+
+    bound_port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        yield f'http://{host}:{bound_port}'
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls answered 503')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of calls answered 429')
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--catalog-size', type=int, default=20000, help='tracks top lists are drawn from, 0 for the fixed lists')
+    parser.add_argument('--library-size', type=int, default=500)
+    args = parser.parse_args()
+
+    app = create_stub_app(latency=args.latency, library_size=args.library_size, error_rate=args.error_rate,
+                          rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, catalog_size=args.catalog_size or None)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning', lifespan='off')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import random
+import numpy as np
+from src import math_utils, models
+from src.plot_utils import cluster_centers, generate_feature_dict, random_artist_list, random_string
+
+'''Synthetic tracks drawn around the genre cluster centers in plot_utils, with their known genre labels'''
+
+
+def synthetic_tracks(n_tracks: int, seed: int = 2025, spread: float = 0.1) -> tuple[list[models.Track], np.ndarray]:
+    '''Returns n_tracks synthetic tracks with audio features and the index of the genre center each was drawn from'''
+
+    np.random.seed(seed)
+    random.seed(seed)
+
+    labels = np.arange(n_tracks) % len(cluster_centers)
+    tracks = []
+    for i, label in enumerate(labels):
+        features = generate_feature_dict(cluster_centers[label], spread=spread)
+        features.pop('valence')  # not a feature column
+        tracks.append(models.Track(name=random_string(),
+                                   artist=random_artist_list(),
+                                   spotify_id=f'synthetic{i:06d}',
+                                   audio_features=math_utils.feature_row(features)))
+    return tracks, labels
@@ -1,21 +1,71 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import event, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from .models import Base
-from sqlalchemy.orm import sessionmaker
 
 '''Creates SQL database'''
 
-URL = 'sqlite:///./mydatabase.db'
+'''Configuration'''
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite+aiosqlite:///./mydatabase.db')  # e.g. postgresql+asyncpg://...
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))  # ms a writer waits for the lock before failing
+SQLITE_WAL = os.getenv('SQLITE_WAL', 'true').lower() == 'true'
 
-engine = create_engine(URL)
-Base.metadata.create_all(engine)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# WAL lets readers run alongside the single writer, synchronous=NORMAL is durable under WAL except on power loss
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'busy_timeout': SQLITE_BUSY_TIMEOUT,
+    'foreign_keys': 'ON',
+    'temp_store': 'MEMORY',
+    'cache_size': -16000,  # KiB
+}
+
+
+def build_engine(url: str = DATABASE_URL, wal: bool = SQLITE_WAL):
+    '''Returns an async engine, SQLite connections get WAL journaling and the pragmas above'''
+
+    engine = create_async_engine(url, pool_pre_ping=not url.startswith('sqlite'))
+
+    if engine.dialect.name == 'sqlite':
+        pragmas = {'journal_mode': 'WAL' if wal else 'DELETE', **SQLITE_PRAGMAS}
+
+        @event.listens_for(engine.sync_engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in pragmas.items():
+                cursor.execute(f'PRAGMA {pragma}={value}')
+            cursor.close()
+
+    return engine
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
 
+engine = build_engine()
+SessionLocal = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
 
 
+async def init_db(db_engine=engine):
+    '''Creates tables and indexes, called once from the application lifespan'''
+
+    async with db_engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+        # Databases created before spotify_tokens.user_id was unique: keep each user's newest row, then add the index.
+        # Runs once, later startups find the index
+        token_indexes = await connection.run_sync(lambda sync_connection: inspect(sync_connection).get_indexes('spotify_tokens'))
+        if not any(index['unique'] and index['column_names'] == ['user_id'] for index in token_indexes):
+            await connection.execute(text(
+                'DELETE FROM spotify_tokens WHERE id NOT IN (SELECT MAX(id) FROM spotify_tokens GROUP BY user_id)'
+            ))
+            await connection.execute(text(
+                'CREATE UNIQUE INDEX IF NOT EXISTS ix_spotify_tokens_user_id ON spotify_tokens (user_id)'
+            ))
+
+        # Databases created before nebula_users.last_seen
+        user_columns = await connection.run_sync(lambda sync_connection: inspect(sync_connection).get_columns('nebula_users'))
+        if 'last_seen' not in {column['name'] for column in user_columns}:
+            await connection.execute(text('ALTER TABLE nebula_users ADD COLUMN last_seen TIMESTAMP'))
+            await connection.execute(text('CREATE INDEX IF NOT EXISTS ix_nebula_users_last_seen ON nebula_users (last_seen)'))
+
+
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
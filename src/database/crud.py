@@ -1,84 +1,257 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
-from .models import SpotifyToken, NebulaUser
+from .models import SpotifyToken, NebulaUser, AudioFeature, EmbeddingVersion, TrackEmbedding, UserTaste
 from fastapi import HTTPException
 from datetime import datetime, timezone, timedelta
 
 '''CRUD for SQL database'''
 
+AUDIO_FEATURE_COLUMNS = ('acousticness', 'danceability', 'energy', 'instrumentalness', 'loudness', 'tempo', 'speechiness')
+SQLITE_IN_CHUNK = 500
+EMBEDDING_INSERT_CHUNK = 5000
+
 class TokenNotFoundError(Exception):
     '''Token not found exception'''
 
-def get_token(db_session: Session, neb_user_id: int):
+def upsert(db_session: AsyncSession, model):
+    '''Returns an INSERT for model that supports ON CONFLICT in the session's dialect'''
+
+    if db_session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+async def get_token(db_session: AsyncSession, neb_user_id: int):
     '''Returns token for given nebula user'''
-    
-    token = db_session.query(SpotifyToken).filter(SpotifyToken.user_id == neb_user_id).first()
+
+    token = await db_session.scalar(select(SpotifyToken).where(SpotifyToken.user_id == neb_user_id))
     if token is None:
         raise TokenNotFoundError(f"No access token found for user_id {neb_user_id}")
-    else: 
+    else:
         return token
 
-def create_nebula_user(db_session: Session, spotify_user_id: str, display_name: str):
-    '''Creates nebula user and returns user, if user already exists return existing user'''
+async def create_nebula_user(db_session: AsyncSession, spotify_user_id: str, display_name: str):
+    '''Creates nebula user and returns user, if user already exists updates display name and returns existing user'''
+
+    statement = upsert(db_session, NebulaUser).values(spotify_user_id=spotify_user_id, display_name=display_name)
+    statement = statement.on_conflict_do_update(index_elements=[NebulaUser.spotify_user_id],
+                                                set_={'display_name': statement.excluded.display_name})
+
+    try:
+        user = (await db_session.execute(statement.returning(NebulaUser), execution_options={'populate_existing': True})).scalar_one()
+        await db_session.commit()
+
+    except SQLAlchemyError as e:
+        await db_session.rollback()
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    return user
+
+
+async def update_tokens(db_session: AsyncSession, nebula_user_id: int, access_token:str, refresh_token:str, expires_in: int = 3600):
+    '''Updates and returns tokens for given user, one statement whether or not the user has tokens yet'''
+
+    now = datetime.now(timezone.utc)
+    values = {
+        'access_token': access_token,
+        'refresh_token': refresh_token,
+        'expires_at': now + timedelta(seconds=expires_in),
+        'updated_at': now,
+    }
+    statement = upsert(db_session, SpotifyToken).values(user_id=nebula_user_id, **values)
+    statement = statement.on_conflict_do_update(index_elements=[SpotifyToken.user_id], set_=values)
+
+    try:
+        token_model = (await db_session.execute(statement.returning(SpotifyToken), execution_options={'populate_existing': True})).scalar_one()
+        await db_session.commit()
+
+    except SQLAlchemyError as e:
+        await db_session.rollback()
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    return token_model
+
+
+async def touch_last_seen(db_session: AsyncSession, nebula_user_ids: list[int], seen_at: datetime | None = None):
+    '''Sets last_seen for given users'''
     
-    existing_user = db_session.query(NebulaUser).filter(NebulaUser.spotify_user_id == spotify_user_id).first()
-    if existing_user: 
-        return existing_user
+    try:
+        await db_session.execute(update(NebulaUser).where(NebulaUser.id.in_(nebula_user_ids))
+                                 .values(last_seen=seen_at or datetime.now(timezone.utc)))
+        await db_session.commit()
+        
+    except SQLAlchemyError as e:
+        await db_session.rollback()
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
+async def get_active_users(db_session: AsyncSession, since: datetime, limit: int) -> list[tuple[int, datetime]]:
+    '''Returns (nebula user id, last_seen) for users seen since given time, most recent first'''
     
-    new_user = NebulaUser(spotify_user_id = spotify_user_id, display_name = display_name)
+    result = await db_session.execute(
+        select(NebulaUser.id, NebulaUser.last_seen)
+        .where(NebulaUser.last_seen >= since)
+        .order_by(NebulaUser.last_seen.desc())
+        .limit(limit)
+    )
+    return [tuple(row) for row in result]
+
+
+async def get_audio_features(db_session: AsyncSession, spotify_ids: list[str]) -> dict[str, AudioFeature]:
+    '''Returns cached audio features for the given spotify track ids, keyed by spotify id. Missing ids are omitted'''
+
+    found = {}
+    unique_ids = list(dict.fromkeys(spotify_ids))
+
+    # Chunk the IN clause to stay under SQLite's bound parameter limit
+    for start in range(0, len(unique_ids), SQLITE_IN_CHUNK):
+        chunk = unique_ids[start:start + SQLITE_IN_CHUNK]
+        rows = await db_session.scalars(select(AudioFeature).where(AudioFeature.spotify_id.in_(chunk)))
+        for row in rows:
+            found[row.spotify_id] = row
+
+    return found
+
+
+async def insert_audio_features(db_session: AsyncSession, features: dict[str, dict]) -> int:
+    '''Batch inserts audio features keyed by spotify id, skipping ids already stored. Returns number of rows inserted'''
+
+    if not features:
+        return 0
+
+    rows = [
+        {'spotify_id': spotify_id, **{column: values[column] for column in AUDIO_FEATURE_COLUMNS}}
+        for spotify_id, values in features.items()
+    ]
+    # Core insert on the table, executemany reports inserted rows through rowcount
+    statement = upsert(db_session, AudioFeature.__table__).on_conflict_do_nothing(index_elements=['spotify_id'])
+
+    try:
+        result = await db_session.execute(statement, rows)
+        await db_session.commit()
+
+    except SQLAlchemyError as e:
+        await db_session.rollback()
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    return max(result.rowcount, 0)
+
+
+async def get_all_audio_features(db_session: AsyncSession) -> list[tuple]:
+    '''Returns (spotify_id, *AUDIO_FEATURE_COLUMNS) for every stored track, as plain tuples'''
+    
+    columns = [getattr(AudioFeature, column) for column in AUDIO_FEATURE_COLUMNS]
+    result = await db_session.execute(select(AudioFeature.spotify_id, *columns))
+    return [tuple(row) for row in result]
+
+
+def embedding_rows(version: int, spotify_ids: list[str], coords, clusters) -> list[dict]:
+    return [
+        {'version': version, 'spotify_id': spotify_id, 'x': float(x), 'y': float(y), 'z': float(z), 'cluster': int(cluster)}
+        for spotify_id, (x, y, z), cluster in zip(spotify_ids, coords, clusters)
+    ]
+
+
+async def create_embedding(db_session: AsyncSession, n_fit: int, model_path: str, spotify_ids: list[str], coords, clusters) -> int:
+    '''Stores a new global embedding version and its coordinates in one transaction. Returns the version'''
     
-    try: 
-        db_session.add(new_user)
-        db_session.commit()
-        db_session.refresh(new_user)
+    try:
+        version = EmbeddingVersion(n_tracks=len(spotify_ids), n_fit=n_fit, model_path=model_path)
+        db_session.add(version)
+        await db_session.flush()
+        
+        rows = embedding_rows(version.id, spotify_ids, coords, clusters)
+        for start in range(0, len(rows), EMBEDDING_INSERT_CHUNK):
+            await db_session.execute(upsert(db_session, TrackEmbedding.__table__), rows[start:start + EMBEDDING_INSERT_CHUNK])
+        await db_session.commit()
         
     except SQLAlchemyError as e:
-        db_session.rollback()
+        await db_session.rollback()
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     
-    verified_user = db_session.query(NebulaUser).filter_by(spotify_user_id=spotify_user_id).first()
+    return version.id
+
+
+async def insert_track_embeddings(db_session: AsyncSession, version: int, spotify_ids: list[str], coords, clusters) -> int:
+    '''Adds tracks placed into an existing version, skipping ids already stored. Returns number of rows inserted'''
+    
+    if not spotify_ids:
+        return 0
     
-    if not verified_user:
-        raise HTTPException(status_code=500, detail="User creation failed")
+    statement = upsert(db_session, TrackEmbedding.__table__).on_conflict_do_nothing(index_elements=['version', 'spotify_id'])
     
-    return verified_user
+    try:
+        result = await db_session.execute(statement, embedding_rows(version, spotify_ids, coords, clusters))
+        await db_session.commit()
+        
+    except SQLAlchemyError as e:
+        await db_session.rollback()
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    
+    return max(result.rowcount, 0)
 
 
-def update_tokens(db_session: Session, nebula_user_id: int, access_token:str, refresh_token:str):
-    '''Updates and returns tokens for given user'''
+async def get_latest_embedding_version(db_session: AsyncSession) -> EmbeddingVersion | None:
+    '''Returns the newest global embedding version, or None before the first fit'''
     
-    token_model = db_session.query(SpotifyToken).filter(SpotifyToken.user_id == nebula_user_id).first()
+    return await db_session.scalar(select(EmbeddingVersion).order_by(EmbeddingVersion.id.desc()).limit(1))
+
+
+async def get_track_embeddings(db_session: AsyncSession, version: int) -> list[tuple]:
+    '''Returns (spotify_id, x, y, z, cluster) for every track in version'''
     
-    if token_model:
-        token_model.access_token = access_token
-        token_model.expires_at=datetime.now(timezone.utc) + timedelta(seconds=3600)
-        token_model.updated_at=datetime.now(timezone.utc)
+    result = await db_session.execute(
+        select(TrackEmbedding.spotify_id, TrackEmbedding.x, TrackEmbedding.y, TrackEmbedding.z, TrackEmbedding.cluster)
+        .where(TrackEmbedding.version == version)
+    )
+    return [tuple(row) for row in result]
+
+
+async def delete_old_embeddings(db_session: AsyncSession, keep: int) -> list[str]:
+    '''Deletes all but the newest keep versions and returns their model paths'''
+    
+    old_versions = (await db_session.scalars(select(EmbeddingVersion).order_by(EmbeddingVersion.id.desc()).offset(keep))).all()
+    if not old_versions:
+        return []
+    
+    old_ids = [version.id for version in old_versions]
+    try:
+        await db_session.execute(delete(TrackEmbedding).where(TrackEmbedding.version.in_(old_ids)))
+        await db_session.execute(delete(EmbeddingVersion).where(EmbeddingVersion.id.in_(old_ids)))
+        await db_session.commit()
         
-        db_session.add(token_model)
-        db_session.commit()
-        return token_model
+    except SQLAlchemyError as e:
+        await db_session.rollback()
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     
-    else:
-        new_token_model = SpotifyToken(user_id=nebula_user_id,
-                                        access_token=access_token,
-                                        refresh_token=refresh_token,
-                                        expires_at=datetime.now(timezone.utc) + timedelta(seconds=3600),
-                                        updated_at=datetime.now(timezone.utc))
-
-        try: 
-            db_session.add(new_token_model)
-            db_session.commit()
-            
-        except SQLAlchemyError as e:
-            db_session.rollback()
-            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    return [version.model_path for version in old_versions]
+
+
+async def upsert_user_taste(db_session: AsyncSession, nebula_user_id: int, term: str, features: dict):
+    '''Stores the mean audio features of a user's top tracks for term'''
+    
+    values = {column: float(features[column]) for column in AUDIO_FEATURE_COLUMNS}
+    statement = upsert(db_session, UserTaste).values(user_id=nebula_user_id, term=term, **values)
+    statement = statement.on_conflict_do_update(index_elements=[UserTaste.user_id, UserTaste.term],
+                                                set_={**values, 'updated_at': datetime.now(timezone.utc)})
+    
+    try:
+        await db_session.execute(statement)
+        await db_session.commit()
         
-        return new_token_model
+    except SQLAlchemyError as e:
+        await db_session.rollback()
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 
-def has_expired_token(db_session:Session,  nebula_user_id: int) -> bool:
-    '''Returns true if tokens are expired, otherwise false'''
+async def get_user_tastes(db_session: AsyncSession, term: str) -> list[tuple]:
+    '''Returns (nebula user id, display name, *AUDIO_FEATURE_COLUMNS) of every user with a taste for term'''
     
-    existing_record = db_session.query(SpotifyToken).filter(SpotifyToken.user_id == nebula_user_id).first()
-    expires_at = existing_record.expires_at.replace(tzinfo=timezone.utc)
-    return expires_at <= datetime.now(timezone.utc)
\ No newline at end of file
+    columns = [getattr(UserTaste, column) for column in AUDIO_FEATURE_COLUMNS]
+    result = await db_session.execute(
+        select(UserTaste.user_id, NebulaUser.display_name, *columns)
+        .join(NebulaUser, NebulaUser.id == UserTaste.user_id)
+        .where(UserTaste.term == term)
+    )
+    return [tuple(row) for row in result]
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Text, ForeignKey, TIMESTAMP, func
+from sqlalchemy import Column, Integer, Float, Text, ForeignKey, TIMESTAMP, func
 from sqlalchemy.orm import relationship, declarative_base
 
 Base = declarative_base()
@@ -12,6 +12,7 @@ class NebulaUser(Base):
     spotify_user_id = Column(Text, unique=True, nullable=False)
     display_name = Column(Text, nullable=True)
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.current_timestamp())
+    last_seen = Column(TIMESTAMP(timezone=True), nullable=True, index=True)
     tokens = relationship("SpotifyToken", back_populates="user", cascade="all, delete-orphan")
 
 
@@ -21,7 +22,7 @@ class SpotifyToken(Base):
     __tablename__ = "spotify_tokens"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer, ForeignKey("nebula_users.id", ondelete="CASCADE"))
+    user_id = Column(Integer, ForeignKey("nebula_users.id", ondelete="CASCADE"), unique=True, index=True, nullable=False)
     access_token = Column(Text, nullable=False)
     refresh_token = Column(Text, nullable=False)
     expires_at = Column(TIMESTAMP(timezone=True), nullable=False)
@@ -31,3 +32,61 @@ class SpotifyToken(Base):
         onupdate=func.current_timestamp()
     )
     user = relationship("NebulaUser", back_populates="tokens")
+
+
+class AudioFeature(Base):
+    '''ORM model for cached audio features, keyed by spotify track id'''
+    
+    __tablename__ = "audio_features"
+
+    spotify_id = Column(Text, primary_key=True)
+    acousticness = Column(Float, nullable=False)
+    danceability = Column(Float, nullable=False)
+    energy = Column(Float, nullable=False)
+    instrumentalness = Column(Float, nullable=False)
+    loudness = Column(Float, nullable=False)
+    tempo = Column(Float, nullable=False)
+    speechiness = Column(Float, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.current_timestamp())
+
+
+class EmbeddingVersion(Base):
+    '''ORM model for one fit of the global embedding, the model file holds the fitted scaler, reducer and clusterer'''
+    
+    __tablename__ = "embedding_versions"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    n_tracks = Column(Integer, nullable=False)
+    n_fit = Column(Integer, nullable=False)
+    model_path = Column(Text, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.current_timestamp())
+
+
+class TrackEmbedding(Base):
+    '''ORM model for a track's coordinates and cluster in one version of the global embedding'''
+    
+    __tablename__ = "track_embeddings"
+
+    version = Column(Integer, ForeignKey("embedding_versions.id", ondelete="CASCADE"), primary_key=True)
+    spotify_id = Column(Text, primary_key=True)
+    x = Column(Float, nullable=False)
+    y = Column(Float, nullable=False)
+    z = Column(Float, nullable=False)
+    cluster = Column(Integer, nullable=False)
+
+
+class UserTaste(Base):
+    '''ORM model for the mean audio features of a user's top tracks for a term, used for user similarity'''
+    
+    __tablename__ = "user_tastes"
+
+    user_id = Column(Integer, ForeignKey("nebula_users.id", ondelete="CASCADE"), primary_key=True)
+    term = Column(Text, primary_key=True)
+    acousticness = Column(Float, nullable=False)
+    danceability = Column(Float, nullable=False)
+    energy = Column(Float, nullable=False)
+    instrumentalness = Column(Float, nullable=False)
+    loudness = Column(Float, nullable=False)
+    tempo = Column(Float, nullable=False)
+    speechiness = Column(Float, nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), server_default=func.current_timestamp(), onupdate=func.current_timestamp())
@@ -0,0 +1,269 @@
+import gzip
+import hashlib
+import json
+import os
+import struct
+from collections import OrderedDict
+from typing import Literal
+import numpy as np
+from fastapi import Request
+from fastapi.responses import Response
+from src import metrics, models
+
+'''Response encoders for nebula results. Uses orjson (with native NumPy support) when installed, and brotli for
+compression when installed, gzip otherwise'''
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional, gzip is used instead
+    brotli = None
+
+'''Configuration'''
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))  # smaller bodies are sent uncompressed
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 5))
+ENCODED_CACHE_SIZE = int(os.getenv('ENCODED_CACHE_SIZE', 256))  # encoded bodies kept per process, 0 disables
+
+NebulaFormat = Literal['rows', 'columns', 'packed']
+
+PACKED_MEDIA_TYPE = 'application/vnd.nebula.packed'
+PACKED_MAGIC = b'NEB1'
+PACKED_HEADER = struct.Struct('<4sHHIIII3f3f')
+COORD_LEVELS = 65535
+CLUSTER_MIN, CLUSTER_MAX = -1, np.iinfo(np.int16).max
+
+
+def _default(value):
+    '''json fallback for NumPy arrays and scalars'''
+
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(content) -> bytes:
+    '''Serializes content to JSON bytes, writing NumPy arrays directly'''
+
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, default=_default, separators=(',', ':')).encode()
+
+
+class FastJSONResponse(Response):
+    '''JSON response that skips FastAPI's jsonable_encoder pass'''
+
+    media_type = 'application/json'
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def nebula_payload(projection: models.Projection, format: NebulaFormat = 'rows'):
+    '''Returns a list of Projected_Track shaped rows, or the compact array-of-columns shape. The packed format is
+    binary only, JSON consumers (the stream) get columns for it'''
+
+    if format == 'columns' or format == 'packed':
+        return projection.columns()
+    return projection.rows()
+
+
+def pack_projection(projection: models.Projection) -> bytes:
+    '''Binary nebula, little endian:
+
+    header       magic 'NEB1', u16 version, u16 flags, u32 tracks, u32 strings, u32 artist refs, u32 string bytes,
+                 f32[3] coordinate minimum, f32[3] coordinate step
+    coords       u16[tracks, 3], x = minimum + q * step per axis
+    clusters     i16[tracks], -1 is noise, labels above 32767 are rejected
+    id_refs      u32[tracks], string index of each spotify id
+    name_refs    u32[tracks], string index of each name
+    artist_offs  u32[tracks + 1], track i's artists are artist_refs[artist_offs[i]:artist_offs[i + 1]]
+    artist_refs  u32[artist refs], string indices
+    string_offs  u32[strings + 1], byte offsets into the string data
+    string data  utf-8, every distinct id, name and artist once
+
+    The header is 48 bytes and coords plus clusters 8 bytes per track, so the u32 sections start 4 byte aligned
+    '''
+
+    coords = np.asarray(projection.coords, dtype=np.float32).reshape(-1, 3)
+    minimum = coords.min(axis=0) if len(coords) else np.zeros(3, dtype=np.float32)
+    span = coords.max(axis=0) - minimum if len(coords) else np.zeros(3, dtype=np.float32)
+    step = np.where(span > 0, span / COORD_LEVELS, 1.0).astype(np.float32)
+    quantized = np.rint((coords - minimum) / step).clip(0, COORD_LEVELS).astype('<u2')
+
+    clusters = np.asarray(projection.clusters)
+    if len(clusters) and (clusters.min() < CLUSTER_MIN or clusters.max() > CLUSTER_MAX):
+        raise ValueError(f'Cluster labels must be between {CLUSTER_MIN} and {CLUSTER_MAX} to pack as i16')
+
+    strings = {}
+    id_refs = [strings.setdefault(spotify_id, len(strings)) for spotify_id in projection.spotify_ids]
+    name_refs = [strings.setdefault(name, len(strings)) for name in projection.names]
+    artist_offsets = [0]
+    artist_refs = []
+    for artists in projection.artists:
+        artist_refs.extend(strings.setdefault(str(artist), len(strings)) for artist in artists)
+        artist_offsets.append(len(artist_refs))
+
+    encoded = [string.encode() for string in strings]
+    string_offsets = np.zeros(len(encoded) + 1, dtype='<u4')
+    np.cumsum([len(string) for string in encoded], out=string_offsets[1:])
+    string_data = b''.join(encoded)
+
+    n_tracks = len(coords)
+    header = PACKED_HEADER.pack(PACKED_MAGIC, 1, 0, n_tracks, len(encoded), len(artist_refs), len(string_data),
+                                *minimum.tolist(), *step.tolist())
+    return b''.join((
+        header,
+        quantized.tobytes(),
+        clusters.astype('<i2').tobytes(),
+        np.asarray(id_refs, dtype='<u4').tobytes(),
+        np.asarray(name_refs, dtype='<u4').tobytes(),
+        np.asarray(artist_offsets, dtype='<u4').tobytes(),
+        np.asarray(artist_refs, dtype='<u4').tobytes(),
+        string_offsets.tobytes(),
+        string_data,
+    ))
+
+
+def encode_body(projection: models.Projection, format: NebulaFormat) -> bytes:
+    if format == 'packed':
+        return pack_projection(projection)
+    return dumps(nebula_payload(projection, format))
+
+
+def projection_hash(projection: models.Projection) -> str:
+    '''Content hash of a projection, kept on the object so a cached result is hashed once'''
+
+    cached = getattr(projection, '_content_hash', None)
+    if cached is not None:
+        return cached
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update('\x1f'.join(projection.spotify_ids).encode())
+    digest.update('\x1f'.join(projection.names).encode())
+    digest.update('\x1e'.join('\x1f'.join(map(str, artists)) for artists in projection.artists).encode())
+    digest.update(np.ascontiguousarray(projection.coords, dtype=np.float32).tobytes())
+    digest.update(np.ascontiguousarray(projection.clusters, dtype=np.int32).tobytes())
+    projection._content_hash = digest.hexdigest()
+    return projection._content_hash
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    '''Picks br or gzip from an Accept-Encoding header, None for identity'''
+
+    accepted = {}
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip()] = quality
+
+    for coding in ('br', 'gzip'):
+        if coding == 'br' and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress(body: bytes, encoding: str | None) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return body
+
+
+def etag_matches(if_none_match: str | None, etag_base: str) -> bool:
+    '''Weak comparison of If-None-Match against this representation, any content coding of it matches'''
+
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip().removeprefix('W/').strip('"')
+        if tag == '*' or tag == etag_base or tag.startswith(f'{etag_base}.'):
+            return True
+    return False
+
+
+class EncodedCache:
+    '''LRU of (body, content coding) by (content hash, format, accepted coding), a reload of a cached nebula is not
+    serialized or compressed again'''
+
+    def __init__(self, max_entries: int = ENCODED_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple, tuple[bytes, str | None]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> tuple[bytes, str | None] | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def set(self, key: tuple, entry: tuple[bytes, str | None]):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'entries': len(self.entries), 'bytes': sum(len(body) for body, _ in self.entries.values()),
+                'hits': self.hits, 'misses': self.misses}
+
+
+encoded_cache = EncodedCache()
+
+
+def nebula_response(projection: models.Projection, format: NebulaFormat = 'rows', request: Request | None = None) -> Response:
+    '''Serialized nebula with a content hash ETag. With the request, a matching If-None-Match is answered 304
+    before serializing, and the body is compressed as Accept-Encoding allows'''
+
+    with metrics.span('serialize'):
+        if request is None:
+            if format == 'packed':
+                return Response(pack_projection(projection), media_type=PACKED_MEDIA_TYPE)
+            return FastJSONResponse(nebula_payload(projection, format))
+
+        content_hash = projection_hash(projection)
+        etag_base = f'{content_hash}.{format}'
+        encoding = negotiate_encoding(request.headers.get('accept-encoding', ''))
+        # no-cache: browsers keep the body but revalidate it on every reload
+        headers = {'Vary': 'Accept-Encoding', 'Cache-Control': 'private, no-cache'}
+
+        if etag_matches(request.headers.get('if-none-match'), etag_base):
+            headers['ETag'] = f'"{etag_base}.{encoding}"' if encoding else f'"{etag_base}"'
+            return Response(status_code=304, headers=headers)
+
+        key = (content_hash, format, encoding)
+        cached = encoded_cache.get(key)
+        if cached is not None:
+            body, encoding = cached
+        else:
+            body = encode_body(projection, format)
+            if len(body) < COMPRESS_MIN_BYTES:
+                encoding = None
+            body = compress(body, encoding)
+            encoded_cache.set(key, (body, encoding))
+
+        headers['ETag'] = f'"{etag_base}.{encoding}"' if encoding else f'"{etag_base}"'
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        media_type = PACKED_MEDIA_TYPE if format == 'packed' else FastJSONResponse.media_type
+        return Response(body, media_type=media_type, headers=headers)
@@ -0,0 +1,96 @@
+import os
+from collections import OrderedDict
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import HTTPException
+from src.database import crud
+
+'''Audio feature cache: in-process LRU of feature rows in front of the audio_features table, keyed by spotify track id'''
+
+FEATURE_CACHE_SIZE = int(os.getenv('FEATURE_CACHE_SIZE', 50000))
+
+
+class AudioFeatureCache:
+    '''Two tier cache for audio features. Audio features of a track never change, so entries never expire'''
+
+    def __init__(self, maxsize: int = FEATURE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lru: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.inserts = 0
+
+    def _remember(self, spotify_id: str, features: np.ndarray):
+        '''Adds features to the LRU, evicting least recently used entries past maxsize'''
+
+        self._lru[spotify_id] = features
+        self._lru.move_to_end(spotify_id)
+        while len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+    async def get_many(self, db_session: AsyncSession, spotify_ids: list[str]) -> dict[str, np.ndarray]:
+        '''Returns cached audio features for given spotify ids, checking the LRU then the database'''
+
+        found = {}
+        not_in_memory = []
+
+        for spotify_id in dict.fromkeys(spotify_ids):
+            features = self._lru.get(spotify_id)
+            if features is None:
+                not_in_memory.append(spotify_id)
+            else:
+                self._lru.move_to_end(spotify_id)
+                found[spotify_id] = features
+
+        self.memory_hits += len(found)
+
+        if not_in_memory:
+            rows = await crud.get_audio_features(db_session, not_in_memory)
+            if rows:
+                matrix = np.array([[getattr(row, column) for column in crud.AUDIO_FEATURE_COLUMNS] for row in rows.values()], dtype=np.float64)
+                for spotify_id, features in zip(rows, matrix):
+                    self._remember(spotify_id, features)
+                    found[spotify_id] = features
+
+            self.db_hits += len(rows)
+            self.misses += len(not_in_memory) - len(rows)
+
+        return found
+
+    async def put_many(self, db_session: AsyncSession, features: dict[str, np.ndarray]) -> int:
+        '''Batch inserts newly fetched audio features into the LRU and the database. Returns number of rows inserted'''
+
+        if not features:
+            return 0
+
+        for spotify_id, track_features in features.items():
+            self._remember(spotify_id, track_features)
+
+        try:
+            inserted = await crud.insert_audio_features(db_session, {spotify_id: dict(zip(crud.AUDIO_FEATURE_COLUMNS, track_features.tolist()))
+                                                                     for spotify_id, track_features in features.items()})
+        except HTTPException as e:
+            # Features stay in memory, a failed write only costs a refetch after restart
+            print(f'Failed to persist audio features e:{e.detail}')
+            return 0
+
+        self.inserts += inserted
+        return inserted
+
+    def stats(self) -> dict:
+        '''Returns hit/miss counters and current LRU size'''
+
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'inserts': self.inserts,
+            'hit_rate': (self.memory_hits + self.db_hits) / lookups if lookups else 0.0,
+            'size': len(self._lru),
+            'maxsize': self.maxsize,
+        }
+
+
+feature_cache = AudioFeatureCache()
@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import os
+from abc import ABC, abstractmethod
+import numpy as np
+from src.fetch_scheduler import FetchScheduler, FetchStats
+from src.math_utils import FEATURE_COLUMNS
+from src.single_flight import SingleFlight
+
+'''Audio feature providers: bulk get_many(spotify_ids) lookups. LocalFeatureStore answers from a memory mapped dump of
+public audio features with no network, RapidApiProvider fetches per track within the upstream budget for the misses'''
+
+'''Configuration'''
+FEATURE_STORE_DIR = os.getenv('FEATURE_STORE_DIR')  # directory written by the build command below, unset disables the store
+
+ID_COLUMNS = ('spotify_id', 'track_id', 'id')  # first one present in the dump is used
+IDS_FILE = 'ids.npy'
+FEATURES_FILE = 'features.npy'
+
+
+class FeatureProvider(ABC):
+    '''Source of audio features for spotify ids, subclasses without get_many fail when instantiated'''
+
+    name = 'provider'
+
+    @abstractmethod
+    async def get_many(self, spotify_ids: list[str]) -> dict[str, np.ndarray]:
+        '''Returns feature rows for the ids this provider knows, missing ids are left out'''
+
+    def stats(self) -> dict:
+        return {}
+
+
+class LocalFeatureStore(FeatureProvider):
+    '''Sorted fixed width id array and an aligned float32 feature matrix, both memory mapped, so only the pages a lookup
+    touches are read. A lookup is a vectorized binary search and gather'''
+
+    name = 'local'
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.ids = np.load(os.path.join(directory, IDS_FILE), mmap_mode='r')
+        self.features = np.load(os.path.join(directory, FEATURES_FILE), mmap_mode='r')
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def gather(self, spotify_ids: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        '''Returns the positions in spotify_ids that are in the store and their feature rows'''
+
+        if not spotify_ids or not len(self.ids):
+            return np.empty(0, dtype=np.intp), np.empty((0, len(FEATURE_COLUMNS)), dtype=np.float32)
+
+        width = self.ids.dtype.itemsize
+        encoded = [spotify_id.encode() for spotify_id in spotify_ids]
+        query = np.array(encoded, dtype=self.ids.dtype)  # ids longer than the store's width are truncated here
+        fits = np.fromiter((len(spotify_id) <= width for spotify_id in encoded), dtype=bool, count=len(encoded))
+
+        rows = np.minimum(np.searchsorted(self.ids, query), len(self.ids) - 1)
+        positions = np.flatnonzero((self.ids[rows] == query) & fits)
+        return positions, np.asarray(self.features[rows[positions]])
+
+    async def get_many(self, spotify_ids: list[str]) -> dict[str, np.ndarray]:
+        positions, rows = self.gather(spotify_ids)
+        self.hits += len(positions)
+        self.misses += len(spotify_ids) - len(positions)
+        return dict(zip((spotify_ids[position] for position in positions), rows))
+
+    def stats(self) -> dict:
+        return {'tracks': len(self.ids), 'hits': self.hits, 'misses': self.misses}
+
+
+class RapidApiProvider(FeatureProvider):
+    '''One RapidAPI call per track through the fetch scheduler. Concurrent lookups of the same id share one call,
+    popular tracks are in many users' top lists at once'''
+
+    name = 'rapid_api'
+
+    def __init__(self, fetch_fn, scheduler: FetchScheduler):
+        self.fetch_fn = fetch_fn
+        self.scheduler = scheduler
+        self.flights = SingleFlight()
+
+    async def get_many(self, spotify_ids: list[str], stats: FetchStats | None = None, on_done=None) -> dict[str, np.ndarray]:
+        '''stats collects the scheduler statistics, on_done(spotify_id, feature row or None) is called as each id resolves'''
+
+        stats = stats if stats is not None else FetchStats()
+
+        async def fetch(spotify_id: str) -> np.ndarray | None:
+            # Outside the scheduler, so a waiter on another request's call uses none of the budget
+            features = await self.flights.run(spotify_id, self.scheduler.run, self.fetch_fn, spotify_id, stats=stats)
+            if on_done is not None:
+                on_done(spotify_id, features)
+            return features
+
+        results = await asyncio.gather(*(fetch(spotify_id) for spotify_id in spotify_ids))
+        return {spotify_id: features for spotify_id, features in zip(spotify_ids, results) if features is not None}
+
+    def stats(self) -> dict:
+        return self.flights.stats()
+
+
+def open_local_store(directory: str | None = FEATURE_STORE_DIR) -> LocalFeatureStore | None:
+    '''Returns the local store in directory, or None when unset or not built yet'''
+
+    if not directory:
+        return None
+    if not os.path.exists(os.path.join(directory, IDS_FILE)):
+        print(f'Local feature store {directory} not found, audio features come from RapidAPI only')
+        return None
+    store = LocalFeatureStore(directory)
+    print(f'Local feature store: {len(store)} tracks from {directory}')
+    return store
+
+
+def build_store(source: str, directory: str) -> int:
+    '''Writes a local store from a CSV or Parquet dump with an id column and the feature columns. Returns the track count'''
+
+    import pandas as pd
+
+    if source.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit('Reading Parquet needs pyarrow: pip install pyarrow')
+        columns = pq.read_schema(source).names
+    else:
+        columns = pd.read_csv(source, nrows=0).columns.tolist()
+
+    id_column = next((column for column in ID_COLUMNS if column in columns), None)
+    missing = [column for column in FEATURE_COLUMNS if column not in columns]
+    if id_column is None or missing:
+        raise SystemExit(f'{source} needs one of {ID_COLUMNS} and {FEATURE_COLUMNS}, missing {missing or ID_COLUMNS}')
+
+    usecols = [id_column, *FEATURE_COLUMNS]
+    if source.endswith('.parquet'):
+        frame = pd.read_parquet(source, columns=usecols)
+    else:
+        frame = pd.read_csv(source, usecols=usecols, dtype={id_column: str})
+
+    # Dumps often repeat a track across albums and playlists, keep the last row per id
+    frame = frame.dropna().drop_duplicates(subset=id_column, keep='last').sort_values(id_column)
+    ids = frame[id_column].str.encode('ascii').to_numpy().astype(bytes)
+    features = frame[list(FEATURE_COLUMNS)].to_numpy(dtype=np.float32)
+
+    # Written under temporary names and renamed, a running server keeps reading the previous files
+    os.makedirs(directory, exist_ok=True)
+    for name, array in ((IDS_FILE, ids), (FEATURES_FILE, np.ascontiguousarray(features))):
+        tmp_path = os.path.join(directory, f'{name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as file:
+            np.save(file, array)
+        os.replace(tmp_path, os.path.join(directory, name))
+
+    return len(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds the local audio feature store from a CSV or Parquet dump')
+    parser.add_argument('source', help='CSV or Parquet file with an id column and the audio feature columns')
+    parser.add_argument('--out', default=FEATURE_STORE_DIR or 'feature_store', help='store directory, FEATURE_STORE_DIR by default')
+    args = parser.parse_args()
+
+    count = build_store(args.source, args.out)
+    print(f'Local feature store: wrote {count} tracks to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
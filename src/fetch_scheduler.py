@@ -0,0 +1,274 @@
+import asyncio
+import os
+import random
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import httpx
+from src import metrics
+
+'''Fetch scheduler that owns an upstream budget: token bucket, bounded concurrency, 429 aware retries with jitter'''
+
+'''Configuration'''
+UPSTREAM_RATE = float(os.getenv('UPSTREAM_RATE', 5))  # tokens per second
+UPSTREAM_BURST = float(os.getenv('UPSTREAM_BURST', 5))  # bucket capacity
+UPSTREAM_CONCURRENCY = int(os.getenv('UPSTREAM_CONCURRENCY', 5))
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', 3))
+UPSTREAM_BASE_BACKOFF = float(os.getenv('UPSTREAM_BASE_BACKOFF', 0.5))
+UPSTREAM_MAX_BACKOFF = float(os.getenv('UPSTREAM_MAX_BACKOFF', 10))
+SPOTIFY_RATE = float(os.getenv('SPOTIFY_RATE', 10))
+SPOTIFY_CONCURRENCY = int(os.getenv('SPOTIFY_CONCURRENCY', 8))
+REDIS_URL = os.getenv('REDIS_URL')
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class FetchStats:
+    '''Per request scheduler statistics'''
+
+    queued: int = 0
+    succeeded: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    dropped: int = 0
+    rejected: int = 0  # dropped after a permanent error (non retryable status, invalid payload), a refetch fails the same way
+    queue_time: float = 0.0
+    max_queue_time: float = 0.0
+
+    def record_wait(self, waited: float):
+        self.queue_time += waited
+        self.max_queue_time = max(self.max_queue_time, waited)
+
+    def merge(self, other: 'FetchStats'):
+        '''Adds another request's statistics, e.g. one batch of a batched fetch'''
+
+        for name in ('queued', 'succeeded', 'retries', 'rate_limited', 'dropped', 'rejected', 'queue_time'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.max_queue_time = max(self.max_queue_time, other.max_queue_time)
+
+    def as_dict(self) -> dict:
+        stats = asdict(self)
+        stats['mean_queue_time'] = self.queue_time / self.queued if self.queued else 0.0
+        return stats
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    '''Returns Retry-After header value in seconds, accepts delta seconds or an HTTP date'''
+
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    '''In-process token bucket, the budget holds per worker process'''
+
+    def __init__(self, rate: float = UPSTREAM_RATE, capacity: float = UPSTREAM_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        '''Waits until a token is available and takes it'''
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def pause(self, seconds: float):
+        '''Blocks the bucket for given seconds, used when upstream answers 429'''
+
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+# Takes a token and returns 0, or returns milliseconds to wait. Uses the Redis clock so all workers agree on time
+REDIS_ACQUIRE_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'blocked_until')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+local blocked_until = tonumber(state[3]) or 0
+if now < blocked_until then
+    return blocked_until - now
+end
+tokens = math.min(capacity, tokens + (now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], 60000)
+return wait
+'''
+
+REDIS_PAUSE_SCRIPT = '''
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local blocked_until = now + tonumber(ARGV[1])
+local current = tonumber(redis.call('HGET', KEYS[1], 'blocked_until')) or 0
+if blocked_until > current then
+    redis.call('HSET', KEYS[1], 'blocked_until', tostring(blocked_until))
+end
+redis.call('PEXPIRE', KEYS[1], 60000)
+return 0
+'''
+
+
+class RedisTokenBucket:
+    '''Token bucket shared through Redis, so the upstream budget holds across uvicorn workers'''
+
+    def __init__(self, redis_url: str, key: str, rate: float = UPSTREAM_RATE, capacity: float = UPSTREAM_BURST):
+        import redis.asyncio as redis
+
+        self.rate = rate
+        self.capacity = capacity
+        self.key = f'nebula:bucket:{key}'
+        self._redis = redis.from_url(redis_url)
+        self._acquire = self._redis.register_script(REDIS_ACQUIRE_SCRIPT)
+        self._pause = self._redis.register_script(REDIS_PAUSE_SCRIPT)
+
+    async def acquire(self):
+        '''Waits until a token is available in the shared bucket and takes it'''
+
+        while True:
+            wait_ms = int(await self._acquire(keys=[self.key], args=[self.rate, self.capacity]))
+            if wait_ms <= 0:
+                return
+            await asyncio.sleep(wait_ms / 1000)
+
+    async def pause(self, seconds: float):
+        '''Blocks the shared bucket for given seconds, used when upstream answers 429'''
+
+        await self._pause(keys=[self.key], args=[int(seconds * 1000)])
+
+
+def build_bucket(key: str, rate: float = UPSTREAM_RATE, capacity: float = UPSTREAM_BURST):
+    '''Returns a Redis backed bucket when REDIS_URL is set, otherwise an in-process bucket'''
+
+    if REDIS_URL:
+        return RedisTokenBucket(REDIS_URL, key, rate, capacity)
+    return TokenBucket(rate, capacity)
+
+
+class FetchScheduler:
+    '''Runs upstream calls within a token bucket budget and a concurrency bound, retrying transient failures'''
+
+    def __init__(self, name: str, bucket, max_concurrency: int = UPSTREAM_CONCURRENCY, max_retries: int = UPSTREAM_MAX_RETRIES,
+                 base_backoff: float = UPSTREAM_BASE_BACKOFF, max_backoff: float = UPSTREAM_MAX_BACKOFF):
+        self.name = name
+        self.bucket = bucket
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _backoff(self, attempt: int) -> float:
+        '''Full jitter exponential backoff'''
+
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+
+    async def run(self, fetch, *args, stats: FetchStats | None = None):
+        '''Awaits fetch(*args) within the budget. Returns its result, or None once retries are exhausted'''
+
+        stats = stats if stats is not None else FetchStats()
+        stats.queued += 1
+        reason = None
+
+        for attempt in range(self.max_retries + 1):
+            queued_at = time.monotonic()
+            retry_after = None
+
+            async with self._semaphore:
+                await self.bucket.acquire()
+                waited = time.monotonic() - queued_at
+                stats.record_wait(waited)
+                metrics.upstream_wait.observe(waited, upstream=self.name)
+
+                try:
+                    result = await fetch(*args)
+                    stats.succeeded += 1
+                    return result
+
+                except httpx.HTTPStatusError as e:
+                    status_code = e.response.status_code
+                    reason = str(status_code)
+                    metrics.upstream_failures.inc(upstream=self.name, reason=reason)
+                    if status_code not in RETRYABLE_STATUS_CODES:
+                        stats.rejected += 1
+                        break
+                    retry_after = parse_retry_after(e.response.headers.get('Retry-After'))
+                    if status_code == 429:
+                        stats.rate_limited += 1
+                        metrics.upstream_rate_limited.inc(upstream=self.name)
+                        await self.bucket.pause(retry_after if retry_after is not None else self._backoff(attempt))
+
+                except httpx.TransportError as e:
+                    reason = type(e).__name__
+                    metrics.upstream_failures.inc(upstream=self.name, reason=reason)
+
+                except ValueError:
+                    # Malformed payload, retrying will not help
+                    reason = 'invalid_payload'
+                    metrics.upstream_failures.inc(upstream=self.name, reason=reason)
+                    stats.rejected += 1
+                    break
+
+            if attempt == self.max_retries:
+                break
+
+            stats.retries += 1
+            metrics.upstream_retries.inc(upstream=self.name)
+            delay = retry_after + random.uniform(0, self.base_backoff) if retry_after is not None else self._backoff(attempt)
+            await asyncio.sleep(delay)
+
+        stats.dropped += 1
+        metrics.upstream_dropped.inc(upstream=self.name, reason=reason)
+        return None
+
+    async def map(self, fetch, items: list, on_done=None) -> tuple[list, FetchStats]:
+        '''Runs fetch over items concurrently, returns results in input order (None for dropped) and the request stats.
+        on_done(item, result) is called as each item resolves'''
+
+        stats = FetchStats()
+
+        async def run_item(item):
+            result = await self.run(fetch, item, stats=stats)
+            if on_done is not None:
+                on_done(item, result)
+            return result
+
+        results = await asyncio.gather(*(run_item(item) for item in items))
+        return results, stats
+
+
+rapid_api_scheduler = FetchScheduler('rapid_api', build_bucket('rapid_api'))
+spotify_scheduler = FetchScheduler('spotify', build_bucket('spotify', rate=SPOTIFY_RATE, capacity=SPOTIFY_RATE), max_concurrency=SPOTIFY_CONCURRENCY)
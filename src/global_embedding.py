@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+from src import models, model_store
+from src.database import crud
+
+'''Global embedding: one UMAP + HDBSCAN fit over every track in the audio feature store, so a user's nebula is an
+index lookup and coordinates are comparable between users. Fitted offline by the job below, served by GlobalEmbeddingIndex'''
+
+'''Configuration'''
+GLOBAL_FIT_SIZE = int(os.getenv('GLOBAL_FIT_SIZE', 20000))  # tracks the models are fitted on, the rest are placed
+GLOBAL_MIN_TRACKS = int(os.getenv('GLOBAL_MIN_TRACKS', 200))
+GLOBAL_KEEP_VERSIONS = int(os.getenv('GLOBAL_KEEP_VERSIONS', 2))  # older versions stay readable while workers reload
+GLOBAL_REFRESH_INTERVAL = float(os.getenv('GLOBAL_REFRESH_INTERVAL', 300))  # seconds between checks for a new version
+
+
+def fit_global(feature_matrix: np.ndarray, fit_size: int = GLOBAL_FIT_SIZE):
+    '''Fits the global models on a subsample and places every track. Returns the model state, projection and labels'''
+
+    from src import math_utils
+
+    scaler, reducer, clusterer, projection, labels = math_utils.fit_subsampled(feature_matrix, fit_size, prediction_data=True)
+    state = {'scaler': scaler, 'reducer': reducer, 'clusterer': clusterer}
+    return state, projection, labels
+
+
+async def build_global_embedding(db_session: AsyncSession, fit_size: int = GLOBAL_FIT_SIZE) -> int | None:
+    '''Fits a new version over the audio feature store and stores it. Returns the version, or None if too few tracks'''
+
+    rows = await crud.get_all_audio_features(db_session)
+    if len(rows) < GLOBAL_MIN_TRACKS:
+        print(f'Global embedding: {len(rows)} tracks in the feature store, need {GLOBAL_MIN_TRACKS}')
+        return None
+
+    spotify_ids = [row[0] for row in rows]
+    feature_matrix = np.array([row[1:] for row in rows], dtype=np.float32)
+
+    # CPU bound, keep the event loop free for the database work around it
+    start = time.perf_counter()
+    state, projection, labels = await asyncio.to_thread(fit_global, feature_matrix, fit_size)
+    print(f'Global embedding: fitted {min(fit_size, len(rows))} and placed {len(rows)} tracks in {time.perf_counter() - start:.1f}s')
+
+    model_path = model_store.global_model_path(datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f'))
+    model_store.save_state(model_path, state)
+    version = await crud.create_embedding(db_session, min(fit_size, len(rows)), model_path, spotify_ids, projection, labels)
+
+    for old_path in await crud.delete_old_embeddings(db_session, GLOBAL_KEEP_VERSIONS):
+        try:
+            os.remove(old_path)
+        except FileNotFoundError:
+            pass
+
+    print(f'Global embedding: version {version} stored, {len(set(labels.tolist()) - {-1})} clusters')
+    return version
+
+
+class GlobalEmbeddingIndex:
+    '''In-memory copy of the latest global embedding: spotify id -> row of a float32 coordinate array.
+    Tracks placed after the fit are kept in a small side table until the next version'''
+
+    def __init__(self, refresh_interval: float = GLOBAL_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.version = None
+        self.model_path = None
+        self._rows: dict[str, int] = {}
+        self._coords = np.empty((0, 3), dtype=np.float32)
+        self._clusters = np.empty(0, dtype=np.int32)
+        self._placed: dict[str, tuple[np.ndarray, int]] = {}
+        self._checked_at = -refresh_interval  # the first refresh loads, even within refresh_interval of boot
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.placed = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.version is not None
+
+    async def refresh(self, db_session: AsyncSession, force: bool = False):
+        '''Loads the latest version if it changed. Checks the database at most once per refresh_interval'''
+
+        if not force and time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+
+        async with self._lock:
+            if not force and time.monotonic() - self._checked_at < self.refresh_interval:
+                return
+            self._checked_at = time.monotonic()
+
+            latest = await crud.get_latest_embedding_version(db_session)
+            if latest is None or latest.id == self.version:
+                return
+
+            rows = await crud.get_track_embeddings(db_session, latest.id)
+            self._rows = {row[0]: i for i, row in enumerate(rows)}
+            self._coords = np.array([row[1:4] for row in rows], dtype=np.float32).reshape(-1, 3)
+            self._clusters = np.array([row[4] for row in rows], dtype=np.int32)
+            self._placed = {}
+            self.version = latest.id
+            self.model_path = latest.model_path
+            print(f'Global embedding index: loaded version {self.version} with {len(rows)} tracks')
+
+    def lookup(self, tracks: list[models.Track]) -> tuple[models.Projection, list[models.Track]]:
+        '''Returns the projection of tracks found in the embedding, in input order, and the tracks that are not'''
+
+        found, coords, clusters, missing = [], [], [], []
+        for track in tracks:
+            row = self._rows.get(track.spotify_id)
+            if row is not None:
+                found.append(track)
+                coords.append(self._coords[row])
+                clusters.append(self._clusters[row])
+                continue
+            placed = self._placed.get(track.spotify_id)
+            if placed is not None:
+                found.append(track)
+                coords.append(placed[0])
+                clusters.append(placed[1])
+            else:
+                missing.append(track)
+
+        self.hits += len(found)
+        self.misses += len(missing)
+        projection = models.Projection(
+            spotify_ids=[track.spotify_id for track in found],
+            names=[track.name for track in found],
+            artists=[track.artist for track in found],
+            coords=np.array(coords, dtype=np.float32).reshape(-1, 3),
+            clusters=np.array(clusters, dtype=np.int32)
+        )
+        return projection, missing
+
+    async def add(self, db_session: AsyncSession, version: int, projection: models.Projection):
+        '''Remembers tracks placed into version by global_transform and stores them for other workers'''
+
+        if version != self.version or not len(projection):
+            return
+
+        for spotify_id, coord, cluster in zip(projection.spotify_ids, projection.coords, projection.clusters):
+            self._placed[spotify_id] = (coord, int(cluster))
+        self.placed += len(projection)
+        await crud.insert_track_embeddings(db_session, version, projection.spotify_ids, projection.coords, projection.clusters)
+
+    def stats(self) -> dict:
+        return {'version': self.version or 0, 'tracks': len(self._rows), 'placed': self.placed,
+                'hits': self.hits, 'misses': self.misses}
+
+
+global_index = GlobalEmbeddingIndex()
+
+
+async def main():
+    from src.database import create_db
+
+    parser = argparse.ArgumentParser(description='Fits a new version of the global embedding over the audio feature store')
+    parser.add_argument('--fit-size', type=int, default=GLOBAL_FIT_SIZE)
+    args = parser.parse_args()
+
+    await create_db.init_db()
+    async with create_db.SessionLocal() as db_session:
+        await build_global_embedding(db_session, args.fit_size)
+    await create_db.engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
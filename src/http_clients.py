@@ -0,0 +1,101 @@
+import os
+import importlib.util
+import time
+import httpx
+from src import metrics
+
+'''Application lifetime pooled HTTP clients, one per upstream, created and closed in the FastAPI lifespan'''
+
+'''Upstream base URLs (overridable to point at a local stub server)'''
+SPOTIFY_ACCOUNTS_URL = os.getenv('SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com')
+SPOTIFY_API_URL = os.getenv('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+RAPID_API_URL = os.getenv('RAPID_API_URL', 'https://track-analysis.p.rapidapi.com')
+
+'''Pool configuration'''
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 20))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS', 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 30))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 10))
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+HTTP2_ENABLED = HTTP2_AVAILABLE and os.getenv('HTTP2_ENABLED', 'true').lower() == 'true'
+
+SPOTIFY_ACCOUNTS = 'spotify_accounts'
+SPOTIFY_API = 'spotify_api'
+RAPID_API = 'rapid_api'
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def metric_hooks(upstream: str) -> dict:
+    '''httpx event hooks counting responses by status code and timing each call to response headers'''
+
+    async def on_request(request: httpx.Request):
+        request.extensions['nebula_started_at'] = time.perf_counter()
+
+    async def on_response(response: httpx.Response):
+        started_at = response.request.extensions.get('nebula_started_at')
+        if started_at is not None:
+            metrics.upstream_latency.observe(time.perf_counter() - started_at, upstream=upstream)
+        metrics.upstream_responses.inc(upstream=upstream, status=response.status_code)
+
+    return {'request': [on_request], 'response': [on_response]}
+
+
+def build_client(upstream: str | None = None,
+                 max_connections: int = HTTP_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry: float = HTTP_KEEPALIVE_EXPIRY,
+                 timeout: float = HTTP_TIMEOUT,
+                 connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                 http2: bool = HTTP2_ENABLED) -> httpx.AsyncClient:
+    '''Returns a pooled async client with keep-alive, timeouts and HTTP/2 when available'''
+
+    limits = httpx.Limits(max_connections=max_connections,
+                          max_keepalive_connections=max_keepalive_connections,
+                          keepalive_expiry=keepalive_expiry)
+    timeouts = httpx.Timeout(timeout, connect=connect_timeout)
+    event_hooks = metric_hooks(upstream) if upstream is not None else None
+    return httpx.AsyncClient(limits=limits, timeout=timeouts, http2=http2, event_hooks=event_hooks)
+
+
+async def start_clients():
+    '''Creates one pooled client per upstream, called on application startup'''
+
+    for name in (SPOTIFY_ACCOUNTS, SPOTIFY_API, RAPID_API):
+        if name not in _clients:
+            _clients[name] = build_client(name)
+
+
+async def close_clients():
+    '''Closes all pooled clients, called on application shutdown'''
+
+    while _clients:
+        _, client = _clients.popitem()
+        await client.aclose()
+
+
+def get_client(name: str) -> httpx.AsyncClient:
+    '''Returns the pooled client for an upstream'''
+
+    client = _clients.get(name)
+    if client is None:
+        raise RuntimeError(f'HTTP client {name} is not started, call start_clients() in the application lifespan')
+    return client
+
+
+def spotify_accounts() -> httpx.AsyncClient:
+    '''Client for accounts.spotify.com (token exchange and refresh)'''
+    return get_client(SPOTIFY_ACCOUNTS)
+
+
+def spotify_api() -> httpx.AsyncClient:
+    '''Client for the Spotify Web API'''
+    return get_client(SPOTIFY_API)
+
+
+def rapid_api() -> httpx.AsyncClient:
+    '''Client for the RapidAPI track analysis endpoint'''
+    return get_client(RAPID_API)
@@ -1,11 +1,49 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from src.routers import spotify
-from src.database.create_db import engine, Base
+from src.routers import spotify, metrics as metrics_router
+from src.database import create_db
+from src import http_clients
+from src import metrics
+from src.pipeline_pool import pipeline_pool
+from src.feature_cache import feature_cache
+from src.result_cache import result_cache
+from src.encoding import encoded_cache
+from src.spatial_index import library_views, spatial_indexes
+from src.global_embedding import global_index
+from src.precompute import PRECOMPUTE_ENABLED
+from src.similarity_index import SIMILARITY_ENABLED, similarity_index
 from fastapi.middleware.cors import CORSMiddleware
 
 '''Main'''
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    '''Creates database tables, shared upstream HTTP clients and the warmed pipeline pool on startup, closes them on shutdown.
+    Runs the precompute scheduler alongside when enabled, and loads or builds the similarity index in the background'''
+    
+    await create_db.init_db()
+    await http_clients.start_clients()
+    await pipeline_pool.start()
+    if PRECOMPUTE_ENABLED:
+        spotify.precompute_scheduler.start()
+    if SIMILARITY_ENABLED:
+        similarity_index.start()
+    loop_lag_task = asyncio.create_task(metrics.monitor_loop_lag()) if metrics.METRICS_ENABLED else None
+    try:
+        yield
+    finally:
+        if loop_lag_task is not None:
+            loop_lag_task.cancel()
+        await spotify.precompute_scheduler.stop()
+        if SIMILARITY_ENABLED:
+            await similarity_index.close()
+        await pipeline_pool.shutdown()
+        await http_clients.close_clients()
+        await create_db.engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -14,10 +52,28 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
-Base.metadata.create_all(bind=engine)
+app.add_middleware(metrics.MetricsMiddleware)
+
+metrics.registry.register_stats('result_cache', result_cache.stats, 'Nebula result cache')
+metrics.registry.register_stats('encoded_cache', encoded_cache.stats, 'Encoded nebula response bodies')
+metrics.registry.register_stats('spatial_indexes', spatial_indexes.stats, 'Nebula spatial indexes')
+metrics.registry.register_stats('library_views', library_views.stats, 'Library nebulas kept for viewport queries')
+metrics.registry.register_stats('feature_cache', feature_cache.stats, 'Audio feature cache')
+metrics.registry.register_stats('pipeline_pool', pipeline_pool.stats, 'Pipeline pool queue and timings')
+metrics.registry.register_stats('token_manager', spotify.token_manager.stats, 'Spotify token cache')
+metrics.registry.register_stats('global_embedding', global_index.stats, 'Global embedding index')
+metrics.registry.register_stats('nebula_flights', spotify.nebula_flights.stats, 'Coalesced nebula builds')
+metrics.registry.register_stats('feature_flights', spotify.rapid_api_provider.stats, 'Coalesced audio feature fetches')
+if spotify.local_feature_store is not None:
+    metrics.registry.register_stats('local_features', spotify.local_feature_store.stats, 'Local audio feature store')
+metrics.registry.register_stats('precompute', spotify.precompute_scheduler.stats, 'Background nebula precomputation')
+metrics.registry.register_stats('similarity_index', similarity_index.stats, 'Track similarity index')
+
 app.include_router(spotify.router)
+app.include_router(metrics_router.router)
 
 
 
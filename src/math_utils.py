@@ -1,99 +1,519 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Literal
 import numpy as np
-import umap
-from kneed import KneeLocator
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import DBSCAN
-from sklearn.neighbors import NearestNeighbors
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
 from . import models 
-from sklearn.preprocessing import StandardScaler  # Standardizes features
-import umap.umap_ as umap  # UMAP for dimensionality reduction
-import hdbscan  # HDBSCAN for clustering
+from . import model_store
+
+# Math-only dependencies (sklearn, umap, hdbscan) are imported inside the functions that use them,
+# so routes like /login never pay for them and workers boot fast
+
+# Persist numba's JIT cache on disk so compiled UMAP/pynndescent kernels survive restarts.
+# Must be set before numba is first imported
+os.environ.setdefault('NUMBA_CACHE_DIR', os.path.abspath(os.getenv('NEBULA_NUMBA_CACHE_DIR', '.numba_cache')))
 
 SEED = 2025
+LARGE_NEBULA_SIZE = int(os.getenv('LARGE_NEBULA_SIZE', 4000))
+LIBRARY_FIT_SIZE = int(os.getenv('LIBRARY_FIT_SIZE', 5000))
 
-### Main Pipline
-### Workflow: Standardize -> Perform KNN / Tune Epsilon -> Apply DBSCAN Clustering -> Project Via TSNE -> Wrap
-def pipline(tracklist: list[models.Track]) -> list[models.Projected_Track]:
-    #1 Build Audio Feature Matrix
-    feature_matrix = np.array([
-        [
-            track.audio_features.acousticness,
-            track.audio_features.danceability,
-            track.audio_features.energy,
-            track.audio_features.instrumentalness,
-            track.audio_features.loudness,
-            track.audio_features.tempo,
-            track.audio_features.speechiness
-        ]
-        for track in tracklist
-    ])
-
-    #2 Create Standardizer
-    scaler = StandardScaler()  # Standardize each feature to mean=0, std=1
-    matrix_scaled = scaler.fit_transform(feature_matrix)  # Apply scaling
-
-    #3 Apply UMAP
-    reducer = umap.UMAP(
-        n_components=3,
-        random_state=SEED)
-    
-    # Create UMAP reducer to 3D space
-    projection = reducer.fit_transform(matrix_scaled)  # Project standardized features into 3D
-
-    #4 Apply HDBSCAN
-    clusterer = hdbscan.HDBSCAN(min_cluster_size=5)  # Create HDBSCAN clusterer, requiring at least 5 points per cluster
-    labels = clusterer.fit_predict(projection)  # Assign cluster labels based on density in 3D UMAP space
-
-    #5 Wrap results
-    projected_tracks = [
-        models.Projected_Track(
-            name=track.name,
-            cluster=label,
-            artist=track.artist,
-            x=coord[0],
-            y=coord[1],
-            z=coord[2]
-        )
-        for track, label, coord in zip(tracklist, labels, projection)
-    ]
-
-    return projected_tracks
-
-
-### Helper function to aquire best epsilon parameter using knee recognizer.
-def get_esp(matrix_scaled:np.ndarray) -> float:
-    k = 8
-    neighbors = NearestNeighbors(n_neighbors=k)
-    neighbors_fit = neighbors.fit(matrix_scaled)
-    distances, _ = neighbors_fit.kneighbors(matrix_scaled)
-    k_distances = distances[:, k-1]
-    k_distances = np.sort(k_distances)
-
-
-    knee = KneeLocator(
-        x=range(len(k_distances)),
-        y=k_distances,
-        curve="convex",
-        direction="increasing"
+# Seeded UMAP runs single threaded. Parallel fits are unseeded and stabilized by align_layout instead.
+# Each pipeline pool worker then uses UMAP_N_JOBS threads, size PIPELINE_WORKERS x UMAP_N_JOBS to the host
+UMAP_PARALLEL = os.getenv('UMAP_PARALLEL', 'false').lower() == 'true'
+UMAP_N_JOBS = int(os.getenv('UMAP_N_JOBS', -1))  # -1 uses every core
+MIN_ALIGN_TRACKS = 10  # shared tracks needed to align to a previous layout, below that the PCA reference is used
+
+FEATURE_COLUMNS = ('acousticness', 'danceability', 'energy', 'instrumentalness', 'loudness', 'tempo', 'speechiness')
+N_FEATURES = len(FEATURE_COLUMNS)
+
+### Stage timer: adds the wall time of a pipline stage to timings[name] when a timings dict is given
+@contextmanager
+def stage(timings: dict | None, name: str):
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+### Parse a RapidAPI track analysis payload straight into a feature row. float64 keeps the values as sent, they are
+### persisted to the feature cache as is
+def parse_rapid_api_features(raw_audio_features: dict) -> np.ndarray:
+    row = np.empty(N_FEATURES, dtype=np.float64)
+    for i, column in enumerate(FEATURE_COLUMNS):
+        value = raw_audio_features.get(column)
+        if column == 'loudness':
+            # Loudness comes back as a string like '-5 dB'
+            value = str(value if value is not None else 0).replace(' dB', '').strip()
+        if value is None:
+            raise ValueError(f'Missing audio feature {column}')
+        row[i] = float(value)
+    return row
+
+
+### Feature row from a mapping with the FEATURE_COLUMNS keys, e.g. a generated feature dict
+def feature_row(features) -> np.ndarray:
+    return np.array([features[column] for column in FEATURE_COLUMNS], dtype=np.float64)
+
+
+### Audio feature matrix, one float32 row per track, stacked from the tracks' feature rows in one call
+def build_feature_matrix(tracklist: list[models.Track]) -> np.ndarray:
+    if not tracklist:
+        return np.empty((0, N_FEATURES), dtype=np.float32)
+    return np.stack([track.audio_features for track in tracklist], dtype=np.float32)
+
+
+### Parameters tuned by dataset size. Small nebulas keep the original settings
+def umap_params(n_tracks: int) -> dict:
+    if n_tracks < LARGE_NEBULA_SIZE:
+        return {}
+    # Approximate kNN via pynndescent, fewer epochs and a lower memory footprint for thousands of tracks
+    return {'force_approximation_algorithm': True, 'low_memory': True, 'n_epochs': 200}
+
+
+def min_cluster_size(n_tracks: int) -> int:
+    # Keep clusters visually meaningful as libraries grow
+    return max(5, n_tracks // 200)
+
+
+### Fit: Standardize -> UMAP to 3D -> HDBSCAN. Returns the fitted models with the projection and labels.
+### parallel drops the seed so UMAP can use n_jobs threads, the layout is then only stable after align_layout
+def fit_models(feature_matrix: np.ndarray, prediction_data: bool = False, timings: dict | None = None,
+               parallel: bool = UMAP_PARALLEL, n_jobs: int = UMAP_N_JOBS):
+    from sklearn.preprocessing import StandardScaler  # Standardizes features
+    import umap.umap_ as umap  # UMAP for dimensionality reduction
+    import hdbscan  # HDBSCAN for clustering
+
+    #1 Create Standardizer
+    with stage(timings, 'scale'):
+        scaler = StandardScaler()  # Standardize each feature to mean=0, std=1
+        matrix_scaled = scaler.fit_transform(feature_matrix)  # Apply scaling
+
+    #2 Apply UMAP
+    with stage(timings, 'umap'):
+        seeding = {'n_jobs': n_jobs} if parallel else {'random_state': SEED}
+        reducer = umap.UMAP(
+            n_components=3,
+            **seeding,
+            **umap_params(len(feature_matrix)))
+        
+        # Create UMAP reducer to 3D space
+        projection = reducer.fit_transform(matrix_scaled)  # Project standardized features into 3D
+
+    #3 Apply HDBSCAN
+    # prediction_data lets approximate_predict place new points later without refitting
+    with stage(timings, 'hdbscan'):
+        clusterer = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size(len(projection)), prediction_data=prediction_data)  # Create HDBSCAN clusterer, requiring at least 5 points per cluster (more for large libraries)
+        labels = clusterer.fit_predict(projection)  # Assign cluster labels based on density in 3D UMAP space
+
+    return scaler, reducer, clusterer, projection, labels
+
+
+### Layout stabilization
+### Unseeded fits differ run to run by rotation, reflection, position and cluster numbering. align_layout returns an
+### alignment onto a reference: the previous layout on the tracks both share (rotation, scale and offset, so unchanged
+### tracks stay put), else a seeded PCA of the same data (rotation only). Cluster ids are matched to the reference's by
+### overlap (Hungarian), unmatched clusters are numbered in order of first appearance. The alignment is stored with
+### the models so tracks placed later land in the same frame
+def procrustes_fit(source: np.ndarray, target: np.ndarray, match_frame: bool = True) -> dict:
+    from scipy.linalg import orthogonal_procrustes
+
+    source_center = source.mean(axis=0)
+    target_center = target.mean(axis=0)
+    centered = source - source_center
+    rotation, singular_sum = orthogonal_procrustes(centered, target - target_center)
+    if not match_frame:
+        return {'center': source_center, 'rotation': rotation, 'scale': 1.0, 'offset': source_center}
+    scale = singular_sum / max(float((centered ** 2).sum()), 1e-12)
+    return {'center': source_center, 'rotation': rotation, 'scale': scale, 'offset': target_center}
+
+
+def match_clusters(labels: np.ndarray, shared_labels: np.ndarray | None = None, reference_labels: np.ndarray | None = None) -> np.ndarray:
+    from scipy.optimize import linear_sum_assignment
+
+    # Clusters in order of first appearance, noise (-1) stays noise
+    unique, first_rows = np.unique(labels, return_index=True)
+    clusters = unique[np.argsort(first_rows)]
+    clusters = clusters[clusters >= 0]
+
+    mapping = {}
+    next_id = 0
+    if reference_labels is not None and len(clusters):
+        reference_clusters = np.unique(reference_labels[reference_labels >= 0])
+        if len(reference_clusters):
+            both = (shared_labels >= 0) & (reference_labels >= 0)
+            overlap = np.zeros((int(labels.max()) + 1, int(reference_clusters.max()) + 1), dtype=np.int64)
+            np.add.at(overlap, (shared_labels[both], reference_labels[both]), 1)
+            rows, columns = linear_sum_assignment(-overlap[clusters][:, reference_clusters])
+            for row, column in zip(rows, columns):
+                if overlap[clusters[row], reference_clusters[column]] > 0:
+                    mapping[int(clusters[row])] = int(reference_clusters[column])
+            next_id = int(reference_clusters.max()) + 1
+
+    for cluster in clusters:
+        if int(cluster) not in mapping:
+            mapping[int(cluster)] = next_id
+            next_id += 1
+
+    # lookup[label + 1] is the new id, so noise maps through index 0
+    lookup = np.full(int(max(labels.max(), -1)) + 2, -1, dtype=np.int32)
+    for cluster, new_id in mapping.items():
+        lookup[cluster + 1] = new_id
+    return lookup
+
+
+# reference: (rows into projection, previous coords of those rows, previous labels of those rows)
+def align_layout(matrix_scaled: np.ndarray, projection: np.ndarray, labels: np.ndarray,
+                 reference: tuple | None = None, timings: dict | None = None) -> dict:
+    with stage(timings, 'align'):
+        if reference is not None and len(reference[0]) >= MIN_ALIGN_TRACKS:
+            rows, reference_coords, reference_labels = reference
+            alignment = procrustes_fit(projection[rows], reference_coords)
+            alignment['cluster_lookup'] = match_clusters(labels, labels[rows], reference_labels)
+        else:
+            from sklearn.decomposition import PCA
+            pca_reference = PCA(n_components=3, random_state=SEED).fit_transform(matrix_scaled)
+            alignment = procrustes_fit(projection, pca_reference, match_frame=False)
+            alignment['cluster_lookup'] = match_clusters(labels)
+    return alignment
+
+
+def apply_alignment(alignment: dict | None, projection: np.ndarray, labels: np.ndarray):
+    if alignment is None:
+        return projection, labels
+    coords = (projection - alignment['center']) @ alignment['rotation'] * alignment['scale'] + alignment['offset']
+    lookup = alignment['cluster_lookup']
+    # Labels the clusterer can predict are all in the lookup, anything else is noise
+    labels = np.asarray(labels)
+    in_lookup = labels + 1 < len(lookup)
+    aligned_labels = np.where(in_lookup, lookup[np.where(in_lookup, labels + 1, 0)], -1)
+    return coords.astype(np.float32), aligned_labels.astype(np.int32)
+
+
+### Wrap projection and labels into a columnar result, track metadata kept in parallel lists
+def wrap(tracklist: list[models.Track], projection: np.ndarray, labels: np.ndarray) -> models.Projection:
+    return models.Projection(
+        spotify_ids=[track.spotify_id for track in tracklist],
+        names=[track.name for track in tracklist],
+        artists=[track.artist for track in tracklist],
+        coords=np.asarray(projection, dtype=np.float32),
+        clusters=np.asarray(labels, dtype=np.int32)
     )
 
-    if knee.knee is None:
-        print("No knee found, using default eps=0.5")
-        return 0.5  # fallback
-    eps = k_distances[knee.knee]
-    print(f"Chosen eps: {eps}")
-    return eps
 
+### Main Pipline
+### Workflow: Build Feature Matrix -> Standardize -> Project Via UMAP -> Apply HDBSCAN Clustering -> Wrap
+def pipline(tracklist: list[models.Track], timings: dict | None = None) -> models.Projection:
+    with stage(timings, 'features'):
+        feature_matrix = build_feature_matrix(tracklist)
+    scaler, _, _, projection, labels = fit_models(feature_matrix, timings=timings)
+    if UMAP_PARALLEL:
+        alignment = align_layout(scaler.transform(feature_matrix), projection, labels, timings=timings)
+        projection, labels = apply_alignment(alignment, projection, labels)
+    with stage(timings, 'wrap'):
+        return wrap(tracklist, projection, labels)
+
+
+### Incremental Pipline
+### Reuses the user's fitted models: known tracks keep their coordinates, new tracks are placed with
+### reducer.transform and hdbscan.approximate_predict. Refits from scratch once drift passes the threshold.
+### With parallel UMAP a refit is aligned to the previous layout, so the nebula does not spin or renumber
+def incremental_pipline(tracklist: list[models.Track], state_path: str,
+                        drift_threshold: float = model_store.MODEL_DRIFT_THRESHOLD, timings: dict | None = None) -> models.Projection:
+    with stage(timings, 'load_state'):
+        state = model_store.load_state(state_path)
+
+    if state is not None:
+        index = state['index']
+        new_positions = [i for i, track in enumerate(tracklist) if track.spotify_id not in index]
+        drift = (state['added_since_fit'] + len(new_positions)) / state['n_fit']
+
+        if drift <= drift_threshold:
+            if new_positions:
+                with stage(timings, 'features'):
+                    new_matrix = build_feature_matrix([tracklist[i] for i in new_positions])
+                new_projection, new_labels = place(state['scaler'], state['reducer'], state['clusterer'], new_matrix, timings)
+                new_projection, new_labels = apply_alignment(state.get('alignment'), new_projection, new_labels)
+
+                # Remember placed tracks so they keep their coordinates next time
+                for offset, i in enumerate(new_positions):
+                    index[tracklist[i].spotify_id] = len(state['labels']) + offset
+                state['projection'] = np.vstack([state['projection'], new_projection])
+                state['labels'] = np.concatenate([state['labels'], new_labels])
+                state['added_since_fit'] += len(new_positions)
+                with stage(timings, 'save_state'):
+                    model_store.save_state(state_path, state)
+
+            rows = [index[track.spotify_id] for track in tracklist]
+            with stage(timings, 'wrap'):
+                return wrap(tracklist, state['projection'][rows], state['labels'][rows])
+
+    with stage(timings, 'features'):
+        feature_matrix = build_feature_matrix(tracklist)
+    scaler, reducer, clusterer, projection, labels = fit_models(feature_matrix, prediction_data=True, timings=timings)
+
+    alignment = None
+    if UMAP_PARALLEL:
+        reference = None
+        if state is not None:
+            shared = [(i, state['index'][track.spotify_id]) for i, track in enumerate(tracklist) if track.spotify_id in state['index']]
+            rows = np.array([i for i, _ in shared], dtype=np.intp)
+            previous_rows = np.array([row for _, row in shared], dtype=np.intp)
+            reference = (rows, state['projection'][previous_rows], state['labels'][previous_rows])
+        alignment = align_layout(scaler.transform(feature_matrix), projection, labels, reference, timings)
+        projection, labels = apply_alignment(alignment, projection, labels)
+
+    with stage(timings, 'save_state'):
+        model_store.save_state(state_path, {
+            'scaler': scaler,
+            'reducer': reducer,
+            'clusterer': clusterer,
+            'alignment': alignment,
+            'projection': projection,
+            'labels': labels,
+            'index': {track.spotify_id: i for i, track in enumerate(tracklist)},
+            'n_fit': len(tracklist),
+            'added_since_fit': 0,
+        })
+
+    with stage(timings, 'wrap'):
+        return wrap(tracklist, projection, labels)
+
+
+### Place new points into fitted models: reducer.transform and hdbscan.approximate_predict
+def place(scaler, reducer, clusterer, feature_matrix: np.ndarray, timings: dict | None = None):
+    import hdbscan
 
+    with stage(timings, 'transform'):
+        projection = reducer.transform(scaler.transform(feature_matrix))
+    with stage(timings, 'predict'):
+        labels, _ = hdbscan.approximate_predict(clusterer, projection)
+    return projection, labels
 
 
+### Subsampled fit: fit on fit_size random rows, place the rest. Below fit_size it is a plain full fit
+def fit_subsampled(feature_matrix: np.ndarray, fit_size: int = LIBRARY_FIT_SIZE, prediction_data: bool = False,
+                   timings: dict | None = None):
+    n_tracks = len(feature_matrix)
 
+    if n_tracks <= fit_size:
+        return fit_models(feature_matrix, prediction_data=prediction_data, timings=timings)
 
+    rng = np.random.default_rng(SEED)
+    fit_rows = np.sort(rng.choice(n_tracks, size=fit_size, replace=False))
+    rest_rows = np.setdiff1d(np.arange(n_tracks), fit_rows, assume_unique=True)
 
+    scaler, reducer, clusterer, fit_projection, fit_labels = fit_models(feature_matrix[fit_rows], prediction_data=True, timings=timings)
 
-    
+    projection = np.empty((n_tracks, 3), dtype=np.float32)
+    labels = np.empty(n_tracks, dtype=np.int32)
+    projection[fit_rows] = fit_projection
+    labels[fit_rows] = fit_labels
+    projection[rest_rows], labels[rest_rows] = place(scaler, reducer, clusterer, feature_matrix[rest_rows], timings)
 
+    return scaler, reducer, clusterer, projection, labels
+
+
+### Library Pipline
+### For thousands of tracks: fit on a random subsample, then place the rest with reducer.transform and
+### hdbscan.approximate_predict. Below fit_size it is a plain full fit
+def library_pipline(tracklist: list[models.Track], fit_size: int = LIBRARY_FIT_SIZE, timings: dict | None = None) -> models.Projection:
+    with stage(timings, 'features'):
+        feature_matrix = build_feature_matrix(tracklist)
+
+    scaler, _, _, projection, labels = fit_subsampled(feature_matrix, fit_size, timings=timings)
+    if UMAP_PARALLEL:
+        alignment = align_layout(scaler.transform(feature_matrix), projection, labels, timings=timings)
+        projection, labels = apply_alignment(alignment, projection, labels)
+
+    with stage(timings, 'wrap'):
+        return wrap(tracklist, projection, labels)
+
+
+### Global Transform
+### Places tracks missing from the shared embedding into the global models (see global_embedding.py).
+### Models are loaded once per worker process and version
+_global_models: dict[str, dict] = {}
+
+def global_transform(tracklist: list[models.Track], model_path: str, timings: dict | None = None) -> models.Projection:
+    state = _global_models.get(model_path)
+    if state is None:
+        with stage(timings, 'load_state'):
+            state = model_store.load_state(model_path)
+        if state is None:
+            raise RuntimeError(f'Global embedding model {model_path} is missing')
+        _global_models.clear()  # only the current version is kept
+        _global_models[model_path] = state
+
+    with stage(timings, 'features'):
+        feature_matrix = build_feature_matrix(tracklist)
+    projection, labels = place(state['scaler'], state['reducer'], state['clusterer'], feature_matrix, timings)
+
+    with stage(timings, 'wrap'):
+        return wrap(tracklist, projection, labels)
+
+
+### Engines: Standardize -> reduce to 3D -> cluster. Each returns (projection, labels) for wrap, so every mode
+### produces the same Projected_Track output. Latencies at 100 / 1000 synthetic tracks, warm, single core
+def scale(feature_matrix: np.ndarray, timings: dict | None = None) -> np.ndarray:
+    from sklearn.preprocessing import StandardScaler
+
+    with stage(timings, 'scale'):
+        return StandardScaler().fit_transform(feature_matrix)
+
+
+def pca_3d(matrix_scaled: np.ndarray, timings: dict | None = None) -> np.ndarray:
+    from sklearn.decomposition import PCA
+
+    with stage(timings, 'pca'):
+        return PCA(n_components=3, random_state=SEED).fit_transform(matrix_scaled)
+
+
+### quality: UMAP + HDBSCAN, the default. ~0.15 s / ~2.5 s, memory grows with UMAP's kNN graph and fuzzy graph
+def quality_engine(feature_matrix: np.ndarray, timings: dict | None = None):
+    scaler, _, _, projection, labels = fit_models(feature_matrix, timings=timings)
+    if UMAP_PARALLEL:
+        alignment = align_layout(scaler.transform(feature_matrix), projection, labels, timings=timings)
+        projection, labels = apply_alignment(alignment, projection, labels)
+    return projection, labels
+
+
+### fast: PCA + MiniBatchKMeans. ~12 ms / ~15 ms, O(n) memory. Every track gets a cluster, no noise label
+def fast_engine(feature_matrix: np.ndarray, timings: dict | None = None):
+    from sklearn.cluster import MiniBatchKMeans
+
+    projection = pca_3d(scale(feature_matrix, timings), timings)
+    # Roughly one cluster per genre sized group, bounded for readable colours
+    n_clusters = int(np.clip(round(np.sqrt(len(projection) / 2)), 2, 12))
+    with stage(timings, 'kmeans'):
+        labels = MiniBatchKMeans(n_clusters=min(n_clusters, len(projection)), random_state=SEED, n_init=3).fit_predict(projection)
+    return projection, labels
+
+
+### density: PCA + DBSCAN with knee-tuned eps. ~6 ms / ~45 ms. One kNN query feeds both eps and the DBSCAN
+### neighbourhood graph, memory is the sparse radius graph
+def density_engine(feature_matrix: np.ndarray, timings: dict | None = None, k: int = 8):
+    from sklearn.neighbors import NearestNeighbors
+    from sklearn.cluster import DBSCAN
+
+    matrix_scaled = scale(feature_matrix, timings)
+    projection = pca_3d(matrix_scaled, timings)
+    with stage(timings, 'dbscan'):
+        neighbors = NearestNeighbors(n_neighbors=min(k, len(matrix_scaled))).fit(matrix_scaled)
+        knn_distances, _ = neighbors.kneighbors(matrix_scaled)
+        eps = get_esp(k=k, knn_distances=knn_distances)
+        graph = neighbors.radius_neighbors_graph(matrix_scaled, radius=eps, mode='distance', sort_results=True)
+        labels = DBSCAN(eps=eps, min_samples=k, metric='precomputed').fit_predict(graph)
+    return projection, labels
+
+
+### tsne: t-SNE (Barnes-Hut) + HDBSCAN. ~1 s / ~17 s, the slowest, O(n) memory, tight local neighbourhoods
+def tsne_engine(feature_matrix: np.ndarray, timings: dict | None = None):
+    from sklearn.manifold import TSNE
+    import hdbscan
+
+    matrix_scaled = scale(feature_matrix, timings)
+    with stage(timings, 'tsne'):
+        perplexity = min(30.0, max(2.0, (len(matrix_scaled) - 1) / 3))
+        projection = TSNE(n_components=3, perplexity=perplexity, init='pca', random_state=SEED).fit_transform(matrix_scaled)
+    with stage(timings, 'hdbscan'):
+        labels = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size(len(projection))).fit_predict(projection)
+    return projection, labels
+
+
+EngineMode = Literal['quality', 'fast', 'density', 'tsne']
+
+ENGINES = {
+    'quality': quality_engine,
+    'fast': fast_engine,
+    'density': density_engine,
+    'tsne': tsne_engine,
+}
+
+
+### Engine Pipline
+### Workflow: Build Feature Matrix -> engine for mode -> Wrap
+def engine_pipline(tracklist: list[models.Track], mode: EngineMode = 'quality', timings: dict | None = None) -> models.Projection:
+    with stage(timings, 'features'):
+        feature_matrix = build_feature_matrix(tracklist)
+    projection, labels = ENGINES[mode](feature_matrix, timings=timings)
+    with stage(timings, 'wrap'):
+        return wrap(tracklist, projection, labels)
+
+
+### Batched Pipline
+### One fit over the union of several track lists (the three time ranges), each list's nebula is sliced out of it,
+### so every list shares one coordinate space and cluster numbering. Tracks in several lists are embedded once
+def batched_pipline(term_tracks: dict[str, list[models.Track]], mode: EngineMode = 'quality', timings: dict | None = None) -> dict[str, models.Projection]:
+    union = {}
+    for tracklist in term_tracks.values():
+        for track in tracklist:
+            union.setdefault(track.spotify_id, track)
+    positions = {spotify_id: position for position, spotify_id in enumerate(union)}
+
+    with stage(timings, 'features'):
+        feature_matrix = build_feature_matrix(list(union.values()))
+    projection, labels = ENGINES[mode](feature_matrix, timings=timings)
+    with stage(timings, 'wrap'):
+        nebula = wrap(list(union.values()), projection, labels)
+        return {term: nebula.take([positions[track.spotify_id] for track in tracklist]) for term, tracklist in term_tracks.items()}
+
+
+### Quick preview layout: Standardize -> PCA to 3D. Runs in milliseconds, rendered while the full pipline runs
+def preview(tracklist: list[models.Track]) -> models.Projection:
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.decomposition import PCA
+
+    if len(tracklist) < 3:
+        return wrap([], np.empty((0, 3)), np.empty(0))
+
+    feature_matrix = build_feature_matrix(tracklist)
+
+    matrix_scaled = StandardScaler().fit_transform(feature_matrix)
+    projection = PCA(n_components=3, random_state=SEED).fit_transform(matrix_scaled)
+
+    # Preview points are unclustered until the full pipline assigns labels
+    return wrap(tracklist, projection, np.full(len(tracklist), -1))
+
+
+### Warm up: runs the pipline once on a small synthetic set so numba JIT compilation happens before the first request
+def warmup(n_tracks: int = 60, parallel: bool = UMAP_PARALLEL):
+    import hdbscan
+
+    # Random features in realistic ranges (loudness in dB, tempo in BPM)
+    rng = np.random.default_rng(SEED)
+    feature_matrix = rng.random((n_tracks, 7)) * [1, 1, 1, 1, -60, 140, 1] + [0, 0, 0, 0, 0, 60, 0]
+
+    # Compile both the fit path and the incremental transform / approximate_predict path
+    scaler, reducer, clusterer, _, _ = fit_models(feature_matrix, prediction_data=True, parallel=parallel)
+    hdbscan.approximate_predict(clusterer, reducer.transform(scaler.transform(feature_matrix[:5])))
+
+
+### Epsilon for DBSCAN: knee of the sorted k-th neighbour distances (Kneedle, vectorized).
+### density_engine passes knn_distances (n x >=k, self included in column 0) from the kNN query it reuses for the
+### DBSCAN graph, so no second neighbour search runs. Without them the search runs here
+def get_esp(matrix_scaled: np.ndarray | None = None, k: int = 8, knn_distances: np.ndarray | None = None) -> float:
+    if knn_distances is None:
+        from sklearn.neighbors import NearestNeighbors
+        knn_distances, _ = NearestNeighbors(n_neighbors=k).fit(matrix_scaled).kneighbors(matrix_scaled)
+
+    k_distances = np.sort(knn_distances[:, min(k, knn_distances.shape[1]) - 1])
+    knee = knee_index(k_distances)
+
+    if knee is None:
+        return 0.5  # fallback
+    return float(k_distances[knee])
 
 
+### Knee of a convex increasing curve: the point furthest below the chord once both axes are scaled to [0, 1]
+def knee_index(values: np.ndarray) -> int | None:
+    if len(values) < 3 or values[-1] <= values[0]:
+        return None
+    x = np.linspace(0.0, 1.0, len(values))
+    y = (values - values[0]) / (values[-1] - values[0])
+    difference = x - y
+    knee = int(np.argmax(difference))
+    return knee if difference[knee] > 0 else None
@@ -0,0 +1,216 @@
+import asyncio
+import contextvars
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+'''Low overhead request metrics: counters, histograms, stats gauges, per request timing spans and Server-Timing'''
+
+'''Configuration'''
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() == 'true'
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.1))  # seconds between event loop lag samples
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _label_text(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Counter:
+    '''Monotonic counter per label set'''
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{_label_text(labels)} {value}' for labels, value in self._values.items()]
+        return lines
+
+
+class Histogram:
+    '''Cumulative bucket histogram per label set, observe is a bisect and two additions'''
+
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._values: dict[tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):  # above the last bound only counts toward +Inf
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def expose(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_label_text(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{self.name}_bucket{_label_text(labels + (("le", "+Inf"),))} {series[-1]}')
+            lines.append(f'{self.name}_sum{_label_text(labels)} {series[-2]}')
+            lines.append(f'{self.name}_count{_label_text(labels)} {series[-1]}')
+        return lines
+
+
+class Registry:
+    '''Holds metrics and stats gauges, renders the Prometheus text format on scrape'''
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram] = {}
+        self._gauges: dict[str, tuple] = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def register_stats(self, prefix: str, stats_fn, help: str):
+        '''Exposes every numeric value of stats_fn() as a gauge named nebula_{prefix}_{key}, read at scrape time'''
+
+        self._gauges[prefix] = (stats_fn, help)
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.expose()
+        for prefix, (stats_fn, help) in self._gauges.items():
+            for key, value in stats_fn().items():
+                if isinstance(value, (int, float)):
+                    name = f'nebula_{prefix}_{key}'
+                    lines += [f'# HELP {name} {help}: {key}', f'# TYPE {name} gauge', f'{name} {float(value)}']
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+'''Metrics'''
+request_duration = registry.histogram('nebula_request_duration_seconds', 'HTTP request latency by route')
+stage_duration = registry.histogram('nebula_stage_duration_seconds', 'Time spent in each request and pipeline stage')
+upstream_responses = registry.counter('nebula_upstream_responses_total', 'Upstream responses by upstream and status code')
+upstream_latency = registry.histogram('nebula_upstream_latency_seconds', 'Upstream time to response headers')
+upstream_failures = registry.counter('nebula_upstream_failures_total', 'Failed upstream attempts by reason: status code, transport error or invalid_payload')
+upstream_retries = registry.counter('nebula_upstream_retries_total', 'Upstream calls retried by the fetch scheduler')
+upstream_dropped = registry.counter('nebula_upstream_dropped_total', 'Upstream calls dropped after retries or a permanent error, by the last failure reason')
+upstream_rate_limited = registry.counter('nebula_upstream_rate_limited_total', 'Upstream 429 responses')
+upstream_wait = registry.histogram('nebula_upstream_wait_seconds', 'Time waiting for the concurrency bound and token bucket')
+library_fetch_deferred = registry.counter('nebula_library_fetch_deferred_total', 'Uncached library tracks left for a later request past LIBRARY_MAX_FETCH')
+global_fallbacks = registry.counter('nebula_global_fallback_total', 'mode=global requests served by a per user fit before the first global embedding')
+event_loop_lag = registry.histogram('nebula_event_loop_lag_seconds', 'Event loop delay past a scheduled wakeup',
+                                    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    '''Sleeps interval in a loop and records how late each wakeup is, i.e. how long callbacks blocked the loop'''
+
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+'''Request spans'''
+_request_spans: contextvars.ContextVar[list | None] = contextvars.ContextVar('request_spans', default=None)
+
+
+def record(name: str, seconds: float):
+    '''Records a finished stage: the stage histogram, and the current request's spans when inside a request'''
+
+    stage_duration.observe(seconds, stage=name)
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((name, seconds))
+
+
+@contextmanager
+def span(name: str):
+    '''Times the enclosed block as stage name'''
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def annotate(name: str, **counts):
+    '''Adds counts to the current request's Server-Timing as name;desc="key=value ...", e.g. per request fetch stats'''
+
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((name, counts))
+
+
+def server_timing(spans: list) -> str:
+    '''Formats spans as a Server-Timing header value, repeated stages and annotations are summed'''
+
+    totals = {}
+    for name, value in spans:
+        if isinstance(value, dict):
+            counts = totals.setdefault(name, {})
+            for key, count in value.items():
+                counts[key] = counts.get(key, 0) + count
+        else:
+            totals[name] = totals.get(name, 0.0) + value
+    return ', '.join(
+        f'{name};desc="{" ".join(f"{key}={count:g}" for key, count in value.items())}"' if isinstance(value, dict)
+        else f'{name};dur={value * 1000:.1f}'
+        for name, value in totals.items()
+    )
+
+
+class MetricsMiddleware:
+    '''ASGI middleware: collects spans per request, observes request latency by route template and
+    adds a Server-Timing header when enabled'''
+
+    def __init__(self, app, server_timing_header: bool = SERVER_TIMING):
+        self.app = app
+        self.server_timing_header = server_timing_header
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        spans = []
+        token = _request_spans.set(spans)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                if self.server_timing_header and spans:
+                    total = time.perf_counter() - start
+                    header = server_timing(spans + [('total', total)])
+                    message['headers'] = [*message.get('headers', []), (b'server-timing', header.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_spans.reset(token)
+            route = scope.get('route')
+            request_duration.observe(time.perf_counter() - start, route=getattr(route, 'path', 'unmatched'),
+                                     method=scope['method'], status=status_code)
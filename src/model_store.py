@@ -0,0 +1,52 @@
+import os
+
+'''On-disk store of each user's fitted nebula models (scaler, UMAP reducer, HDBSCAN clusterer and last layout)'''
+
+MODEL_DIR = os.getenv('NEBULA_MODEL_DIR', 'nebula_models')
+MODEL_DRIFT_THRESHOLD = float(os.getenv('MODEL_DRIFT_THRESHOLD', 0.25))
+INCREMENTAL_PROJECTION = os.getenv('INCREMENTAL_PROJECTION', 'true').lower() == 'true'
+
+
+def state_path(nebula_user_id: int, term: str) -> str:
+    '''Returns the model file path for a user and term'''
+
+    return os.path.join(os.path.abspath(MODEL_DIR), f'{nebula_user_id}_{term}.joblib')
+
+
+def global_model_path(tag: str) -> str:
+    '''Returns the model file path for one fit of the global embedding'''
+
+    return os.path.join(os.path.abspath(MODEL_DIR), 'global', f'{tag}.joblib')
+
+
+def load_state(path: str) -> dict | None:
+    '''Returns the stored model state, or None if missing or unreadable'''
+
+    import joblib
+
+    if not os.path.exists(path):
+        return None
+    try:
+        return joblib.load(path)
+    except Exception as e:
+        # A corrupt or incompatible pickle (e.g. after a umap upgrade) just means a full refit
+        print(f'Discarding unreadable model state {path} e:{e}')
+        return None
+
+
+def save_state(path: str, state: dict):
+    '''Writes the model state atomically, so concurrent readers never see a partial file'''
+
+    import joblib
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    joblib.dump(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def delete_state(nebula_user_id: int, term: str):
+    try:
+        os.remove(state_path(nebula_user_id, term))
+    except FileNotFoundError:
+        pass
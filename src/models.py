@@ -1,24 +1,17 @@
+from dataclasses import dataclass
 from typing import Optional
-from pydantic import BaseModel
+import numpy as np
+from pydantic import BaseModel, ConfigDict
 
-class Audio_Features(BaseModel):
-    '''Pydantic model for track's audio feautres'''
-    
-    acousticness: float
-    danceability: float
-    energy: float
-    instrumentalness: float
-    loudness: float
-    tempo: float
-    speechiness:float
-    
 class Track(BaseModel):
-    '''Pydantic model for track'''
+    '''Pydantic model for track. audio_features is the track's feature row, in math_utils.FEATURE_COLUMNS order'''
+    
+    model_config = ConfigDict(arbitrary_types_allowed=True)
     
     name: str
     artist: list
     spotify_id: str
-    audio_features: Optional[Audio_Features] = None
+    audio_features: Optional[np.ndarray] = None
 
 
 class Projected_Track(BaseModel):
@@ -30,3 +23,63 @@ class Projected_Track(BaseModel):
     x: float
     y: float
     z: float
+
+
+@dataclass
+class Projection:
+    '''Columnar nebula result: track metadata in parallel lists, coordinates and cluster labels as numpy arrays'''
+    
+    spotify_ids: list[str]
+    names: list[str]
+    artists: list[list]
+    coords: np.ndarray  # (n, 3) float32
+    clusters: np.ndarray  # (n,) int32
+    
+    def __len__(self) -> int:
+        return len(self.names)
+    
+    def rows(self) -> list[dict]:
+        '''Returns one dict per track, same shape as Projected_Track'''
+        
+        coords = self.coords.tolist()
+        return [
+            {'name': name, 'cluster': cluster, 'artist': artist, 'x': coord[0], 'y': coord[1], 'z': coord[2]}
+            for name, cluster, artist, coord in zip(self.names, self.clusters.tolist(), self.artists, coords)
+        ]
+    
+    def columns(self) -> dict:
+        '''Returns compact array-of-columns shape'''
+        
+        return {
+            'spotify_id': self.spotify_ids,
+            'name': self.names,
+            'artist': self.artists,
+            'cluster': self.clusters,
+            'x': np.ascontiguousarray(self.coords[:, 0]),
+            'y': np.ascontiguousarray(self.coords[:, 1]),
+            'z': np.ascontiguousarray(self.coords[:, 2]),
+        }
+    
+    def take(self, indices) -> 'Projection':
+        '''Returns the tracks at indices, in that order'''
+        
+        indices = np.asarray(indices, dtype=np.intp)
+        positions = indices.tolist()
+        return Projection(spotify_ids=[self.spotify_ids[index] for index in positions],
+                          names=[self.names[index] for index in positions],
+                          artists=[self.artists[index] for index in positions],
+                          coords=self.coords[indices],
+                          clusters=self.clusters[indices])
+    
+    def to_tracks(self) -> list[Projected_Track]:
+        return [Projected_Track(**row) for row in self.rows()]
+    
+    @classmethod
+    def from_columns(cls, columns: dict) -> 'Projection':
+        '''Inverse of columns(), accepts lists or arrays'''
+        
+        return cls(spotify_ids=list(columns['spotify_id']),
+                   names=list(columns['name']),
+                   artists=list(columns['artist']),
+                   coords=np.column_stack([columns['x'], columns['y'], columns['z']]).astype(np.float32),
+                   clusters=np.asarray(columns['cluster'], dtype=np.int32))
@@ -0,0 +1,143 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fastapi import HTTPException
+from starlette import status
+from src import metrics
+
+'''Runs the CPU bound nebula pipeline off the event loop, in a pool of pre-warmed worker processes'''
+
+'''Configuration'''
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'process')  # process or thread
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+PIPELINE_MAX_QUEUE = int(os.getenv('PIPELINE_MAX_QUEUE', PIPELINE_WORKERS * 4))
+PIPELINE_RETRY_AFTER = int(os.getenv('PIPELINE_RETRY_AFTER', 5))
+PIPELINE_WARMUP = os.getenv('PIPELINE_WARMUP', 'true').lower() == 'true'
+
+
+def _warm_worker(warmup: bool = PIPELINE_WARMUP):
+    '''Worker initializer: runs the pipeline on a synthetic matrix so numba code is compiled (or loaded from the
+    on-disk cache) before the first real job'''
+
+    if not warmup:
+        return
+
+    from src import math_utils
+    start = time.perf_counter()
+    math_utils.warmup()
+    print(f'Pipeline worker {os.getpid()} warmed in {time.perf_counter() - start:.1f}s')
+
+
+def _ready() -> int:
+    '''No-op job used to force worker start up'''
+
+    return os.getpid()
+
+
+def _timed_call(fn, args):
+    '''Runs fn in the worker and returns its result with the compute time and the pipline stage timings'''
+
+    timings = {}
+    start = time.perf_counter()
+    result = fn(*args, timings=timings)
+    return result, time.perf_counter() - start, timings
+
+
+class PipelinePool:
+    '''Bounded executor for pipeline jobs. Rejects with 503 and Retry-After when the queue is full'''
+
+    def __init__(self, mode: str = PIPELINE_MODE, workers: int = PIPELINE_WORKERS, max_queue: int = PIPELINE_MAX_QUEUE,
+                 warmup: bool = PIPELINE_WARMUP):
+        self.mode = mode
+        self.warmup = warmup
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.compute_total = 0.0
+        self.compute_max = 0.0
+
+    async def start(self):
+        '''Creates the executor and waits for every worker to finish warming up'''
+
+        if self._executor is not None:
+            return
+
+        if self.mode == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, initializer=_warm_worker, initargs=(self.warmup,))
+        else:
+            # spawn avoids forking a process that already holds numba/OpenMP threads
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_warm_worker,
+                                                 initargs=(self.warmup,))
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, _ready) for _ in range(self.workers)))
+        print(f'Pipeline pool ready: {self.workers} {self.mode} workers (warmup {self.warmup}) started in {time.perf_counter() - start:.1f}s')
+
+    async def shutdown(self):
+        '''Shuts down the executor, cancelling queued jobs'''
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, fn, *args):
+        '''Runs fn(*args, timings=...) in the pool. Raises 503 with Retry-After when saturated'''
+
+        if self._executor is None:
+            raise RuntimeError('Pipeline pool is not started, call start() in the application lifespan')
+
+        if self.pending >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail='Nebula pipeline is saturated, try again shortly',
+                                headers={'Retry-After': str(PIPELINE_RETRY_AFTER)})
+
+        self.pending += 1
+        submitted_at = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            result, compute_time, timings = await loop.run_in_executor(self._executor, _timed_call, fn, args)
+        finally:
+            self.pending -= 1
+
+        queue_wait = max(0.0, time.perf_counter() - submitted_at - compute_time)
+        self.completed += 1
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        self.compute_total += compute_time
+        self.compute_max = max(self.compute_max, compute_time)
+        metrics.record('pipeline_queue', queue_wait)
+        for name, seconds in timings.items():
+            metrics.record(name, seconds)
+
+        return result
+
+    def stats(self) -> dict:
+        '''Returns queue depth, rejections, and queue wait / compute time totals'''
+
+        return {
+            'mode': self.mode,
+            'warmup': self.warmup,
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'queue_wait_total': self.queue_wait_total,
+            'queue_wait_max': self.queue_wait_max,
+            'compute_total': self.compute_total,
+            'compute_max': self.compute_max,
+        }
+
+
+pipeline_pool = PipelinePool()
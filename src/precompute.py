@@ -0,0 +1,158 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from src.database import create_db, crud
+
+'''Background precomputation: keeps recently active users' nebulas warm in the result cache, so their next
+request is a cache hit. Runs inside the app (PRECOMPUTE_ENABLED=true) or as its own process (python -m src.worker)'''
+
+'''Configuration'''
+PRECOMPUTE_ENABLED = os.getenv('PRECOMPUTE_ENABLED', 'false').lower() == 'true'
+PRECOMPUTE_INTERVAL = float(os.getenv('PRECOMPUTE_INTERVAL', 900))  # seconds between cycles
+PRECOMPUTE_ACTIVE_WINDOW = float(os.getenv('PRECOMPUTE_ACTIVE_WINDOW', 24 * 3600))  # users seen within this many seconds
+PRECOMPUTE_CONCURRENCY = int(os.getenv('PRECOMPUTE_CONCURRENCY', 2))  # nebulas built at once, leaves the pool to live requests
+PRECOMPUTE_MAX_USERS = int(os.getenv('PRECOMPUTE_MAX_USERS', 200))  # per cycle, most recently seen first
+PRECOMPUTE_TERMS = [term for term in os.getenv('PRECOMPUTE_TERMS', 'short_term,medium_term,long_term').split(',') if term]
+PRECOMPUTE_SHUTDOWN_TIMEOUT = float(os.getenv('PRECOMPUTE_SHUTDOWN_TIMEOUT', 30))  # seconds in flight jobs get to finish
+LAST_SEEN_INTERVAL = float(os.getenv('LAST_SEEN_INTERVAL', 300))  # min seconds between last_seen writes per user
+
+
+class LastSeenTracker:
+    '''Records user activity for the scheduler, writes last_seen at most once per interval per user'''
+
+    def __init__(self, interval: float = LAST_SEEN_INTERVAL):
+        self.interval = interval
+        self._written: dict[int, float] = {}
+
+    async def touch(self, nebula_user_id: int):
+        now = time.monotonic()
+        if now - self._written.get(nebula_user_id, -self.interval) < self.interval:
+            return
+        self._written[nebula_user_id] = now
+
+        # Own session, a failed write must not fail the request it came from
+        try:
+            async with create_db.SessionLocal() as db_session:
+                await crud.touch_last_seen(db_session, [nebula_user_id])
+        except HTTPException as e:
+            print(f'Could not record last_seen for user {nebula_user_id}: {e.detail}')
+
+
+last_seen = LastSeenTracker()
+
+
+class PrecomputeScheduler:
+    '''Every interval, builds each term's nebula for users active within the window, most recently seen first.
+    precompute_fn(nebula_user_id, term) does the work, busy_fn() returning True holds back new jobs while live
+    requests need the pipeline pool. stop() lets in flight jobs finish. Jobs that hand their work to shielded tasks
+    (shared builds) pass cancel_fn, awaited after a stop timeout to cancel those too'''
+
+    def __init__(self, precompute_fn, busy_fn=None, cancel_fn=None, interval: float = PRECOMPUTE_INTERVAL,
+                 active_window: float = PRECOMPUTE_ACTIVE_WINDOW, concurrency: int = PRECOMPUTE_CONCURRENCY,
+                 max_users: int = PRECOMPUTE_MAX_USERS, terms: list[str] = PRECOMPUTE_TERMS):
+        self.precompute_fn = precompute_fn
+        self.busy_fn = busy_fn or (lambda: False)
+        self.cancel_fn = cancel_fn
+        self.interval = interval
+        self.active_window = active_window
+        self.concurrency = concurrency
+        self.max_users = max_users
+        self.terms = terms
+        self._stopping = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.cycles = 0
+        self.users = 0
+        self.built = 0
+        self.failed = 0
+        self.skipped_users = 0
+        self.last_cycle_seconds = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        '''Starts the loop on the running event loop'''
+
+        self._stopping.clear()
+        self._task = asyncio.create_task(self.run_forever())
+
+    async def stop(self, timeout: float = PRECOMPUTE_SHUTDOWN_TIMEOUT):
+        '''Stops taking new jobs and waits for in flight ones, cancels them after timeout'''
+
+        self._stopping.set()
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            # Cancelling the loop leaves shielded work running, it must not outlive the pool and engine
+            if self.cancel_fn is not None:
+                await self.cancel_fn()
+            print(f'Precompute: jobs still running after {timeout:.0f}s, cancelled')
+        self._task = None
+
+    async def run_forever(self):
+        while not self._stopping.is_set():
+            try:
+                await self.run_cycle()
+            except Exception as e:
+                print(f'Precompute: cycle failed: {type(e).__name__}: {e}')
+
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def active_users(self) -> list[int]:
+        since = datetime.now(timezone.utc) - timedelta(seconds=self.active_window)
+        async with create_db.SessionLocal() as db_session:
+            rows = await crud.get_active_users(db_session, since, self.max_users)
+        return [nebula_user_id for nebula_user_id, _ in rows]
+
+    async def run_cycle(self):
+        '''One pass over active users. Jobs are taken in last_seen order by concurrency workers'''
+
+        start = time.perf_counter()
+        built, failed = self.built, self.failed
+        user_ids = await self.active_users()
+        jobs = [(nebula_user_id, term) for nebula_user_id in user_ids for term in self.terms]
+        skipped = set()
+
+        async def worker():
+            while jobs and not self._stopping.is_set():
+                # Live requests first: wait while the pipeline pool is saturated
+                if self.busy_fn():
+                    await asyncio.sleep(1)
+                    continue
+
+                nebula_user_id, term = jobs.pop(0)
+                if nebula_user_id in skipped:
+                    continue
+                try:
+                    await self.precompute_fn(nebula_user_id, term)
+                    self.built += 1
+                except HTTPException as e:
+                    self.failed += 1
+                    # Revoked or missing tokens fail every term, skip the user's remaining jobs
+                    if e.status_code == 401:
+                        skipped.add(nebula_user_id)
+                    print(f'Precompute: user {nebula_user_id} {term} failed: {e.detail}')
+                except Exception as e:
+                    self.failed += 1
+                    print(f'Precompute: user {nebula_user_id} {term} failed: {type(e).__name__}: {e}')
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+        self.cycles += 1
+        self.users = len(user_ids)
+        self.skipped_users += len(skipped)
+        self.last_cycle_seconds = time.perf_counter() - start
+        print(f'Precompute: {len(user_ids)} active users, {self.built - built} built, {self.failed - failed} failed, '
+              f'{self.last_cycle_seconds:.1f}s')
+
+    def stats(self) -> dict:
+        return {'running': int(self.running), 'cycles': self.cycles, 'active_users': self.users, 'built': self.built,
+                'failed': self.failed, 'skipped_users': self.skipped_users, 'last_cycle_seconds': self.last_cycle_seconds}
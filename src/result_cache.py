@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from src import models
+from src.encoding import dumps
+
+'''Cache of final nebula results per (nebula user, term), validated against a hash of the ordered top track ids'''
+
+'''Configuration'''
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 6 * 60 * 60))  # seconds
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 2000))
+REDIS_URL = os.getenv('REDIS_URL')
+
+
+def track_ids_hash(tracks: list[models.Track]) -> str:
+    '''Returns a hash of the ordered spotify ids, changes whenever the top tracks change'''
+
+    return hashlib.sha1('\n'.join(track.spotify_id for track in tracks).encode()).hexdigest()
+
+
+def result_key(nebula_user_id: int, term: str) -> str:
+    return f'nebula:result:{nebula_user_id}:{term}'
+
+
+class MemoryResultCache:
+    '''In-process TTL + LRU cache. One entry per (user, term), replaced when the track id hash changes'''
+
+    def __init__(self, ttl: int = RESULT_CACHE_TTL, maxsize: int = RESULT_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, tuple[float, str, models.Projection]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    async def get(self, nebula_user_id: int, term: str, ids_hash: str) -> models.Projection | None:
+        '''Returns cached result if present, unexpired and computed from the same tracks'''
+
+        key = result_key(nebula_user_id, term)
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, cached_hash, projection = entry
+        if expires_at <= time.monotonic() or cached_hash != ids_hash:
+            del self._entries[key]
+            self.stale += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return projection
+
+    async def set(self, nebula_user_id: int, term: str, ids_hash: str, projection: models.Projection):
+        '''Stores result, evicting least recently used entries past maxsize'''
+
+        key = result_key(nebula_user_id, term)
+        self._entries[key] = (time.monotonic() + self.ttl, ids_hash, projection)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def invalidate(self, nebula_user_id: int, term: str):
+        self._entries.pop(result_key(nebula_user_id, term), None)
+
+    def stats(self) -> dict:
+        return {'backend': 'memory', 'hits': self.hits, 'misses': self.misses, 'stale': self.stale,
+                'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+class RedisResultCache:
+    '''Redis backed cache shared across workers. Redis handles TTL, eviction follows the server's maxmemory policy'''
+
+    def __init__(self, redis_url: str, ttl: int = RESULT_CACHE_TTL):
+        import redis.asyncio as redis
+
+        self.ttl = ttl
+        self._redis = redis.from_url(redis_url)
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    async def get(self, nebula_user_id: int, term: str, ids_hash: str) -> models.Projection | None:
+        '''Returns cached result if present and computed from the same tracks'''
+
+        raw = await self._redis.get(result_key(nebula_user_id, term))
+        if raw is None:
+            self.misses += 1
+            return None
+
+        entry = json.loads(raw)
+        if entry['hash'] != ids_hash:
+            self.stale += 1
+            return None
+
+        self.hits += 1
+        return models.Projection.from_columns(entry['columns'])
+
+    async def set(self, nebula_user_id: int, term: str, ids_hash: str, projection: models.Projection):
+        entry = {'hash': ids_hash, 'columns': projection.columns()}
+        await self._redis.set(result_key(nebula_user_id, term), dumps(entry), ex=self.ttl)
+
+    async def invalidate(self, nebula_user_id: int, term: str):
+        await self._redis.delete(result_key(nebula_user_id, term))
+
+    def stats(self) -> dict:
+        return {'backend': 'redis', 'hits': self.hits, 'misses': self.misses, 'stale': self.stale}
+
+
+def build_result_cache():
+    '''Returns a Redis backed cache when REDIS_URL is set, otherwise an in-process cache'''
+
+    if REDIS_URL:
+        return RedisResultCache(REDIS_URL)
+    return MemoryResultCache()
+
+
+result_cache = build_result_cache()
@@ -0,0 +1,14 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from src import metrics
+
+'''Prometheus scrape endpoint. Metrics are per process, scrape each uvicorn worker'''
+
+router = APIRouter(tags={'metrics'})
+
+
+@router.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    '''Returns counters, histograms and cache / queue gauges in the Prometheus text format'''
+
+    return PlainTextResponse(metrics.registry.expose(), media_type='text/plain; version=0.0.4')
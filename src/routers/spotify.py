@@ -3,30 +3,47 @@ import asyncio
 import base64
 import secrets
 import os
-import httpx
 import time
+import numpy as np
 from datetime import datetime, timedelta, timezone
-from typing import Annotated
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Annotated, Literal
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
 from urllib.parse import urlencode
 from dotenv import load_dotenv
 from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
 from src.database import crud, create_db
 from jose import JWTError, jwt
 from starlette import status
 from src import models
-from src import math_utils, plot_utils
-from aiolimiter import AsyncLimiter
+from src import math_utils
+from src.math_utils import EngineMode
+from src.global_embedding import global_index
+from src.encoding import FastJSONResponse, NebulaFormat, dumps, nebula_payload, nebula_response
+from src.feature_cache import feature_cache
+from src.feature_providers import RapidApiProvider, open_local_store
+from src import http_clients
+from src import metrics
+from src.fetch_scheduler import FetchStats, rapid_api_scheduler, spotify_scheduler
+from src.pipeline_pool import pipeline_pool
+from src.precompute import PrecomputeScheduler, last_seen
+from src.result_cache import result_cache, track_ids_hash
+from src.similarity_index import SIMILARITY_ENABLED, similarity_index
+from src.single_flight import SingleFlight
+from src.spatial_index import library_views, spatial_indexes
+from src import model_store
+from src.token_manager import TokenManager
 
 '''Load .env'''
 load_dotenv()
 
 
 '''Constants'''
-SPOTIFY_AUTHORIZE_BASE_URL = 'https://accounts.spotify.com'
-SPOTIFY_CALL_BASE_URL = 'https://api.spotify.com/v1/me'
+SPOTIFY_AUTHORIZE_BASE_URL = http_clients.SPOTIFY_ACCOUNTS_URL
+SPOTIFY_CALL_BASE_URL = f'{http_clients.SPOTIFY_API_URL}/me'
+RAPID_API_BASE_URL = http_clients.RAPID_API_URL
 
 CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
@@ -40,10 +57,25 @@ ALGORITHM = 'HS256'
 RAPID_API_KEY = os.getenv('RAPID_API_KEY')
 RAPID_API_HEADERS = {'x-rapidapi-host': 'track-analysis.p.rapidapi.com', 'x-rapidapi-key': RAPID_API_KEY}
 
-'''API Router, HTTP Bearer and Async Limiter'''
+STREAM_PREVIEW_MIN_TRACKS = 10
+
+TIME_RANGES = ('short_term', 'medium_term', 'long_term')
+
+# Engine modes, plus global: a lookup in the shared embedding (global_embedding.py)
+NebulaMode = Literal['quality', 'fast', 'density', 'tsne', 'global']
+
+LIBRARY_MAX_TRACKS = int(os.getenv('LIBRARY_MAX_TRACKS', 20000))
+LIBRARY_MAX_FETCH = int(os.getenv('LIBRARY_MAX_FETCH', 1000))  # uncached feature lookups per request
+LIBRARY_FETCH_BATCH = int(os.getenv('LIBRARY_FETCH_BATCH', 250))
+LIBRARY_MIN_TRACKS = 20
+
+NEAREST_MAX_K = 500
+SIMILAR_MAX_K = 100
+LOD_MAX_POINTS = int(os.getenv('LOD_MAX_POINTS', 2000))  # default point budget of a level of detail view
+
+'''API Router and HTTP Bearer'''
 router = APIRouter(tags={'spotify'})
 security = HTTPBearer()
-limiter = AsyncLimiter(5, 1)
 
 
 '''Pydantic Models'''
@@ -58,8 +90,7 @@ async def get_user_info(access_token: str):
     '''Returns spotify profile for current user'''
     
     header = {'Authorization': f'Bearer {access_token}'}
-    async with httpx.AsyncClient() as client:
-        response = await client.get(SPOTIFY_CALL_BASE_URL, headers=header)
+    response = await http_clients.spotify_api().get(SPOTIFY_CALL_BASE_URL, headers=header)
         
     return response.json()
 
@@ -96,75 +127,523 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except JWTError: raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user.')
 
 user_dependency = Annotated[dict, Depends(get_current_user)]
+db_dependency = Annotated[AsyncSession, Depends(create_db.get_db)]
 
-async def refresh_tokens(user: user_dependency):
-    '''Refreshes spotify access token and updates SQL database'''
-    
-    db_session = next(create_db.get_db())
-    token_model = crud.get_token(db_session, user.get('nebula_user_id'))
+async def refresh_tokens(refresh_token: str) -> dict:
+    '''Exchanges a spotify refresh token and returns the token response, persisted by the token manager'''
     
     body_parameters = {
         'grant_type': 'refresh_token',
-        'refresh_token': token_model.refresh_token,
+        'refresh_token': refresh_token,
     }
     
-    async with httpx.AsyncClient() as client:
-        token_response = await client.post(f'https://accounts.spotify.com/api/token', data=body_parameters, headers=SPOTIFY_TOKEN_REQUEST_HEADERS)
+    token_response = await http_clients.spotify_accounts().post(f'{SPOTIFY_AUTHORIZE_BASE_URL}/api/token', data=body_parameters, headers=SPOTIFY_TOKEN_REQUEST_HEADERS)
     
-    token_data = token_response.json()
-    new_access_token = token_data.get('access_token')
+    # A rejected token (400 invalid_grant) and an accounts outage (5xx) are told apart by the token manager
+    token_response.raise_for_status()
     
-    if 'refresh_token' in token_data:
-        new_refresh_token = token_data['refresh_token']
-    else:
-        new_refresh_token = token_model.refresh_token
+    return token_response.json()
+
+token_manager = TokenManager(refresh_tokens)
+
+
+async def get_audio_features(spotify_id: str) -> np.ndarray:
+    '''Gets the audio feature row of a track. Raises httpx.HTTPError or ValueError so the scheduler can retry or drop it'''
     
-    crud.update_tokens(db_session, user.get('nebula_user_id'), new_access_token, new_refresh_token)
-    return new_access_token
+    resp = await http_clients.rapid_api().get(f'{RAPID_API_BASE_URL}/pktx/spotify/{spotify_id}', headers=RAPID_API_HEADERS)
+    
+    resp.raise_for_status()
+    
+    return math_utils.parse_rapid_api_features(resp.json())
+
+'''Audio feature providers: the local store when built, RapidAPI for the rest'''
+local_feature_store = open_local_store()
+rapid_api_provider = RapidApiProvider(get_audio_features, rapid_api_scheduler)
 
+'''Coalescing'''
+# Double renders, retries and open tabs share one build per user, term and mode
+nebula_flights = SingleFlight()
 
-async def get_audio_features(track: models.Track):
-    '''Gets audio features for a track and returns track, if track does not exist, returns None'''
+async def get_access_token(user: dict) -> str:
+    '''Returns a valid spotify access token for user, no database query while the cached token is valid'''
     
-    track_id = track.spotify_id
+    with metrics.span('token'):
+        return await token_manager.get_access_token(user.get('nebula_user_id'))
+
+async def get_top_tracks(access_token: str, term: str) -> list[models.Track]:
+    '''Returns user's top 100 tracks for term, without audio features'''
     
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(f'https://track-analysis.p.rapidapi.com/pktx/spotify/{track_id}', headers=RAPID_API_HEADERS, timeout=10)
+    body_parameters = {'time_range': term, 'limit': 50, 'offset': 0}
+    header_parameters = {'Authorization': f'Bearer {access_token}'}
+    url = f'{SPOTIFY_CALL_BASE_URL}/top/tracks'
+
+    client = http_clients.spotify_api()
+    with metrics.span('top_tracks'):
+        response_1 = await client.get(url, params=body_parameters, headers=header_parameters)
+        body_parameters['offset'] = 50
+        response_2 = await client.get(url, params=body_parameters, headers=header_parameters)
+
+    items = response_1.json().get('items', []) + response_2.json().get('items', [])
+
+    return tracks_from_items(items)
+
+def tracks_from_items(items: list[dict]) -> list[models.Track]:
+    '''Builds tracks without audio features from Spotify track objects, skipping local files and duplicates'''
+    
+    tracks = []
+    seen = set()
+
+    for item in items:
+        
+        track_spotify_id = item.get('id') if item else None
+        if track_spotify_id is None or track_spotify_id in seen:
+            continue
+        seen.add(track_spotify_id)
         
-        resp.raise_for_status()
-        raw_audio_features = resp.json()
+        track_name = item.get('name')
+        track_artits = [artist['name'] for artist in item.get('artists', [])]
         
-        track_acousticness = raw_audio_features.get('acousticness')
-        track_danceability = raw_audio_features.get('danceability')
-        track_energy = raw_audio_features.get('energy')
-        track_instrumentalness = raw_audio_features.get('instrumentalness')
-        track_loudness = float(str(raw_audio_features.get('loudness', 0)).replace(' dB', '').strip())
-        track_tempo = raw_audio_features.get('tempo')
-        track_speechiness = raw_audio_features.get('speechiness')
-
-        track.audio_features = models.Audio_Features(acousticness=track_acousticness,
-                                                     danceability=track_danceability,
-                                                     energy=track_energy,
-                                                     instrumentalness=track_instrumentalness,
-                                                     loudness=track_loudness,
-                                                     tempo=track_tempo,
-                                                     speechiness=track_speechiness)
-            
-        print(f'Successful for {track.name}')
-        return track
+        track = models.Track(name=track_name,
+                             artist=track_artits,
+                             spotify_id=track_spotify_id)
         
-    except (httpx.HTTPError, ValueError) as e:
-        print(f'Failed for track {track.name} e:{e}')
-        return None
+        tracks.append(track)
+    
+    return tracks
+
+async def get_paged_items(url: str, access_token: str, page_size: int, max_items: int) -> list[dict]:
+    '''Returns up to max_items items from a paginated Spotify endpoint. The first page gives the total,
+    the remaining pages are fetched concurrently within the Spotify budget'''
+    
+    header_parameters = {'Authorization': f'Bearer {access_token}'}
+    client = http_clients.spotify_api()
+
+    async def get_page(offset: int) -> list[dict]:
+        response = await client.get(url, params={'limit': page_size, 'offset': offset}, headers=header_parameters)
+        response.raise_for_status()
+        return response.json().get('items', [])
+
+    first_page = await client.get(url, params={'limit': page_size, 'offset': 0}, headers=header_parameters)
+    if first_page.status_code != 200:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f'Spotify returned {first_page.status_code} for {url}')
+    
+    first_page_data = first_page.json()
+    total = min(first_page_data.get('total', 0), max_items)
+    
+    # Pages dropped after retries are left out, counted in upstream_dropped
+    pages, _ = await spotify_scheduler.map(get_page, list(range(page_size, total, page_size)))
+    
+    items = list(first_page_data.get('items', []))
+    for page in pages:
+        items.extend(page or [])
+    
+    return items[:max_items]
+
+async def get_library_tracks(access_token: str, source: str, playlist_ids: list[str]) -> list[models.Track]:
+    '''Returns the user's saved tracks or the tracks of given playlists, deduplicated, without audio features'''
+    
+    with metrics.span('library_tracks'):
+        if source == 'saved':
+            items = await get_paged_items(f'{SPOTIFY_CALL_BASE_URL}/tracks', access_token, 50, LIBRARY_MAX_TRACKS)
+        else:
+            playlist_items = await asyncio.gather(*(
+                get_paged_items(f'{http_clients.SPOTIFY_API_URL}/playlists/{playlist_id}/tracks', access_token, 100, LIBRARY_MAX_TRACKS)
+                for playlist_id in playlist_ids
+            ))
+            items = [item for page in playlist_items for item in page]
+    
+    # Saved and playlist items wrap the track object
+    return tracks_from_items([item.get('track') for item in items])[:LIBRARY_MAX_TRACKS]
+
+async def fill_cached_audio_features(db_session: AsyncSession, tracks: list[models.Track]) -> list[models.Track]:
+    '''Fills audio features from the local store and the cache in place and returns the tracks that still need fetching'''
+
+    remaining = tracks
+
+    # Local store first: a vectorized gather, cheaper than the database query behind the cache
+    if local_feature_store is not None:
+        with metrics.span('local_features'):
+            local_features = await local_feature_store.get_many([track.spotify_id for track in remaining])
+        remaining = fill_audio_features(remaining, local_features)
+        if SIMILARITY_ENABLED:
+            similarity_index.add(local_features)
+
+    with metrics.span('feature_cache'):
+        cached_features = await feature_cache.get_many(db_session, [track.spotify_id for track in remaining])
+
+    return fill_audio_features(remaining, cached_features)
+
+def fill_audio_features(tracks: list[models.Track], features: dict[str, np.ndarray]) -> list[models.Track]:
+    '''Sets the feature rows of tracks found in features, returns the others'''
+
+    missing = []
+
+    for track in tracks:
+        if track.spotify_id in features:
+            track.audio_features = features[track.spotify_id]
+        else:
+            missing.append(track)
+
+    return missing
+
+async def fetch_audio_features(db_session: AsyncSession, tracks_to_fetch: list[models.Track], on_done=None,
+                               fetch_stats: FetchStats | None = None) -> list[models.Track]:
+    '''Fetches uncached tracks within the shared RapidAPI budget and stores them in the cache, returns fetched tracks.
+    The request's queued time, retries and drops are collected in fetch_stats and reported in Server-Timing'''
+    
+    fetch_stats = fetch_stats if fetch_stats is not None else FetchStats()
+    
+    with metrics.span('audio_features'):
+        features = await rapid_api_provider.get_many([track.spotify_id for track in tracks_to_fetch], stats=fetch_stats, on_done=on_done)
+    metrics.annotate('rapid_api', queued=fetch_stats.queued, retries=fetch_stats.retries, rate_limited=fetch_stats.rate_limited,
+                     dropped=fetch_stats.dropped, rejected=fetch_stats.rejected, wait_ms=round(fetch_stats.queue_time * 1000))
+
+    # Tracks dropped after retries stay without features
+    fill_audio_features(tracks_to_fetch, features)
+    fetched_tracks = [track for track in tracks_to_fetch if track.spotify_id in features]
+
+    with metrics.span('feature_store'):
+        await feature_cache.put_many(db_session, features)
+    if SIMILARITY_ENABLED:
+        similarity_index.add(features)
+    
+    return fetched_tracks
+
+async def fetch_audio_features_batched(db_session: AsyncSession, tracks_to_fetch: list[models.Track],
+                                       fetch_stats: FetchStats | None = None) -> list[models.Track]:
+    '''Fetches at most LIBRARY_MAX_FETCH uncached tracks in batches, each batch is persisted to the cache as it
+    completes so an interrupted build keeps its progress. The batches' stats are merged into fetch_stats'''
+    
+    if len(tracks_to_fetch) > LIBRARY_MAX_FETCH:
+        metrics.library_fetch_deferred.inc(len(tracks_to_fetch) - LIBRARY_MAX_FETCH)
+    
+    fetched_tracks = []
+    bounded = tracks_to_fetch[:LIBRARY_MAX_FETCH]
+    
+    for start in range(0, len(bounded), LIBRARY_FETCH_BATCH):
+        batch_stats = FetchStats()
+        fetched_tracks += await fetch_audio_features(db_session, bounded[start:start + LIBRARY_FETCH_BATCH], fetch_stats=batch_stats)
+        if fetch_stats is not None:
+            fetch_stats.merge(batch_stats)
+    
+    return fetched_tracks
+
+def fetch_complete(tracks_to_fetch: list[models.Track], fetched_tracks: list[models.Track], fetch_stats: FetchStats) -> bool:
+    '''True when every track left without features was rejected for good upstream (a non retryable status or an
+    invalid payload), so a refetch fails the same way and the result may be cached. Transient drops, tracks deferred
+    past a fetch cap, and tracks whose shared call another request ran keep it uncached'''
+    
+    return len(tracks_to_fetch) - len(fetched_tracks) <= fetch_stats.rejected
+
+def ready_tracks(tracks: list[models.Track]) -> list[models.Track]:
+    '''Returns tracks that have audio features, keeping top tracks order'''
+    
+    return [track for track in tracks if track.audio_features is not None]
+
+async def record_taste(db_session: AsyncSession, nebula_user_id: int, term: str, tracks: list[models.Track]):
+    '''Stores the mean audio features of the user's tracks for term, compared by the user similarity endpoint'''
+    
+    if not tracks:
+        return
+    centroid = math_utils.build_feature_matrix(tracks).mean(axis=0)
+    await crud.upsert_user_taste(db_session, nebula_user_id, term, dict(zip(math_utils.FEATURE_COLUMNS, centroid.tolist())))
+
+async def run_pipeline(nebula_user_id: int, term: str, tracks: list[models.Track], mode: EngineMode = 'quality') -> models.Projection:
+    '''Projects tracks in the pipeline pool with the engine for mode. In quality mode new tracks are placed into the
+    user's stored nebula when possible'''
+    
+    with metrics.span('pipeline'):
+        if mode != 'quality':
+            return await pipeline_pool.run(math_utils.engine_pipline, tracks, mode)
+        if model_store.INCREMENTAL_PROJECTION:
+            return await pipeline_pool.run(math_utils.incremental_pipline, tracks, model_store.state_path(nebula_user_id, term))
+        return await pipeline_pool.run(math_utils.pipline, tracks)
+
+async def get_global_projection(db_session: AsyncSession, tracks: list[models.Track]) -> models.Projection | None:
+    '''Looks tracks up in the global embedding, placing unseen tracks with the global models. None before the first fit'''
+    
+    with metrics.span('global_lookup'):
+        await global_index.refresh(db_session)
+        if not global_index.ready:
+            return None
+        projection, missing = global_index.lookup(tracks)
+    
+    if not missing:
+        return projection
+    
+    # Only tracks new to the embedding need audio features and the models
+    version, model_path = global_index.version, global_index.model_path
+    tracks_to_fetch = await fill_cached_audio_features(db_session, missing)
+    await fetch_audio_features(db_session, tracks_to_fetch)
+    
+    to_place = ready_tracks(missing)
+    if to_place:
+        with metrics.span('pipeline'):
+            placed = await pipeline_pool.run(math_utils.global_transform, to_place, model_path)
+        await global_index.add(db_session, version, placed)
+    
+    with metrics.span('global_lookup'):
+        projection, _ = global_index.lookup(tracks)
+    return projection
+
+async def build_nebula(db_session: AsyncSession, nebula_user_id: int, term: str, top_tracks: list[models.Track],
+                       mode: EngineMode = 'quality') -> models.Projection:
+    '''Returns the cached projection for these top tracks, or fetches missing features, runs the pipeline and caches it'''
+    
+    # Same top tracks as last time, skip feature fetching and the pipeline entirely
+    ids_hash = track_ids_hash(top_tracks)
+    with metrics.span('result_cache'):
+        cached_result = await result_cache.get(nebula_user_id, result_term(term, mode), ids_hash)
+    if cached_result is not None:
+        return cached_result
+    
+    # Fill audio features from cache, only tracks never seen before go out over the network
+    tracks_to_fetch = await fill_cached_audio_features(db_session, top_tracks)
+    fetch_stats = FetchStats()
+    fetched_tracks = await fetch_audio_features(db_session, tracks_to_fetch, fetch_stats=fetch_stats)
+    
+    # Do not pin a nebula with transiently dropped tracks for the whole TTL
+    cacheable = fetch_complete(tracks_to_fetch, fetched_tracks, fetch_stats)
+    return await fit_nebula(db_session, nebula_user_id, term, top_tracks, mode, cacheable)
+
+async def fit_nebula(db_session: AsyncSession, nebula_user_id: int, term: str, top_tracks: list[models.Track],
+                     mode: EngineMode = 'quality', cacheable: bool = True) -> models.Projection:
+    '''Records the taste and projects the top tracks that have audio features, caching the result when cacheable'''
+    
+    tracks = ready_tracks(top_tracks)
+    await record_taste(db_session, nebula_user_id, term, tracks)
+
+    # Process off the event loop
+    processed_tracks = await run_pipeline(nebula_user_id, term, tracks, mode)
+
+    if cacheable:
+        await result_cache.set(nebula_user_id, result_term(term, mode), track_ids_hash(top_tracks), processed_tracks)
+
+    return processed_tracks
+
+async def term_nebula(nebula_user_id: int, term: str, mode: EngineMode = 'quality', top_tracks: list[models.Track] | None = None) -> models.Projection:
+    '''Builds the nebula for term, fetching top tracks unless given. Concurrent calls for the same user, term and mode
+    share one build, which writes through its own session so it outlives any single caller'''
+    
+    async def build() -> models.Projection:
+        tracks = top_tracks
+        if tracks is None:
+            with metrics.span('token'):
+                access_token = await token_manager.get_access_token(nebula_user_id)
+            tracks = await get_top_tracks(access_token, term)
+        async with create_db.SessionLocal() as db_session:
+            return await build_nebula(db_session, nebula_user_id, term, tracks, mode)
+    
+    return await nebula_flights.run((nebula_user_id, term, mode), build)
+
+async def batch_nebulas(nebula_user_id: int, terms: tuple[str, ...], mode: EngineMode = 'quality') -> dict[str, models.Projection]:
+    '''Nebulas for several terms from one pass: the top track lists are fetched concurrently, each distinct track's
+    features are looked up once, and one fit over the union is sliced per term. Cached as a set, since the slices
+    share a coordinate space a change to any list refits all of them'''
+    
+    async def build() -> dict[str, models.Projection]:
+        with metrics.span('token'):
+            access_token = await token_manager.get_access_token(nebula_user_id)
+        term_lists = await asyncio.gather(*(get_top_tracks(access_token, term) for term in terms))
+    
+        ids_hash = '.'.join(track_ids_hash(tracks) for tracks in term_lists)
+        with metrics.span('result_cache'):
+            cached_results = [await result_cache.get(nebula_user_id, batch_term(term, mode), ids_hash) for term in terms]
+        if all(result is not None for result in cached_results):
+            return dict(zip(terms, cached_results))
     
-async def limited_get_audio_features(track):
-    async with limiter:
-        return await get_audio_features(track)
+        # The ranges overlap heavily, features are filled on one Track per spotify id and copied to the others
+        union = {}
+        for tracks in term_lists:
+            for track in tracks:
+                union.setdefault(track.spotify_id, track)
+        async with create_db.SessionLocal() as db_session:
+            tracks_to_fetch = await fill_cached_audio_features(db_session, list(union.values()))
+            fetch_stats = FetchStats()
+            fetched_tracks = await fetch_audio_features(db_session, tracks_to_fetch, fetch_stats=fetch_stats)
+        for tracks in term_lists:
+            for track in tracks:
+                track.audio_features = union[track.spotify_id].audio_features
+    
+        term_tracks = {term: ready_tracks(tracks) for term, tracks in zip(terms, term_lists)}
+        async with create_db.SessionLocal() as db_session:
+            for term, tracks in term_tracks.items():
+                await record_taste(db_session, nebula_user_id, term, tracks)
+        with metrics.span('pipeline'):
+            projections = await pipeline_pool.run(math_utils.batched_pipline, term_tracks, mode)
+    
+        if fetch_complete(tracks_to_fetch, fetched_tracks, fetch_stats):
+            for term, projection in projections.items():
+                await result_cache.set(nebula_user_id, batch_term(term, mode), ids_hash, projection)
+    
+        return projections
+    
+    return await nebula_flights.run((nebula_user_id, 'batch', terms, mode), build)
+
+async def precompute_nebula(nebula_user_id: int, term: str):
+    '''Background job for the precompute scheduler: refreshes the token if needed and builds the quality nebula'''
+    
+    await term_nebula(nebula_user_id, term)
+
+# Holds back while live requests already fill the pipeline pool. Builds are shielded in nebula_flights, a stop that
+# times out cancels them there, shutdown is the only caller
+precompute_scheduler = PrecomputeScheduler(precompute_nebula, busy_fn=lambda: pipeline_pool.pending >= pipeline_pool.workers,
+                                           cancel_fn=nebula_flights.cancel)
+
+def check_term(term: str):
+    '''Rejects terms other than Spotify's time ranges, before any upstream call, model file or cache entry is made for them'''
+    
+    if term not in TIME_RANGES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'term must be one of {", ".join(TIME_RANGES)}')
+
+def result_term(term: str, mode: EngineMode) -> str:
+    '''Result cache term, each mode caches separately'''
+    
+    return term if mode == 'quality' else f'{term}:{mode}'
+
+def batch_term(term: str, mode: EngineMode) -> str:
+    '''Result cache term of a batched slice, kept apart from the term's own fit'''
+    
+    return f'{result_term(term, mode)}:batch'
+
+def ndjson_event(event: str, **data) -> bytes:
+    '''Encodes one NDJSON stream line'''
+    
+    return dumps({'event': event, **data}) + b'\n'
+
+async def resolve_term_nebula(user: dict, db_session: AsyncSession, term: str, mode: NebulaMode = 'quality') -> models.Projection:
+    '''The nebula for term: a lookup in the global embedding for mode=global once it is built, the user's own fit otherwise'''
+    
+    check_term(term)
+    nebula_user_id = user.get('nebula_user_id')
+    await last_seen.touch(nebula_user_id)
+    
+    top_tracks = None
+    if mode == 'global':
+        access_token = await get_access_token(user)
+        top_tracks = await get_top_tracks(access_token, term)
+        global_projection = await get_global_projection(db_session, top_tracks)
+        if global_projection is not None:
+            # Tracks already in the embedding were not looked up, the taste needs their features
+            await fill_cached_audio_features(db_session, [track for track in top_tracks if track.audio_features is None])
+            await record_taste(db_session, nebula_user_id, term, ready_tracks(top_tracks))
+            return global_projection
+        # Not built yet, counted rather than logged per request
+        metrics.global_fallbacks.inc()
+        mode = 'quality'
+    
+    return await term_nebula(nebula_user_id, term, mode, top_tracks)
 
-async def get_task_delayed(track, delay):
-    await asyncio.sleep(delay)
-    return await limited_get_audio_features(track)
+def library_term(source: str, playlist_ids: str | None) -> tuple[str, list[str]]:
+    '''Cache term of a library source, saved or playlists:<sorted ids>, and the playlist id list'''
+    
+    playlist_id_list = [playlist_id for playlist_id in (playlist_ids or '').split(',') if playlist_id]
+    if source == 'playlists' and not playlist_id_list:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='playlist_ids is required for source=playlists')
+    return ('saved' if source == 'saved' else f'playlists:{",".join(sorted(playlist_id_list))}'), playlist_id_list
+
+async def library_nebula(user: dict, db_session: AsyncSession, source: str, playlist_ids: str | None) -> models.Projection:
+    '''The nebula of the user's saved tracks or of comma separated playlist ids, cached like term nebulas'''
+    
+    nebula_user_id = user.get('nebula_user_id')
+    await last_seen.touch(nebula_user_id)
+    
+    cache_term, playlist_id_list = library_term(source, playlist_ids)
+    access_token = await get_access_token(user)
+    library_tracks = await get_library_tracks(access_token, source, playlist_id_list)
+    
+    ids_hash = track_ids_hash(library_tracks)
+    with metrics.span('result_cache'):
+        cached_result = await result_cache.get(nebula_user_id, cache_term, ids_hash)
+    if cached_result is not None:
+        library_views.set((nebula_user_id, cache_term), cached_result)
+        return cached_result
+    
+    tracks_to_fetch = await fill_cached_audio_features(db_session, library_tracks)
+    fetch_stats = FetchStats()
+    fetched_tracks = await fetch_audio_features_batched(db_session, tracks_to_fetch, fetch_stats)
+    
+    tracks = ready_tracks(library_tracks)
+    if len(tracks) < LIBRARY_MIN_TRACKS:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f'Need at least {LIBRARY_MIN_TRACKS} tracks with audio features, found {len(tracks)}')
+    
+    with metrics.span('pipeline'):
+        processed_tracks = await pipeline_pool.run(math_utils.library_pipline, tracks)
+    
+    if fetch_complete(tracks_to_fetch, fetched_tracks, fetch_stats):
+        await result_cache.set(nebula_user_id, cache_term, ids_hash, processed_tracks)
+    library_views.set((nebula_user_id, cache_term), processed_tracks)
+    
+    return processed_tracks
+
+async def library_view(user: dict, db_session: AsyncSession, source: str, playlist_ids: str | None) -> models.Projection:
+    '''The library nebula for viewport queries: the one built or served within VIEW_CACHE_TTL, the library is paged from
+    Spotify again only on a miss. Loading the full nebula refreshes it'''
+    
+    cache_term, _ = library_term(source, playlist_ids)
+    projection = library_views.get((user.get('nebula_user_id'), cache_term))
+    if projection is not None:
+        await last_seen.touch(user.get('nebula_user_id'))
+        return projection
+    return await library_nebula(user, db_session, source, playlist_ids)
+
+def parse_bbox(bbox: str | None) -> tuple[list[float], list[float]] | tuple[None, None]:
+    '''Parses min_x,min_y,min_z,max_x,max_y,max_z into low and high corners, (None, None) when not given'''
+    
+    if not bbox:
+        return None, None
+    try:
+        values = [float(value) for value in bbox.split(',')]
+    except ValueError:
+        values = []
+    if len(values) != 6 or any(high < low for low, high in zip(values[:3], values[3:])):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='bbox must be min_x,min_y,min_z,max_x,max_y,max_z')
+    return values[:3], values[3:]
+
+async def region_response(projection: models.Projection, bbox: str, format: NebulaFormat, request: Request):
+    '''Every track inside the bounding box'''
+    
+    with metrics.span('spatial'):
+        index = await spatial_indexes.get(projection)
+        low, high = parse_bbox(bbox)
+        indices = index.region(low, high)
+    return nebula_response(projection.take(indices), format, request)
+
+async def nearest_response(projection: models.Projection, x: float | None, y: float | None, z: float | None, spotify_id: str | None,
+                           k: int, format: NebulaFormat, request: Request):
+    '''The k tracks nearest a point, or nearest a track of the nebula (itself excluded), nearest first'''
+    
+    if not 1 <= k <= NEAREST_MAX_K:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'k must be between 1 and {NEAREST_MAX_K}')
+    
+    with metrics.span('spatial'):
+        index = await spatial_indexes.get(projection)
+        if spotify_id is not None:
+            if spotify_id not in projection.spotify_ids:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'{spotify_id} is not in this nebula')
+            position = projection.spotify_ids.index(spotify_id)
+            indices, _ = index.nearest(index.coords[position], k + 1)
+            indices = indices[indices != position][:k]
+        elif None in (x, y, z):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='x, y and z or spotify_id is required')
+        else:
+            indices, _ = index.nearest((x, y, z), k)
+    return nebula_response(projection.take(indices), format, request)
+
+async def lod_response(projection: models.Projection, bbox: str | None, max_points: int, format: NebulaFormat):
+    '''Cluster summaries and an evenly spread subset of the tracks in view, every track once the view holds few enough'''
+    
+    if max_points < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='max_points must be positive')
+    
+    with metrics.span('spatial'):
+        index = await spatial_indexes.get(projection)
+        low, high = parse_bbox(bbox)
+        indices, complete = index.level_of_detail(max_points, low, high)
+        clusters = index.clusters_in_view(low, high)
+    with metrics.span('serialize'):
+        return FastJSONResponse({'complete': complete, 'total': len(index), 'clusters': clusters,
+                                 'tracks': nebula_payload(projection.take(indices), format)})
 
 '''API Endpoints'''
 @router.get('/login')
@@ -178,7 +657,7 @@ async def login():
         'response_type': 'code',
         'redirect_uri': REDIRECT_URI,
         'state': state,
-        'scope': 'user-top-read',
+        'scope': 'user-top-read user-library-read playlist-read-private',
         'show_dialog': 'true'
     }
     
@@ -188,7 +667,7 @@ async def login():
     return RedirectResponse(url=auth_url)
 
 @router.get('/callback/', response_model=Token)
-async def callback(code: str):
+async def callback(code: str, db_session: db_dependency):
     '''Creates user, access token, refresh token in SQL database, and returns user info as encoded JWT token'''
     
     body_parameters = {
@@ -197,10 +676,9 @@ async def callback(code: str):
         'redirect_uri': REDIRECT_URI
     }
     
-    async with httpx.AsyncClient() as client:
-        token_data_response = await client.post(f'{SPOTIFY_AUTHORIZE_BASE_URL}/api/token', 
-                                                data=body_parameters, 
-                                                headers=SPOTIFY_TOKEN_REQUEST_HEADERS)
+    token_data_response = await http_clients.spotify_accounts().post(f'{SPOTIFY_AUTHORIZE_BASE_URL}/api/token', 
+                                                                     data=body_parameters, 
+                                                                     headers=SPOTIFY_TOKEN_REQUEST_HEADERS)
     
     token_data = token_data_response.json()
     access_token = token_data.get('access_token')
@@ -210,15 +688,13 @@ async def callback(code: str):
     spotify_user_id = user_info.get('id')
     display_name = user_info.get('display_name')
     
-    db_session = next(create_db.get_db())
-    
     try:
-         user = crud.create_nebula_user(db_session, spotify_user_id, display_name)
+         user = await crud.create_nebula_user(db_session, spotify_user_id, display_name)
     except HTTPException as e:
         return {'message': f'{e}'} 
     
     try: 
-        crud.update_tokens(db_session, user.id, access_token, refresh_token)
+        await token_manager.store(user.id, access_token, refresh_token, token_data.get('expires_in', 3600))
     except HTTPException as e:
         return {'message': f'{e}'} 
     
@@ -229,61 +705,236 @@ async def callback(code: str):
 
 
 @router.get('/nebula/{term}')
-async def get_nebula(user: user_dependency, term: str):
-    '''Parses top 100 tracks from user's Spotify to render Spotify nebula'''
+async def get_nebula(user: user_dependency, db_session: db_dependency, request: Request, term: str, format: NebulaFormat = 'rows',
+                     mode: NebulaMode = 'quality'):
+    '''Parses top 100 tracks from user's Spotify to render Spotify nebula. mode picks the reduction and clustering engine,
+    format=packed returns the binary layout of encoding.pack_projection'''
+    
+    processed_tracks = await resolve_term_nebula(user, db_session, term, mode)
+    
+    return nebula_response(processed_tracks, format, request)
+
 
+@router.get('/nebulas')
+async def get_nebulas(user: user_dependency, terms: str = ','.join(TIME_RANGES), format: Literal['rows', 'columns'] = 'rows',
+                      mode: EngineMode = 'quality'):
+    '''Nebulas for comma separated terms, all three time ranges by default, from one batched pass. Every term's nebula
+    is in the same coordinate space with the same cluster ids'''
+    
+    term_list = tuple(dict.fromkeys(term for term in terms.split(',') if term))
+    if not term_list or any(term not in TIME_RANGES for term in term_list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'terms must be comma separated values of {", ".join(TIME_RANGES)}')
+    
     nebula_user_id = user.get('nebula_user_id')
-    db_session = next(create_db.get_db())
+    await last_seen.touch(nebula_user_id)
+    
+    projections = await batch_nebulas(nebula_user_id, term_list, mode)
+    
+    with metrics.span('serialize'):
+        return FastJSONResponse({term: nebula_payload(projection, format) for term, projection in projections.items()})
+
 
-    if crud.has_expired_token(db_session, nebula_user_id):
-        await refresh_tokens(user)
+@router.get('/nebula/library/{source}')
+async def get_library_nebula(user: user_dependency, db_session: db_dependency, request: Request, source: Literal['saved', 'playlists'], playlist_ids: str | None = None,
+                             format: NebulaFormat = 'rows'):
+    '''Builds a nebula from the user's saved tracks, or from comma separated playlist ids, up to thousands of tracks'''
     
-    token_model = crud.get_token(db_session, nebula_user_id)
-    access_token = token_model.access_token
+    processed_tracks = await library_nebula(user, db_session, source, playlist_ids)
+    
+    return nebula_response(processed_tracks, format, request)
 
-    body_parameters = {'time_range': term, 'limit': 50, 'offset': 0}
-    header_parameters = {'Authorization': f'Bearer {access_token}'}
-    url = f'{SPOTIFY_CALL_BASE_URL}/top/tracks'
 
-    async with httpx.AsyncClient() as client:
-        response_1 = await client.get(url, params=body_parameters, headers=header_parameters)
-        body_parameters['offset'] = 50
-        response_2 = await client.get(url, params=body_parameters, headers=header_parameters)
+@router.get('/nebula/library/{source}/region')
+async def get_library_region(user: user_dependency, db_session: db_dependency, request: Request, source: Literal['saved', 'playlists'],
+                             bbox: str, playlist_ids: str | None = None, format: NebulaFormat = 'rows'):
+    '''Library nebula tracks inside bbox=min_x,min_y,min_z,max_x,max_y,max_z'''
+    
+    projection = await library_view(user, db_session, source, playlist_ids)
+    return await region_response(projection, bbox, format, request)
 
-    items = response_1.json().get('items', []) + response_2.json().get('items', [])
 
-    # Get tracks with no audio features
-    tracks_no_af = []
+@router.get('/nebula/library/{source}/nearest')
+async def get_library_nearest(user: user_dependency, db_session: db_dependency, request: Request, source: Literal['saved', 'playlists'],
+                              playlist_ids: str | None = None, x: float | None = None, y: float | None = None, z: float | None = None,
+                              spotify_id: str | None = None, k: int = 10, format: NebulaFormat = 'rows'):
+    '''The k library nebula tracks nearest (x, y, z) or nearest the track spotify_id'''
+    
+    projection = await library_view(user, db_session, source, playlist_ids)
+    return await nearest_response(projection, x, y, z, spotify_id, k, format, request)
 
-    for item in items:
+
+@router.get('/nebula/library/{source}/lod')
+async def get_library_lod(user: user_dependency, db_session: db_dependency, source: Literal['saved', 'playlists'],
+                          playlist_ids: str | None = None, bbox: str | None = None, max_points: int = LOD_MAX_POINTS,
+                          format: Literal['rows', 'columns'] = 'rows'):
+    '''Level of detail view of the library nebula: cluster centroids plus up to max_points tracks in bbox'''
+    
+    projection = await library_view(user, db_session, source, playlist_ids)
+    return await lod_response(projection, bbox, max_points, format)
+
+
+@router.get('/nebula/{term}/stream')
+async def stream_nebula(user: user_dependency, db_session: db_dependency, term: str, format: NebulaFormat = 'rows',
+                        mode: EngineMode = 'quality'):
+    '''Streams nebula build as NDJSON: fetch progress, an early PCA preview layout, then the final projection'''
+
+    check_term(term)
+    nebula_user_id = user.get('nebula_user_id')
+    await last_seen.touch(nebula_user_id)
+
+    access_token = await get_access_token(user)
+    top_tracks = await get_top_tracks(access_token, term)
+    
+    ids_hash = track_ids_hash(top_tracks)
+    with metrics.span('result_cache'):
+        cached_result = await result_cache.get(nebula_user_id, result_term(term, mode), ids_hash)
+    tracks_to_fetch = [] if cached_result is not None else await fill_cached_audio_features(db_session, top_tracks)
+
+    async def cached_events():
+        yield ndjson_event('tracks', total=len(top_tracks), cached=len(top_tracks))
+        yield ndjson_event('result', tracks=nebula_payload(cached_result, format))
+
+    async def events():
+        total = len(top_tracks)
+        cached = total - len(tracks_to_fetch)
+        yield ndjson_event('tracks', total=total, cached=cached)
         
-        track_name = item.get('name')
-        track_artits = [artist['name'] for artist in item.get('artists', [])]
-        track_spotify_id = item.get('id')
+        # Render cached tracks straight away while the rest are fetched
+        if cached >= STREAM_PREVIEW_MIN_TRACKS and tracks_to_fetch:
+            preview = math_utils.preview(ready_tracks(top_tracks))
+            yield ndjson_event('preview', tracks=nebula_payload(preview, format))
+
+        progress = asyncio.Queue()
+        fetch_stats = FetchStats()
         
-        track = models.Track(name=track_name,
-                             artist=track_artits,
-                             spotify_id=track_spotify_id)
+        async def fetch():
+            # The request session is closed once the response starts, the stream writes through its own
+            try:
+                async with create_db.SessionLocal() as stream_session:
+                    return await fetch_audio_features(stream_session, tracks_to_fetch, fetch_stats=fetch_stats,
+                                                      on_done=lambda spotify_id, result: progress.put_nowait(result is not None))
+            finally:
+                progress.put_nowait(None)
+
+        fetch_task = asyncio.create_task(fetch())
+        
+        try:
+            resolved, dropped = 0, 0
+            while (succeeded := await progress.get()) is not None:
+                resolved += 1
+                dropped += not succeeded
+                yield ndjson_event('progress', resolved=cached + resolved, dropped=dropped, total=total)
+            fetched_tracks = await fetch_task
+        finally:
+            # Client went away mid-stream
+            fetch_task.cancel()
+        # Headers went out before the fetch, its stats are reported in band
+        yield ndjson_event('fetch_stats', **fetch_stats.as_dict())
+
+        if tracks_to_fetch:
+            preview = math_utils.preview(ready_tracks(top_tracks))
+            yield ndjson_event('preview', tracks=nebula_payload(preview, format))
+
+        cacheable = fetch_complete(tracks_to_fetch, fetched_tracks, fetch_stats)
+
+        async def fit() -> models.Projection:
+            # A GET for the same nebula may have finished while this stream was fetching
+            cached_result = await result_cache.get(nebula_user_id, result_term(term, mode), ids_hash)
+            if cached_result is not None:
+                return cached_result
+            async with create_db.SessionLocal() as stream_session:
+                return await fit_nebula(stream_session, nebula_user_id, term, top_tracks, mode, cacheable)
+
+        try:
+            # Shares the fit with a GET building the same nebula, so both do not write the model state file
+            processed_tracks = await nebula_flights.run((nebula_user_id, term, mode), fit)
+        except HTTPException as e:
+            # Headers are already sent, report saturation in band
+            yield ndjson_event('error', status=e.status_code, detail=e.detail, retry_after=(e.headers or {}).get('Retry-After'))
+            return
         
-        tracks_no_af.append(track)
+        yield ndjson_event('result', tracks=nebula_payload(processed_tracks, format))
+
+    if cached_result is not None:
+        return StreamingResponse(cached_events(), media_type='application/x-ndjson')
+    return StreamingResponse(events(), media_type='application/x-ndjson')
+
+
+@router.get('/tracks/{spotify_id}/similar')
+async def get_similar_tracks(user: user_dependency, db_session: db_dependency, spotify_id: str, k: int = 10):
+    '''The k tracks whose audio features are nearest the track's, from every track seen, nearest first'''
+    
+    if not SIMILARITY_ENABLED:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Similarity search is disabled')
+    if not 1 <= k <= SIMILAR_MAX_K:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'k must be between 1 and {SIMILAR_MAX_K}')
     
-    # Get all get_audio_feature coroutines for all tracks
-    tasks = []
+    await similarity_index.refresh()
+    with metrics.span('similarity'):
+        vector = similarity_index.vector_of(spotify_id)
+        if vector is None:
+            # Known to the feature cache but not indexed yet, e.g. before the first build finishes
+            cached_features = await feature_cache.get_many(db_session, [spotify_id])
+            if spotify_id not in cached_features:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'No audio features for {spotify_id}')
+            vector = similarity_index.scale(cached_features[spotify_id])
+        neighbours = similarity_index.query(vector, k, exclude=spotify_id)
     
-    for i, track in enumerate(tracks_no_af):
-        task = get_task_delayed(track, i * 0.15)
-        tasks.append(task)
+    return [{'spotify_id': neighbour_id, 'distance': distance} for neighbour_id, distance in neighbours]
 
-    # Run all tasks concurrently with limit
-    tracks_ready = await asyncio.gather(*tasks)
 
-    # ilter out any None results
-    tracks = []
-    for track in tracks_ready:
-        if track is not None:
-            tracks.append(track)
+@router.get('/users/similar')
+async def get_similar_users(user: user_dependency, db_session: db_dependency, term: str = 'medium_term', k: int = 10):
+    '''The k users whose taste for term, the mean audio features of their top tracks, is nearest the caller's'''
+    
+    check_term(term)
+    if not 1 <= k <= SIMILAR_MAX_K:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'k must be between 1 and {SIMILAR_MAX_K}')
+    
+    nebula_user_id = user.get('nebula_user_id')
+    with metrics.span('similarity'):
+        tastes = await crud.get_user_tastes(db_session, term)
+        user_ids = [row[0] for row in tastes]
+        if nebula_user_id not in user_ids:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'No taste for {term} yet, build its nebula first')
+    
+        # Standardized over the users' own tastes, so tempo and loudness do not outweigh the unit range features.
+        # The exact scan is intentional: one row per user, about 15 ms at 100k users. Past that, index the tastes
+        # like the tracks in similarity_index
+        vectors = np.array([row[2:] for row in tastes], dtype=np.float32)
+        std = vectors.std(axis=0)
+        vectors = (vectors - vectors.mean(axis=0)) / np.where(std > 0, std, 1.0)
+        distances = np.linalg.norm(vectors - vectors[user_ids.index(nebula_user_id)], axis=1)
+        candidates = np.argpartition(distances, min(k, len(distances) - 1))[:k + 1]
+        nearest = [position for position in candidates[np.argsort(distances[candidates])].tolist() if user_ids[position] != nebula_user_id][:k]
+    
+    return [{'nebula_user_id': user_ids[position], 'display_name': tastes[position][1], 'distance': float(distances[position])}
+            for position in nearest]
 
-    # Process and visualize
-    processed_tracks = math_utils.pipline(tracks)
 
-    return processed_tracks
+@router.get('/nebula/{term}/region')
+async def get_nebula_region(user: user_dependency, db_session: db_dependency, request: Request, term: str, bbox: str,
+                            format: NebulaFormat = 'rows', mode: NebulaMode = 'quality'):
+    '''Tracks of the term nebula inside bbox=min_x,min_y,min_z,max_x,max_y,max_z'''
+    
+    projection = await resolve_term_nebula(user, db_session, term, mode)
+    return await region_response(projection, bbox, format, request)
+
+
+@router.get('/nebula/{term}/nearest')
+async def get_nebula_nearest(user: user_dependency, db_session: db_dependency, request: Request, term: str,
+                             x: float | None = None, y: float | None = None, z: float | None = None, spotify_id: str | None = None,
+                             k: int = 10, format: NebulaFormat = 'rows', mode: NebulaMode = 'quality'):
+    '''The k term nebula tracks nearest (x, y, z) or nearest the track spotify_id'''
+    
+    projection = await resolve_term_nebula(user, db_session, term, mode)
+    return await nearest_response(projection, x, y, z, spotify_id, k, format, request)
+
+
+@router.get('/nebula/{term}/lod')
+async def get_nebula_lod(user: user_dependency, db_session: db_dependency, term: str, bbox: str | None = None,
+                         max_points: int = LOD_MAX_POINTS, format: Literal['rows', 'columns'] = 'rows', mode: NebulaMode = 'quality'):
+    '''Level of detail view of the term nebula: cluster centroids plus up to max_points tracks in bbox'''
+    
+    projection = await resolve_term_nebula(user, db_session, term, mode)
+    return await lod_response(projection, bbox, max_points, format)
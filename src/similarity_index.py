@@ -0,0 +1,342 @@
+import argparse
+import asyncio
+import os
+import pickle
+import shutil
+import time
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.database import crud
+from src.math_utils import N_FEATURES
+
+'''Track similarity: approximate nearest neighbours over the standardized audio features of every track seen.
+A version on disk is a pynndescent search graph plus memory mapped ids and vectors. Tracks seen since the last version
+wait in a buffer that is searched exactly, and are merged into a new version in the background once it fills up'''
+
+'''Configuration'''
+SIMILARITY_ENABLED = os.getenv('SIMILARITY_ENABLED', 'true').lower() == 'true'
+SIMILARITY_INDEX_DIR = os.getenv('SIMILARITY_INDEX_DIR', 'similarity_index')
+SIMILARITY_NEIGHBORS = int(os.getenv('SIMILARITY_NEIGHBORS', 30))  # graph degree, more is slower to build with better recall
+SIMILARITY_EPSILON = float(os.getenv('SIMILARITY_EPSILON', 0.1))  # search breadth, see benchmarks/bench_similarity.py
+SIMILARITY_MERGE_SIZE = int(os.getenv('SIMILARITY_MERGE_SIZE', 5000))  # buffered tracks that trigger a merge
+SIMILARITY_MIN_TRACKS = int(os.getenv('SIMILARITY_MIN_TRACKS', 100))  # smaller sets stay in the exact buffer
+SIMILARITY_REFRESH_INTERVAL = float(os.getenv('SIMILARITY_REFRESH_INTERVAL', 60))  # seconds between checks for another process's version
+SIMILARITY_KEEP_VERSIONS = 2  # older versions stay readable while other processes reload
+
+CURRENT_FILE = 'CURRENT'
+IDS_FILE = 'ids.npy'
+VECTORS_FILE = 'vectors.npy'
+SCALER_FILE = 'scaler.npy'
+GRAPH_FILE = 'graph.pkl'
+
+
+def current_version(directory: str) -> str | None:
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_version(directory: str, version: str) -> dict:
+    '''Loads a version: ids and vectors memory mapped, the search graph unpickled'''
+
+    path = os.path.join(directory, version)
+    with open(os.path.join(path, GRAPH_FILE), 'rb') as file:
+        graph = pickle.load(file)
+    scaler = np.load(os.path.join(path, SCALER_FILE))
+    ids = np.load(os.path.join(path, IDS_FILE), mmap_mode='r')
+    return {'version': version, 'ids': ids, 'vectors': np.load(os.path.join(path, VECTORS_FILE), mmap_mode='r'),
+            'mean': scaler[0], 'std': scaler[1], 'graph': graph, **sorted_lookup(ids)}
+
+
+def sorted_lookup(ids: np.ndarray) -> dict:
+    '''Sorted copy of the ids and their rows, for binary search by spotify id'''
+
+    rows = np.argsort(ids, kind='stable')
+    return {'sorted_ids': np.asarray(ids[rows]), 'sorted_rows': rows}
+
+
+def find_row(state: dict | None, spotify_id: str) -> int | None:
+    '''Row of spotify_id in a version, None when it is not indexed'''
+
+    if state is None or not len(state['ids']):
+        return None
+    sorted_ids = state['sorted_ids']
+    encoded = spotify_id.encode()
+    # Ids wider than the array are truncated in the search key, the comparison below uses the full id
+    position = int(np.searchsorted(sorted_ids, np.array(encoded, dtype=sorted_ids.dtype)))
+    if position < len(sorted_ids) and sorted_ids[position] == encoded:
+        return int(state['sorted_rows'][position])
+    return None
+
+
+def build_version(base: dict | None, spotify_ids: list[str], raw: np.ndarray, n_neighbors: int = SIMILARITY_NEIGHBORS) -> dict:
+    '''New in-memory version: base plus the given tracks. The first version fixes the standardization, later ones
+    insert into a copy of the base graph, so queries on the base keep running meanwhile'''
+
+    from pynndescent import NNDescent
+
+    encoded = np.array([spotify_id.encode() for spotify_id in spotify_ids])
+    if base is None:
+        mean = raw.mean(axis=0)
+        std = raw.std(axis=0)
+        std[std == 0] = 1.0
+        vectors = ((raw - mean) / std).astype(np.float32)
+        graph = NNDescent(vectors, n_neighbors=min(n_neighbors, len(vectors) - 1), low_memory=True)
+        ids = encoded
+    else:
+        mean, std = base['mean'], base['std']
+        fresh = ((raw - mean) / std).astype(np.float32)
+        graph = pickle.loads(pickle.dumps(base['graph']))
+        graph.update(xs_fresh=fresh)
+        vectors = np.concatenate([base['vectors'], fresh])
+        ids = np.concatenate([base['ids'], encoded])
+    graph.prepare()
+    return {'version': None, 'ids': ids, 'vectors': vectors, 'mean': mean, 'std': std, 'graph': graph, **sorted_lookup(ids)}
+
+
+def save_version(directory: str, state: dict) -> str:
+    '''Writes state as a new version directory and points CURRENT at it. Returns the version name'''
+
+    version = f'{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}-{len(state["ids"])}'
+    path = os.path.join(directory, version)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, IDS_FILE), np.asarray(state['ids']))
+    np.save(os.path.join(path, VECTORS_FILE), np.asarray(state['vectors']))
+    np.save(os.path.join(path, SCALER_FILE), np.stack([state['mean'], state['std']]).astype(np.float32))
+    with open(os.path.join(path, GRAPH_FILE), 'wb') as file:
+        pickle.dump(state['graph'], file)
+
+    # Readers go through CURRENT, a rename swaps it atomically
+    tmp_path = os.path.join(directory, f'{CURRENT_FILE}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as file:
+        file.write(version)
+    os.replace(tmp_path, os.path.join(directory, CURRENT_FILE))
+
+    versions = sorted((entry for entry in os.scandir(directory) if entry.is_dir()), key=lambda entry: entry.stat().st_mtime)
+    for entry in versions[:-SIMILARITY_KEEP_VERSIONS]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+    return version
+
+
+class SimilarityIndex:
+    '''The current version plus the buffer of tracks seen since. Each process buffers its own inserts, a merge starts
+    from the newest version on disk so merges from other workers are kept'''
+
+    def __init__(self, directory: str = SIMILARITY_INDEX_DIR, merge_size: int = SIMILARITY_MERGE_SIZE,
+                 epsilon: float = SIMILARITY_EPSILON, refresh_interval: float = SIMILARITY_REFRESH_INTERVAL):
+        self.directory = directory
+        self.merge_size = merge_size
+        self.epsilon = epsilon
+        self.refresh_interval = refresh_interval
+        self.state: dict | None = None
+        self._pending: dict[str, np.ndarray] = {}
+        self._merge_task: asyncio.Task | None = None
+        self._checked_at = -refresh_interval  # the first refresh checks, even within refresh_interval of boot
+        self.queries = 0
+        self.inserts = 0
+        self.merges = 0
+
+    @property
+    def version(self) -> str | None:
+        return self.state['version'] if self.state is not None else None
+
+    def __len__(self) -> int:
+        return (len(self.state['ids']) if self.state is not None else 0) + len(self._pending)
+
+    async def load(self) -> bool:
+        '''Loads the newest version on disk if it is not the one in use. Returns True when it switched'''
+
+        version = current_version(self.directory)
+        if version is None or version == self.version:
+            return False
+        # Unpickling the graph takes a while for large indexes, the swap itself happens on the event loop
+        self.state = await asyncio.to_thread(load_version, self.directory, version)
+        self._pending = {spotify_id: raw for spotify_id, raw in self._pending.items() if self.row_of(spotify_id) is None}
+        print(f'Similarity index: loaded version {version} with {len(self.state["ids"])} tracks')
+        return True
+
+    async def refresh(self):
+        '''Picks up a version written by another process, at most once per refresh_interval'''
+
+        if time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+        self._checked_at = time.monotonic()
+        await self.load()
+
+    def row_of(self, spotify_id: str) -> int | None:
+        return find_row(self.state, spotify_id)
+
+    def scale(self, raw: np.ndarray) -> np.ndarray:
+        '''Standardizes raw feature rows like the indexed vectors. Before the first version, with the buffer's statistics'''
+
+        if self.state is not None:
+            mean, std = self.state['mean'], self.state['std']
+        elif self._pending:
+            buffered = np.stack(list(self._pending.values()))
+            mean, std = buffered.mean(axis=0), buffered.std(axis=0)
+            std[std == 0] = 1.0
+        else:
+            return np.asarray(raw, dtype=np.float32)
+        return ((np.asarray(raw) - mean) / std).astype(np.float32)
+
+    def vector_of(self, spotify_id: str) -> np.ndarray | None:
+        '''Standardized vector of an indexed or buffered track'''
+
+        row = self.row_of(spotify_id)
+        if row is not None:
+            return np.asarray(self.state['vectors'][row])
+        raw = self._pending.get(spotify_id)
+        return self.scale(raw) if raw is not None else None
+
+    def add(self, features: dict[str, np.ndarray]) -> int:
+        '''Buffers tracks not seen before and starts a merge once the buffer is full. Returns the number added'''
+
+        added = 0
+        for spotify_id, track_features in features.items():
+            if spotify_id in self._pending or self.row_of(spotify_id) is not None:
+                continue
+            self._pending[spotify_id] = np.asarray(track_features, dtype=np.float32)
+            added += 1
+        self.inserts += added
+
+        # The first version is built as soon as there are enough tracks for a graph
+        threshold = self.merge_size if self.state is not None else SIMILARITY_MIN_TRACKS
+        if len(self._pending) >= threshold and (self._merge_task is None or self._merge_task.done()):
+            self._merge_task = asyncio.create_task(self.merge())
+        return added
+
+    def query(self, vector: np.ndarray, k: int, exclude: str | None = None) -> list[tuple[str, float]]:
+        '''(spotify id, distance) of the k tracks nearest a standardized vector, nearest first'''
+
+        self.queries += 1
+        candidates = []
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, N_FEATURES)
+
+        if self.state is not None:
+            n_query = min(k + 1, len(self.state['ids']))
+            rows, distances = self.state['graph'].query(vector, k=n_query, epsilon=self.epsilon)
+            candidates += [(self.state['ids'][row].decode(), float(distance)) for row, distance in zip(rows[0], distances[0])]
+
+        # The buffer is small, searched exactly
+        if self._pending:
+            pending_ids = list(self._pending)
+            distances = np.linalg.norm(self.scale(np.stack(list(self._pending.values()))) - vector, axis=1)
+            nearest = np.argsort(distances)[:k + 1]
+            candidates += [(pending_ids[position], float(distances[position])) for position in nearest]
+
+        candidates.sort(key=lambda candidate: candidate[1])
+        return [candidate for candidate in candidates if candidate[0] != exclude][:k]
+
+    async def merge(self):
+        '''Merges the buffer into a new version on disk, off the event loop'''
+
+        snapshot = dict(self._pending)
+        if not snapshot or (self.state is None and len(snapshot) < SIMILARITY_MIN_TRACKS):
+            return
+
+        start = time.perf_counter()
+        state = await asyncio.to_thread(self._merge_snapshot, snapshot)
+        self.state = state
+        self._pending = {spotify_id: raw for spotify_id, raw in self._pending.items() if spotify_id not in snapshot}
+        self.merges += 1
+        print(f'Similarity index: merged {len(snapshot)} tracks into version {state["version"]} '
+              f'({len(state["ids"])} tracks) in {time.perf_counter() - start:.1f}s')
+
+    def _merge_snapshot(self, snapshot: dict[str, np.ndarray]) -> dict:
+        base = self.state
+        version = current_version(self.directory)
+        if version is not None and version != self.version:
+            base = load_version(self.directory, version)
+
+        # Tracks another process merged meanwhile are already in base
+        if base is not None:
+            snapshot = {spotify_id: raw for spotify_id, raw in snapshot.items() if find_row(base, spotify_id) is None}
+        if not snapshot:
+            return base
+
+        state = build_version(base, list(snapshot), np.stack(list(snapshot.values())))
+        os.makedirs(self.directory, exist_ok=True)
+        state['version'] = save_version(self.directory, state)
+        # Serve the saved arrays memory mapped, the graph stays the one just built
+        path = os.path.join(self.directory, state['version'])
+        state['ids'] = np.load(os.path.join(path, IDS_FILE), mmap_mode='r')
+        state['vectors'] = np.load(os.path.join(path, VECTORS_FILE), mmap_mode='r')
+        return state
+
+    async def bootstrap(self, db_session: AsyncSession):
+        '''Loads the newest version, or builds the first one from the audio feature store when there is none'''
+
+        if await self.load() or self.state is not None:
+            return
+        rows = await crud.get_all_audio_features(db_session)
+        for spotify_id, *values in rows:
+            self._pending.setdefault(spotify_id, np.array(values, dtype=np.float32))
+        self.inserts += len(rows)
+        if rows:
+            await self.merge()
+
+    def start(self):
+        '''Bootstraps in the background, a first build over a large feature store takes minutes'''
+
+        from src.database import create_db
+
+        async def run():
+            async with create_db.SessionLocal() as db_session:
+                await self.bootstrap(db_session)
+
+        # Held as the merge task, so inserts meanwhile do not start a second build and close() waits for it
+        self._merge_task = asyncio.create_task(run())
+
+    async def close(self):
+        '''Waits for a running merge and merges what is left, so buffered tracks survive a restart'''
+
+        if self._merge_task is not None:
+            await asyncio.gather(self._merge_task, return_exceptions=True)
+        if self._pending:
+            await self.merge()
+
+    def stats(self) -> dict:
+        return {'tracks': len(self), 'buffered': len(self._pending), 'queries': self.queries,
+                'inserts': self.inserts, 'merges': self.merges}
+
+
+similarity_index = SimilarityIndex()
+
+
+async def main():
+    from src.database import create_db
+    from src.feature_providers import open_local_store
+
+    parser = argparse.ArgumentParser(description='Builds a new similarity index version from the audio feature store')
+    parser.add_argument('--out', default=SIMILARITY_INDEX_DIR, help='index directory, SIMILARITY_INDEX_DIR by default')
+    parser.add_argument('--local-store', help='also index a local feature store directory (feature_providers)')
+    args = parser.parse_args()
+
+    await create_db.init_db()
+    async with create_db.SessionLocal() as db_session:
+        rows = await crud.get_all_audio_features(db_session)
+    await create_db.engine.dispose()
+
+    spotify_ids = [row[0] for row in rows]
+    raw = np.array([row[1:] for row in rows], dtype=np.float32).reshape(-1, N_FEATURES)
+    store = open_local_store(args.local_store) if args.local_store else None
+    if store is not None:
+        known = set(spotify_ids)
+        local = np.array([spotify_id not in known for spotify_id in (raw_id.decode() for raw_id in store.ids)])
+        spotify_ids += [raw_id.decode() for raw_id in np.asarray(store.ids)[local]]
+        raw = np.concatenate([raw, np.asarray(store.features)[local]])
+
+    if len(spotify_ids) < SIMILARITY_MIN_TRACKS:
+        raise SystemExit(f'Similarity index: {len(spotify_ids)} tracks, need {SIMILARITY_MIN_TRACKS}')
+
+    start = time.perf_counter()
+    state = build_version(None, spotify_ids, raw)
+    os.makedirs(args.out, exist_ok=True)
+    version = save_version(args.out, state)
+    print(f'Similarity index: version {version} with {len(spotify_ids)} tracks built in {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
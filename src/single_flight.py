@@ -0,0 +1,46 @@
+import asyncio
+from functools import partial
+
+'''Request coalescing: concurrent calls with the same key share one in flight computation'''
+
+
+class SingleFlight:
+    '''The first caller for a key starts the work as a task, callers arriving while it runs await the same task.
+    Waiters are shielded, so a cancelled caller (client disconnect, timeout) does not abort the work for the others.
+    Nothing is kept after the task finishes, caching results is the caller's job'''
+
+    def __init__(self):
+        self._in_flight: dict = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def run(self, key, fn, *args, **kwargs):
+        '''Returns the result of fn(*args, **kwargs), or of the call already in flight for key'''
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(fn(*args, **kwargs))
+            self._in_flight[key] = task
+            task.add_done_callback(partial(self._done, key))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def cancel(self):
+        '''Cancels every call in flight and waits for them to finish, for shutdown'''
+
+        tasks = list(self._in_flight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _done(self, key, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Every waiter may have been cancelled, retrieve the exception so it is not logged as unhandled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {'in_flight': len(self._in_flight), 'started': self.started, 'coalesced': self.coalesced}
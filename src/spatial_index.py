@@ -0,0 +1,200 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+import numpy as np
+from src import models
+from src.encoding import projection_hash
+from src.single_flight import SingleFlight
+
+'''Spatial index over a computed nebula: viewport (bounding box) queries, nearest tracks to a point, and level of detail
+downsampling, so large nebulas are sent a view at a time instead of every point'''
+
+'''Configuration'''
+SPATIAL_INDEX_CACHE_SIZE = int(os.getenv('SPATIAL_INDEX_CACHE_SIZE', 64))  # indexes kept per process
+LOD_MAX_DEPTH = 20  # octree levels of the level of detail order, cell keys stay within int64
+VIEW_CACHE_TTL = int(os.getenv('VIEW_CACHE_TTL', 10 * 60))  # seconds a built library nebula answers viewport queries
+VIEW_CACHE_SIZE = int(os.getenv('VIEW_CACHE_SIZE', 64))
+
+
+def lod_ranks(coords: np.ndarray) -> np.ndarray:
+    '''Coarse to fine rank of every point. Walks an octree over the bounding box level by level, at each level the
+    first point (lowest index, i.e. highest in the user's list) to land in a cell no earlier point holds is ranked next.
+    Any prefix of the order covers the occupied space evenly'''
+
+    n = len(coords)
+    ranks = np.full(n, n, dtype=np.int64)
+    if not n:
+        return ranks
+
+    low = coords.min(axis=0)
+    span = np.maximum(coords.max(axis=0) - low, 1e-12)
+    unit = (coords - low) / span
+    next_rank = 0
+
+    for depth in range(LOD_MAX_DEPTH + 1):
+        cells = 1 << depth
+        grid = np.minimum((unit * cells).astype(np.int64), cells - 1)
+        keys = (grid[:, 0] * cells + grid[:, 1]) * cells + grid[:, 2]
+
+        ranked = ranks < n
+        candidates = np.flatnonzero(~ranked & ~np.isin(keys, keys[ranked]))
+        if len(candidates):
+            _, first = np.unique(keys[candidates], return_index=True)
+            picked = np.sort(candidates[first])
+            ranks[picked] = np.arange(next_rank, next_rank + len(picked))
+            next_rank += len(picked)
+        if next_rank == n:
+            break
+
+    # Points sharing a coordinate with a ranked one at full depth
+    rest = np.flatnonzero(ranks == n)
+    ranks[rest] = np.arange(next_rank, next_rank + len(rest))
+    return ranks
+
+
+class SpatialIndex:
+    '''KD-tree, level of detail ranks and cluster summaries of one projection, built once and read only afterwards'''
+
+    def __init__(self, projection: models.Projection):
+        from scipy.spatial import cKDTree  # Nearest neighbour queries
+
+        self.projection = projection
+        self.coords = np.asarray(projection.coords, dtype=np.float64).reshape(-1, 3)
+        self.clusters = np.asarray(projection.clusters)
+        self.tree = cKDTree(self.coords)
+        self.ranks = lod_ranks(self.coords)
+        self.cluster_summaries = self.summarize_clusters()
+
+    def __len__(self) -> int:
+        return len(self.coords)
+
+    def summarize_clusters(self) -> list[dict]:
+        '''Centroid, size and the member nearest the centroid of every cluster, noise excluded'''
+
+        summaries = []
+        for label in np.unique(self.clusters):
+            if label < 0:
+                continue
+            members = np.flatnonzero(self.clusters == label)
+            centroid = self.coords[members].mean(axis=0)
+            representative = members[np.argmin(((self.coords[members] - centroid) ** 2).sum(axis=1))]
+            summaries.append({'cluster': int(label), 'count': len(members),
+                              'x': float(centroid[0]), 'y': float(centroid[1]), 'z': float(centroid[2]),
+                              'spotify_id': self.projection.spotify_ids[representative],
+                              'name': self.projection.names[representative]})
+        return summaries
+
+    def region(self, low, high) -> np.ndarray:
+        '''Indices of the points inside the box, bounds included, in index order. Every point without bounds'''
+
+        if low is None:
+            return np.arange(len(self))
+        low, high = np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64)
+        if not len(self) or np.any(high < low):
+            return np.empty(0, dtype=np.intp)
+
+        # Chebyshev ball around the center covers the box, filtered to the exact bounds
+        center = (low + high) / 2
+        radius = float((high - low).max() / 2)
+        candidates = np.asarray(self.tree.query_ball_point(center, radius, p=np.inf), dtype=np.intp)
+        inside = np.all((self.coords[candidates] >= low) & (self.coords[candidates] <= high), axis=1)
+        return np.sort(candidates[inside])
+
+    def nearest(self, point, k: int) -> tuple[np.ndarray, np.ndarray]:
+        '''Indices and distances of the k nearest points, nearest first'''
+
+        k = min(k, len(self))
+        if k <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+        distances, indices = self.tree.query(np.asarray(point, dtype=np.float64), k=[*range(1, k + 1)])
+        return np.asarray(indices, dtype=np.intp), np.asarray(distances)
+
+    def level_of_detail(self, max_points: int, low=None, high=None) -> tuple[np.ndarray, bool]:
+        '''Up to max_points indices in view (the whole nebula without bounds), coarse to fine. The flag is True when
+        every point in view is included'''
+
+        in_view = self.region(low, high)
+        if len(in_view) <= max_points:
+            return in_view, True
+        picked = in_view[np.argpartition(self.ranks[in_view], max_points)[:max_points]]
+        return np.sort(picked), False
+
+    def clusters_in_view(self, low=None, high=None) -> list[dict]:
+        if low is None:
+            return self.cluster_summaries
+        return [summary for summary in self.cluster_summaries
+                if all(low[axis] <= summary[key] <= high[axis] for axis, key in enumerate('xyz'))]
+
+
+class SpatialIndexCache:
+    '''LRU of spatial indexes by projection content hash, alongside the result cache entry. A nebula served again
+    from the result cache, memory or Redis, finds its index here. Concurrent first queries share one build'''
+
+    def __init__(self, max_entries: int = SPATIAL_INDEX_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, SpatialIndex] = OrderedDict()
+        self.flights = SingleFlight()
+        self.hits = 0
+        self.builds = 0
+
+    async def get(self, projection: models.Projection) -> SpatialIndex:
+        key = projection_hash(projection)
+        index = self.entries.get(key)
+        if index is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return index
+        return await self.flights.run(key, self._build, key, projection)
+
+    async def _build(self, key: str, projection: models.Projection) -> SpatialIndex:
+        # Off the event loop, large library nebulas take tens of milliseconds
+        index = await asyncio.to_thread(SpatialIndex, projection)
+        self.builds += 1
+        if self.max_entries > 0:
+            self.entries[key] = index
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return index
+
+    def stats(self) -> dict:
+        return {'entries': len(self.entries), 'hits': self.hits, 'builds': self.builds}
+
+
+spatial_indexes = SpatialIndexCache()
+
+
+class ViewCache:
+    '''TTL + LRU of built projections by key, e.g. (user, library source). Viewport queries (region, nearest, level of
+    detail) are answered from the entry and its spatial index without paging the library from Spotify again'''
+
+    def __init__(self, ttl: int = VIEW_CACHE_TTL, max_entries: int = VIEW_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple, tuple[float, models.Projection]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> models.Projection | None:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: tuple, projection: models.Projection):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, projection)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+library_views = ViewCache()
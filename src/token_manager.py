@@ -0,0 +1,129 @@
+import asyncio
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+import httpx
+from fastapi import HTTPException
+from starlette import status
+from src.database import crud, create_db
+from src.single_flight import SingleFlight
+
+'''Token manager over crud: cached Spotify access tokens, proactive refresh and per-user single-flight refresh'''
+
+TOKEN_REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', 60))  # seconds before expires_at to refresh
+TOKEN_ROTATION_WAIT = float(os.getenv('TOKEN_ROTATION_WAIT', 2))  # seconds to wait for another process's refresh to land
+
+
+@dataclass
+class CachedToken:
+    '''Spotify tokens for one nebula user'''
+
+    access_token: str
+    refresh_token: str
+    expires_at: datetime
+
+    def expiring(self, margin: int = TOKEN_REFRESH_MARGIN) -> bool:
+        return self.expires_at - timedelta(seconds=margin) <= datetime.now(timezone.utc)
+
+
+class TokenManager:
+    '''Serves access tokens from memory. The database is read when a user's cached token is missing or expiring, and
+    written only on refresh. Concurrent requests for the same user share one in-flight load or refresh'''
+
+    def __init__(self, refresh_fn, margin: int = TOKEN_REFRESH_MARGIN):
+        # refresh_fn(refresh_token) -> Spotify token response dict, may raise httpx.HTTPError
+        self.refresh_fn = refresh_fn
+        self.margin = margin
+        self._tokens: dict[int, CachedToken] = {}
+        # Keyed by user only while a renewal runs, so nothing is kept per user once it finishes
+        self._renewals = SingleFlight()
+        self.hits = 0
+        self.loads = 0
+        self.refreshes = 0
+
+    async def get_access_token(self, nebula_user_id: int) -> str:
+        '''Returns a valid access token, refreshing it shortly before it expires'''
+
+        cached = self._tokens.get(nebula_user_id)
+        if cached is not None and not cached.expiring(self.margin):
+            self.hits += 1
+            return cached.access_token
+
+        cached = await self._renewals.run(nebula_user_id, self._renew, nebula_user_id)
+        return cached.access_token
+
+    async def _renew(self, nebula_user_id: int) -> CachedToken:
+        '''Reads the user's row and refreshes only if it is still expiring. With several worker processes another one
+        may have refreshed, and rotated the refresh token, since this process last read the row'''
+
+        cached = await self._load(nebula_user_id)
+        if cached.expiring(self.margin):
+            cached = await self._refresh(nebula_user_id, cached)
+
+        self._tokens[nebula_user_id] = cached
+        return cached
+
+    async def _load(self, nebula_user_id: int) -> CachedToken:
+        '''Reads the user's token row once'''
+
+        self.loads += 1
+        async with create_db.SessionLocal() as db_session:
+            try:
+                token_model = await crud.get_token(db_session, nebula_user_id)
+            except crud.TokenNotFoundError:
+                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='No Spotify token, log in again.')
+            return CachedToken(access_token=token_model.access_token,
+                               refresh_token=token_model.refresh_token,
+                               expires_at=token_model.expires_at.replace(tzinfo=timezone.utc))
+
+    async def _refresh(self, nebula_user_id: int, cached: CachedToken) -> CachedToken:
+        '''Exchanges the database's current refresh token and writes the new tokens in one update'''
+
+        self.refreshes += 1
+        try:
+            token_data = await self.refresh_fn(cached.refresh_token)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code >= 500:
+                raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f'Spotify token refresh returned {e.response.status_code}')
+            token_data = {}
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f'Spotify token refresh failed: {e!r}')
+
+        access_token = token_data.get('access_token')
+        if not access_token:
+            # A process that refreshed between our read and the exchange has rotated the token we sent,
+            # its new tokens are written right after its exchange
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + TOKEN_ROTATION_WAIT
+            while True:
+                current = await self._load(nebula_user_id)
+                if not current.expiring(self.margin):
+                    return current
+                if loop.time() >= deadline:
+                    break
+                await asyncio.sleep(0.1)
+            self.invalidate(nebula_user_id)
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Spotify token refresh failed, log in again.')
+
+        # Spotify only sometimes rotates the refresh token
+        refresh_token = token_data.get('refresh_token', cached.refresh_token)
+        return await self.store(nebula_user_id, access_token, refresh_token, token_data.get('expires_in', 3600))
+
+    async def store(self, nebula_user_id: int, access_token: str, refresh_token: str, expires_in: int = 3600) -> CachedToken:
+        '''Writes tokens to the database and the cache, used after login and after refresh'''
+
+        async with create_db.SessionLocal() as db_session:
+            await crud.update_tokens(db_session, nebula_user_id, access_token, refresh_token, expires_in)
+
+        cached = CachedToken(access_token=access_token,
+                             refresh_token=refresh_token,
+                             expires_at=datetime.now(timezone.utc) + timedelta(seconds=expires_in))
+        self._tokens[nebula_user_id] = cached
+        return cached
+
+    def invalidate(self, nebula_user_id: int):
+        self._tokens.pop(nebula_user_id, None)
+
+    def stats(self) -> dict:
+        return {'cached': len(self._tokens), 'renewing': self._renewals.stats()['in_flight'], 'hits': self.hits,
+                'loads': self.loads, 'refreshes': self.refreshes}
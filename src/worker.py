@@ -0,0 +1,45 @@
+import asyncio
+import signal
+from src.database import create_db
+from src import http_clients
+from src.pipeline_pool import pipeline_pool
+from src.routers.spotify import precompute_scheduler
+from src.similarity_index import SIMILARITY_ENABLED, similarity_index
+
+'''Precompute worker: runs the precompute scheduler without the API, stops cleanly on SIGTERM / SIGINT.
+Set REDIS_URL so the API processes read the results this worker caches
+
+Usage: python -m src.worker
+'''
+
+
+async def main():
+    await create_db.init_db()
+    await http_clients.start_clients()
+    await pipeline_pool.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, stop.set)
+
+    if SIMILARITY_ENABLED:
+        # Loads the current version, so tracks already indexed are not buffered again
+        similarity_index.start()
+    precompute_scheduler.start()
+    print('Precompute worker started')
+    try:
+        await stop.wait()
+    finally:
+        print('Precompute worker stopping')
+        await precompute_scheduler.stop()
+        if SIMILARITY_ENABLED:
+            # Tracks this worker fetched are merged into the index the API processes load
+            await similarity_index.close()
+        await pipeline_pool.shutdown()
+        await http_clients.close_clients()
+        await create_db.engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
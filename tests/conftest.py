@@ -0,0 +1,16 @@
+import asyncio
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from src.database import create_db
+
+
+@pytest.fixture
+def session_factory(tmp_path, monkeypatch):
+    '''A fresh SQLite database per test, swapped in for create_db.SessionLocal'''
+
+    engine = create_db.build_engine(f'sqlite+aiosqlite:///{tmp_path / "test.db"}')
+    asyncio.run(create_db.init_db(engine))
+    factory = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
+    monkeypatch.setattr(create_db, 'SessionLocal', factory)
+    yield factory
+    asyncio.run(engine.dispose())
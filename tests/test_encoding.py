@@ -0,0 +1,99 @@
+import gzip
+import numpy as np
+import pytest
+from starlette.requests import Request
+from src import encoding, models
+from src.encoding import PACKED_HEADER, etag_matches, nebula_response, pack_projection
+
+
+def make_projection(n: int, seed: int = 0) -> models.Projection:
+    rng = np.random.default_rng(seed)
+    return models.Projection(spotify_ids=[f'id{i}' for i in range(n)], names=[f'név {i % 3}' for i in range(n)],
+                             artists=[[f'artist{i % 2}', 'shared'][:1 + i % 2] for i in range(n)],
+                             coords=rng.normal(size=(n, 3)).astype(np.float32) * 10,
+                             clusters=rng.integers(-1, 5, size=n).astype(np.int32))
+
+
+def unpack_projection(body: bytes) -> tuple[dict, np.ndarray, np.ndarray, list[str], list[str], list[list[str]]]:
+    '''Reads the layout documented on pack_projection'''
+
+    magic, version, flags, n_tracks, n_strings, n_artist_refs, n_bytes, *bounds = PACKED_HEADER.unpack_from(body)
+    minimum, step = np.array(bounds[:3], dtype=np.float32), np.array(bounds[3:], dtype=np.float32)
+    offset = PACKED_HEADER.size
+
+    def read(dtype: str, count: int) -> np.ndarray:
+        nonlocal offset
+        array = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+        offset += array.nbytes
+        return array
+
+    quantized = read('<u2', n_tracks * 3).reshape(-1, 3)
+    clusters = read('<i2', n_tracks)
+    assert offset % 4 == 0
+    id_refs, name_refs = read('<u4', n_tracks), read('<u4', n_tracks)
+    artist_offsets, artist_refs = read('<u4', n_tracks + 1), read('<u4', n_artist_refs)
+    string_offsets = read('<u4', n_strings + 1)
+    data = body[offset:]
+    assert len(data) == n_bytes
+    strings = [data[start:end].decode() for start, end in zip(string_offsets[:-1], string_offsets[1:])]
+
+    header = {'magic': magic, 'version': version, 'flags': flags}
+    coords = minimum + quantized * step
+    artists = [[strings[ref] for ref in artist_refs[start:end]] for start, end in zip(artist_offsets[:-1], artist_offsets[1:])]
+    return header, coords, clusters, [strings[ref] for ref in id_refs], [strings[ref] for ref in name_refs], artists
+
+
+@pytest.mark.parametrize('n', [0, 1, 3, 257])
+def test_pack_projection_round_trip(n):
+    projection = make_projection(n)
+    header, coords, clusters, spotify_ids, names, artists = unpack_projection(pack_projection(projection))
+
+    assert header == {'magic': b'NEB1', 'version': 1, 'flags': 0}
+    assert spotify_ids == projection.spotify_ids
+    assert names == projection.names
+    assert artists == projection.artists
+    np.testing.assert_array_equal(clusters, projection.clusters)
+    if n:
+        # Quantized to 65535 levels per axis, half a step of error at most
+        tolerance = (projection.coords.max(axis=0) - projection.coords.min(axis=0)) / encoding.COORD_LEVELS
+        assert np.all(np.abs(coords - projection.coords) <= tolerance / 2 + 1e-4)
+
+
+def test_pack_projection_rejects_clusters_outside_i16():
+    projection = make_projection(3)
+    projection.clusters = np.array([0, 1, 40000], dtype=np.int32)
+    with pytest.raises(ValueError):
+        pack_projection(projection)
+
+
+def make_request(**headers: str) -> Request:
+    raw = [(name.replace('_', '-').encode(), value.encode()) for name, value in headers.items()]
+    return Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': raw, 'query_string': b''})
+
+
+def test_etag_matches():
+    assert etag_matches('"abc.rows"', 'abc.rows')
+    assert etag_matches('W/"abc.rows.gzip"', 'abc.rows')
+    assert etag_matches('"other", "abc.rows.br"', 'abc.rows')
+    assert etag_matches('*', 'abc.rows')
+    assert not etag_matches(None, 'abc.rows')
+    assert not etag_matches('"abc.columns"', 'abc.rows')
+    assert not etag_matches('"abc.rowsx"', 'abc.rows')
+
+
+def test_nebula_response_revalidates_with_304():
+    projection = make_projection(200)
+    response = nebula_response(projection, 'columns', make_request(accept_encoding='gzip'))
+    assert response.status_code == 200
+    assert response.headers['content-encoding'] == 'gzip'
+    assert encoding.dumps(projection.columns()) == gzip.decompress(response.body)
+    etag = response.headers['etag']
+
+    revalidated = nebula_response(projection, 'columns', make_request(accept_encoding='gzip', if_none_match=etag))
+    assert revalidated.status_code == 304
+    assert revalidated.body == b''
+    assert revalidated.headers['etag'] == etag
+
+    # Another format or changed content is a new representation
+    assert nebula_response(projection, 'rows', make_request(if_none_match=etag)).status_code == 200
+    assert nebula_response(make_projection(200, seed=1), 'columns', make_request(if_none_match=etag)).status_code == 200
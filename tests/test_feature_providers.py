@@ -0,0 +1,28 @@
+import asyncio
+import numpy as np
+import pandas as pd
+import pytest
+from src.feature_providers import FeatureProvider, LocalFeatureStore, build_store
+from src.math_utils import FEATURE_COLUMNS
+
+
+def test_provider_without_get_many_fails_on_instantiation():
+    class Incomplete(FeatureProvider):
+        name = 'incomplete'
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_local_store_round_trip(tmp_path):
+    rows = {f'id{i}': np.arange(len(FEATURE_COLUMNS), dtype=np.float32) + i for i in (3, 1, 2)}
+    frame = pd.DataFrame([{'spotify_id': spotify_id, **dict(zip(FEATURE_COLUMNS, row))} for spotify_id, row in rows.items()])
+    frame.to_csv(tmp_path / 'dump.csv', index=False)
+    assert build_store(str(tmp_path / 'dump.csv'), str(tmp_path / 'store')) == 3
+
+    store = LocalFeatureStore(str(tmp_path / 'store'))
+    found = asyncio.run(store.get_many(['id2', 'missing', 'id1', 'id1_with_a_longer_name']))
+    assert sorted(found) == ['id1', 'id2']
+    for spotify_id, row in found.items():
+        np.testing.assert_array_equal(row, rows[spotify_id])
+    assert store.stats() == {'tracks': 3, 'hits': 2, 'misses': 2}
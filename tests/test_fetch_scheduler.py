@@ -0,0 +1,81 @@
+import asyncio
+import httpx
+from src import metrics
+from src.fetch_scheduler import FetchScheduler, FetchStats, TokenBucket
+
+
+def status_error(status_code: int) -> httpx.HTTPStatusError:
+    request = httpx.Request('GET', 'https://upstream.test/track')
+    return httpx.HTTPStatusError(f'{status_code}', request=request, response=httpx.Response(status_code, request=request))
+
+
+def counter_value(counter, **labels) -> float:
+    return counter._values.get(tuple(sorted(labels.items())), 0)
+
+
+def scheduler(name: str) -> FetchScheduler:
+    return FetchScheduler(name, TokenBucket(rate=1000, capacity=1000), max_retries=2, base_backoff=0.001, max_backoff=0.001)
+
+
+def test_exhausted_5xx_is_counted_as_failure_and_drop():
+    async def always_503():
+        raise status_error(503)
+
+    stats = FetchStats()
+    result = asyncio.run(scheduler('test_5xx').run(always_503, stats=stats))
+
+    assert result is None
+    assert stats.dropped == 1 and stats.retries == 2
+    assert counter_value(metrics.upstream_failures, upstream='test_5xx', reason='503') == 3
+    assert counter_value(metrics.upstream_dropped, upstream='test_5xx', reason='503') == 1
+
+
+def test_drops_are_labeled_by_last_reason():
+    async def not_found():
+        raise status_error(404)
+
+    async def invalid_payload():
+        raise ValueError('Missing audio feature tempo')
+
+    attempts = []
+
+    async def recovers():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise status_error(502)
+        return 'ok'
+
+    fetch_scheduler = scheduler('test_reasons')
+    assert asyncio.run(fetch_scheduler.run(not_found)) is None
+    assert asyncio.run(fetch_scheduler.run(invalid_payload)) is None
+    assert asyncio.run(fetch_scheduler.run(recovers)) == 'ok'
+
+    assert counter_value(metrics.upstream_dropped, upstream='test_reasons', reason='404') == 1
+    assert counter_value(metrics.upstream_dropped, upstream='test_reasons', reason='invalid_payload') == 1
+    # A failed attempt that a retry recovers is a failure, not a drop
+    assert counter_value(metrics.upstream_failures, upstream='test_reasons', reason='502') == 1
+    assert counter_value(metrics.upstream_dropped, upstream='test_reasons', reason='502') == 0
+
+
+def test_permanent_errors_are_counted_as_rejected():
+    async def not_found():
+        raise status_error(404)
+
+    async def invalid_payload():
+        raise ValueError('Missing audio feature tempo')
+
+    async def always_429():
+        raise status_error(429)
+
+    stats = FetchStats()
+    fetch_scheduler = scheduler('test_rejected')
+    for fetch in (not_found, invalid_payload, always_429):
+        assert asyncio.run(fetch_scheduler.run(fetch, stats=stats)) is None
+
+    # Only the exhausted 429 may get through on a later request
+    assert stats.dropped == 3 and stats.rejected == 2
+
+    merged = FetchStats()
+    merged.merge(stats)
+    merged.merge(stats)
+    assert merged.dropped == 6 and merged.rejected == 4 and merged.max_queue_time == stats.max_queue_time
@@ -0,0 +1,24 @@
+import asyncio
+import numpy as np
+from src.database import crud
+from src.global_embedding import GlobalEmbeddingIndex
+from src import models
+
+
+def test_first_refresh_loads_right_after_boot(session_factory, monkeypatch):
+    # Monotonic time counts from boot, a fresh host is within refresh_interval of zero
+    monkeypatch.setattr('src.global_embedding.time.monotonic', lambda: 1.0)
+
+    async def scenario():
+        async with session_factory() as db_session:
+            version = await crud.create_embedding(db_session, 2, 'models.joblib', ['a', 'b'],
+                                                  np.array([[0, 1, 2], [3, 4, 5]], dtype=np.float32), np.array([0, -1]))
+            index = GlobalEmbeddingIndex(refresh_interval=300)
+            await index.refresh(db_session)
+            assert index.ready and index.version == version
+
+            projection, missing = index.lookup([models.Track(name=spotify_id, artist=[], spotify_id=spotify_id) for spotify_id in ('b', 'c')])
+            assert projection.spotify_ids == ['b'] and [track.spotify_id for track in missing] == ['c']
+            np.testing.assert_array_equal(projection.coords, [[3, 4, 5]])
+
+    asyncio.run(scenario())
@@ -0,0 +1,13 @@
+from src import metrics
+
+
+def test_server_timing_sums_spans_and_annotations():
+    header = metrics.server_timing([
+        ('audio_features', 0.25), ('rapid_api', {'queued': 100, 'retries': 2, 'dropped': 1}),
+        ('audio_features', 0.5), ('rapid_api', {'queued': 50, 'retries': 0, 'dropped': 0}),
+    ])
+    assert header == 'audio_features;dur=750.0, rapid_api;desc="queued=150 retries=2 dropped=1"'
+
+
+def test_annotate_outside_a_request_is_ignored():
+    metrics.annotate('rapid_api', queued=1)
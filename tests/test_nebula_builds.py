@@ -0,0 +1,111 @@
+import asyncio
+import numpy as np
+import pytest
+from src import models
+from src.feature_providers import RapidApiProvider
+from src.fetch_scheduler import FetchScheduler, TokenBucket
+from src.result_cache import MemoryResultCache, track_ids_hash
+from tests.test_fetch_scheduler import status_error
+
+
+def make_tracks(*spotify_ids: str) -> list[models.Track]:
+    return [models.Track(name=spotify_id, artist=['artist'], spotify_id=spotify_id) for spotify_id in spotify_ids]
+
+
+@pytest.fixture
+def nebula_router(session_factory, monkeypatch):
+    '''The spotify router with a stub RapidAPI (bad* ids answer 404, flaky* ids 503), a counting pipeline and
+    fresh result caches'''
+
+    from src.routers import spotify
+
+    calls = {'fetch': [], 'pipeline': 0}
+
+    async def get_audio_features(spotify_id: str) -> np.ndarray:
+        calls['fetch'].append(spotify_id)
+        if spotify_id.startswith('bad'):
+            raise status_error(404)
+        if spotify_id.startswith('flaky'):
+            raise status_error(503)
+        return np.full(7, len(spotify_id), dtype=np.float64)
+
+    async def run_pipeline(nebula_user_id, term, tracks, mode='quality'):
+        calls['pipeline'] += 1
+        await asyncio.sleep(0.05)
+        n = len(tracks)
+        return models.Projection(spotify_ids=[track.spotify_id for track in tracks], names=[track.name for track in tracks],
+                                 artists=[track.artist for track in tracks], coords=np.zeros((n, 3), dtype=np.float32),
+                                 clusters=np.zeros(n, dtype=np.int32))
+
+    scheduler = FetchScheduler('test_nebula', TokenBucket(rate=1000, capacity=1000), max_retries=1, base_backoff=0.001, max_backoff=0.001)
+    monkeypatch.setattr(spotify, 'rapid_api_provider', RapidApiProvider(get_audio_features, scheduler))
+    monkeypatch.setattr(spotify, 'run_pipeline', run_pipeline)
+    monkeypatch.setattr(spotify, 'result_cache', MemoryResultCache())
+    monkeypatch.setattr(spotify, 'SIMILARITY_ENABLED', False)
+    monkeypatch.setattr(spotify, 'local_feature_store', None)
+    return spotify, calls
+
+
+def test_permanently_rejected_tracks_do_not_block_caching(nebula_router, session_factory):
+    spotify, calls = nebula_router
+
+    async def scenario():
+        async with session_factory() as db_session:
+            user = await spotify.crud.create_nebula_user(db_session, 'spotify-user', 'User')
+            tracks = make_tracks('good1', 'good2', 'bad1')
+            await spotify.build_nebula(db_session, user.id, 'short_term', tracks, 'fast')
+            cached = await spotify.result_cache.get(user.id, spotify.result_term('short_term', 'fast'), track_ids_hash(tracks))
+            assert cached is not None and cached.spotify_ids == ['good1', 'good2']
+
+            # A reload is served from the cache, the rejected id is not fetched again
+            fetches = len(calls['fetch'])
+            assert await spotify.build_nebula(db_session, user.id, 'short_term', make_tracks('good1', 'good2', 'bad1'), 'fast') is cached
+            assert len(calls['fetch']) == fetches and calls['pipeline'] == 1
+
+    asyncio.run(scenario())
+
+
+def test_transient_drops_keep_the_result_uncached(nebula_router, session_factory):
+    spotify, calls = nebula_router
+
+    async def scenario():
+        async with session_factory() as db_session:
+            user = await spotify.crud.create_nebula_user(db_session, 'spotify-user', 'User')
+            tracks = make_tracks('good3', 'flaky1')
+            await spotify.build_nebula(db_session, user.id, 'short_term', tracks, 'fast')
+            assert await spotify.result_cache.get(user.id, spotify.result_term('short_term', 'fast'), track_ids_hash(tracks)) is None
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_stream_and_get_share_one_fit(nebula_router, session_factory, monkeypatch):
+    spotify, calls = nebula_router
+
+    async def get_access_token(nebula_user_id):
+        return 'token'
+
+    async def get_top_tracks(access_token, term):
+        return make_tracks('good4', 'good55', 'good666')
+
+    async def touch(nebula_user_id):
+        pass
+
+    monkeypatch.setattr(spotify.token_manager, 'get_access_token', get_access_token)
+    monkeypatch.setattr(spotify, 'get_top_tracks', get_top_tracks)
+    monkeypatch.setattr(spotify.last_seen, 'touch', touch)
+
+    async def scenario():
+        async with session_factory() as db_session:
+            user = await spotify.crud.create_nebula_user(db_session, 'spotify-user', 'User')
+            user = {'nebula_user_id': user.id}
+
+            async def stream():
+                response = await spotify.stream_nebula(user, db_session, 'short_term', 'rows', 'fast')
+                return [line async for line in response.body_iterator]
+
+            lines, projection = await asyncio.gather(stream(), spotify.resolve_term_nebula(user, db_session, 'short_term', 'fast'))
+            assert b'"event":"result"' in lines[-1]
+            assert projection.spotify_ids == ['good4', 'good55', 'good666']
+            assert calls['pipeline'] == 1
+
+    asyncio.run(scenario())
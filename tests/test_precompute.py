@@ -0,0 +1,60 @@
+import asyncio
+from src.precompute import PrecomputeScheduler
+from src.single_flight import SingleFlight
+
+
+def test_stop_timeout_cancels_shielded_builds():
+    async def scenario():
+        flights = SingleFlight()
+        build_cancelled = asyncio.Event()
+
+        async def slow_build():
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                build_cancelled.set()
+                raise
+
+        async def precompute(nebula_user_id: int, term: str):
+            await flights.run((nebula_user_id, term), slow_build)
+
+        scheduler = PrecomputeScheduler(precompute, cancel_fn=flights.cancel, concurrency=1, terms=['short_term'])
+
+        async def active_users():
+            return [1]
+        scheduler.active_users = active_users
+
+        scheduler.start()
+        while not flights.stats()['in_flight']:
+            await asyncio.sleep(0.01)
+
+        await scheduler.stop(timeout=0.1)
+
+        # Nothing of the build is left running once stop returns
+        assert build_cancelled.is_set()
+        assert flights.stats()['in_flight'] == 0
+        assert not scheduler.running
+
+    asyncio.run(scenario())
+
+
+def test_stop_waits_for_jobs_that_finish_in_time():
+    async def scenario():
+        finished = []
+
+        async def precompute(nebula_user_id: int, term: str):
+            await asyncio.sleep(0.05)
+            finished.append(term)
+
+        scheduler = PrecomputeScheduler(precompute, concurrency=1, terms=['short_term'])
+
+        async def active_users():
+            return [1]
+        scheduler.active_users = active_users
+
+        scheduler.start()
+        await asyncio.sleep(0.01)
+        await scheduler.stop(timeout=5)
+        assert finished == ['short_term']
+
+    asyncio.run(scenario())
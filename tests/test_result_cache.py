@@ -0,0 +1,53 @@
+import asyncio
+import numpy as np
+from src import models
+from src.result_cache import MemoryResultCache, track_ids_hash
+
+
+def tracks(*spotify_ids: str) -> list[models.Track]:
+    return [models.Track(name=spotify_id, artist=['artist'], spotify_id=spotify_id) for spotify_id in spotify_ids]
+
+
+def projection(n: int) -> models.Projection:
+    return models.Projection(spotify_ids=[f't{i}' for i in range(n)], names=[f't{i}' for i in range(n)], artists=[['a']] * n,
+                             coords=np.zeros((n, 3), dtype=np.float32), clusters=np.zeros(n, dtype=np.int32))
+
+
+def test_ids_hash_follows_ids_and_order():
+    assert track_ids_hash(tracks('a', 'b')) == track_ids_hash(tracks('a', 'b'))
+    assert track_ids_hash(tracks('a', 'b')) != track_ids_hash(tracks('b', 'a'))
+    assert track_ids_hash(tracks('a', 'b')) != track_ids_hash(tracks('a', 'b', 'c'))
+
+
+def test_changed_tracks_invalidate_the_entry():
+    async def scenario():
+        cache = MemoryResultCache(ttl=60)
+        old_hash, new_hash = track_ids_hash(tracks('a', 'b')), track_ids_hash(tracks('a', 'c'))
+        result = projection(2)
+
+        await cache.set(1, 'short_term', old_hash, result)
+        assert await cache.get(1, 'short_term', old_hash) is result
+        assert await cache.get(2, 'short_term', old_hash) is None
+        assert await cache.get(1, 'long_term', old_hash) is None
+
+        # New top tracks: the stale entry is dropped
+        assert await cache.get(1, 'short_term', new_hash) is None
+        assert await cache.get(1, 'short_term', old_hash) is None
+        assert cache.stats()['stale'] == 1
+
+    asyncio.run(scenario())
+
+
+def test_expired_and_evicted_entries_miss():
+    async def scenario():
+        cache = MemoryResultCache(ttl=0)
+        await cache.set(1, 'short_term', 'hash', projection(1))
+        assert await cache.get(1, 'short_term', 'hash') is None
+
+        cache = MemoryResultCache(ttl=60, maxsize=2)
+        for user in (1, 2, 3):
+            await cache.set(user, 'short_term', 'hash', projection(1))
+        assert await cache.get(1, 'short_term', 'hash') is None
+        assert await cache.get(3, 'short_term', 'hash') is not None
+
+    asyncio.run(scenario())
@@ -0,0 +1,91 @@
+import asyncio
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from src import similarity_index as similarity
+from src.database import crud
+from src.math_utils import FEATURE_COLUMNS, N_FEATURES
+
+
+def random_features(prefix: str, n: int, seed: int) -> dict[str, np.ndarray]:
+    rows = np.random.default_rng(seed).normal(size=(n, N_FEATURES)).astype(np.float32)
+    return {f'{prefix}{i}': row for i, row in enumerate(rows)}
+
+
+def test_merges_keep_every_track_and_other_processes_versions(tmp_path):
+    async def scenario():
+        first = similarity.SimilarityIndex(str(tmp_path), merge_size=10_000)
+        second = similarity.SimilarityIndex(str(tmp_path), merge_size=10_000)
+
+        # The first version is built once SIMILARITY_MIN_TRACKS tracks are buffered
+        first.add(random_features('a', similarity.SIMILARITY_MIN_TRACKS, seed=1))
+        await first.close()
+        assert first.version is not None and len(first) == similarity.SIMILARITY_MIN_TRACKS
+
+        # Another process loads it on start, merges its own tracks on top, then the first picks that version up
+        assert await second.load()
+        assert second.add(random_features('a', 5, seed=1)) == 0
+        assert second.add(random_features('b', 50, seed=2)) == 50
+        await second.merge()
+        assert len(second.state['ids']) == similarity.SIMILARITY_MIN_TRACKS + 50
+        assert await first.load()
+        assert first.version == second.version
+
+        first.add(random_features('c', 20, seed=3))
+        assert len(first) == similarity.SIMILARITY_MIN_TRACKS + 70
+        for spotify_id in ('a0', 'b49', 'c19'):
+            vector = first.vector_of(spotify_id)
+            assert vector is not None
+            assert first.query(vector, 1)[0] == (spotify_id, pytest.approx(0.0, abs=1e-5))
+        assert first.query(first.vector_of('a0'), 5, exclude='a0')[0][0] != 'a0'
+
+        await first.merge()
+        assert len(first.state['ids']) == similarity.SIMILARITY_MIN_TRACKS + 70 and not first._pending
+        loaded = similarity.load_version(str(tmp_path), first.version)
+        assert sorted(spotify_id.decode() for spotify_id in loaded['ids']) == sorted(
+            [f'a{i}' for i in range(similarity.SIMILARITY_MIN_TRACKS)] + [f'b{i}' for i in range(50)] + [f'c{i}' for i in range(20)])
+
+    asyncio.run(scenario())
+
+
+def test_similar_users_compare_standardized_tastes(session_factory):
+    from src.routers import spotify
+
+    # Raw, user b is nearest a by tempo alone. Standardized, c is nearest across tempo and energy
+    tastes = {'a': (120.0, 0.9), 'b': (121.0, 0.1), 'c': (125.0, 0.85), 'd': (180.0, 0.5)}
+
+    async def scenario():
+        async with session_factory() as db_session:
+            user_ids = {}
+            for name, (tempo, energy) in tastes.items():
+                user = await crud.create_nebula_user(db_session, f'spotify-{name}', name)
+                user_ids[name] = user.id
+                features = {column: 0.5 for column in FEATURE_COLUMNS} | {'tempo': tempo, 'energy': energy}
+                await crud.upsert_user_taste(db_session, user.id, 'medium_term', features)
+            await crud.create_nebula_user(db_session, 'spotify-e', 'no taste yet')
+
+            caller = {'nebula_user_id': user_ids['a']}
+            similar = await spotify.get_similar_users(caller, db_session, 'medium_term', 2)
+            assert [row['display_name'] for row in similar] == ['c', 'b']
+            assert similar[0]['distance'] < similar[1]['distance']
+            assert len(await spotify.get_similar_users(caller, db_session, 'medium_term', 10)) == 3
+
+            with pytest.raises(HTTPException) as error:
+                await spotify.get_similar_users(caller, db_session, 'short_term', 2)
+            assert error.value.status_code == 404
+            with pytest.raises(HTTPException) as error:
+                await spotify.get_similar_users(caller, db_session, 'all_time', 2)
+            assert error.value.status_code == 400
+
+    asyncio.run(scenario())
+
+
+def test_first_refresh_checks_right_after_boot(tmp_path, monkeypatch):
+    monkeypatch.setattr('src.similarity_index.time.monotonic', lambda: 1.0)
+    (tmp_path / similarity.CURRENT_FILE).write_text('v1')
+    loaded = []
+    monkeypatch.setattr(similarity, 'load_version', lambda directory, version: loaded.append(version) or {'version': version, 'ids': []})
+
+    index = similarity.SimilarityIndex(str(tmp_path), refresh_interval=60)
+    asyncio.run(index.refresh())
+    assert loaded == ['v1'] and index.version == 'v1'
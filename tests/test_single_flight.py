@@ -0,0 +1,75 @@
+import asyncio
+import pytest
+from src.single_flight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+
+        async def build(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value * 2
+
+        results = await asyncio.gather(*(flights.run('key', build, 21) for _ in range(10)))
+
+        assert results == [42] * 10
+        assert calls == [21]
+        assert flights.stats() == {'in_flight': 0, 'started': 1, 'coalesced': 9}
+
+        # Nothing is cached once the call finishes
+        assert await flights.run('key', build, 1) == 2
+        assert calls == [21, 1]
+
+    asyncio.run(scenario())
+
+
+def test_different_keys_run_separately():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def build(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        assert await asyncio.gather(flights.run('a', build, 1), flights.run('b', build, 2)) == [1, 2]
+        assert flights.stats()['started'] == 2
+
+    asyncio.run(scenario())
+
+
+def test_errors_reach_every_waiter():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError('upstream down')
+
+        results = await asyncio.gather(*(flights.run('key', fail) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert flights.stats()['in_flight'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_caller_does_not_abort_the_others():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def build():
+            await asyncio.sleep(0.05)
+            return 'done'
+
+        first = asyncio.create_task(flights.run('key', build))
+        second = asyncio.create_task(flights.run('key', build))
+        await asyncio.sleep(0.01)
+        first.cancel()
+
+        assert await second == 'done'
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+    asyncio.run(scenario())
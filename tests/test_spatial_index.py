@@ -0,0 +1,115 @@
+import asyncio
+import numpy as np
+import pytest
+from src import models
+from src.result_cache import MemoryResultCache, track_ids_hash
+from src.spatial_index import SpatialIndex, ViewCache, lod_ranks
+
+
+def make_projection(n: int, seed: int = 0) -> models.Projection:
+    rng = np.random.default_rng(seed)
+    return models.Projection(spotify_ids=[f'id{i}' for i in range(n)], names=[f'name{i}' for i in range(n)],
+                             artists=[['artist']] * n, coords=rng.normal(size=(n, 3)).astype(np.float32),
+                             clusters=rng.integers(-1, 4, size=n).astype(np.int32))
+
+
+def test_lod_ranks_is_a_permutation_led_by_the_first_point():
+    coords = np.random.default_rng(1).normal(size=(500, 3))
+    ranks = lod_ranks(coords)
+    assert sorted(ranks.tolist()) == list(range(500))
+    assert ranks[0] == 0
+    # Duplicated points still get a rank each
+    assert sorted(lod_ranks(np.zeros((5, 3))).tolist()) == list(range(5))
+
+
+def test_region_matches_brute_force():
+    projection = make_projection(2000)
+    index = SpatialIndex(projection)
+    low, high = [-0.5, -1.0, -0.25], [0.75, 0.5, 1.0]
+    expected = np.flatnonzero(np.all((projection.coords >= low) & (projection.coords <= high), axis=1))
+    np.testing.assert_array_equal(index.region(low, high), expected)
+    np.testing.assert_array_equal(index.region(None, None), np.arange(2000))
+
+
+def test_nearest_matches_brute_force():
+    projection = make_projection(1000)
+    index = SpatialIndex(projection)
+    point = np.array([0.1, -0.2, 0.3])
+    indices, distances = index.nearest(point, 15)
+    brute = np.linalg.norm(projection.coords.astype(np.float64) - point, axis=1)
+    np.testing.assert_array_equal(indices, np.argsort(brute)[:15])
+    np.testing.assert_allclose(distances, np.sort(brute)[:15])
+    assert len(index.nearest(point, 5000)[0]) == 1000
+
+
+def test_level_of_detail_stays_in_view_and_within_budget():
+    projection = make_projection(3000)
+    index = SpatialIndex(projection)
+    low, high = [-1.0, -1.0, -1.0], [1.0, 1.0, 1.0]
+
+    picked, complete = index.level_of_detail(100, low, high)
+    assert not complete and len(picked) == 100
+    assert set(picked.tolist()) <= set(index.region(low, high).tolist())
+
+    everything, complete = index.level_of_detail(5000)
+    assert complete
+    np.testing.assert_array_equal(everything, np.arange(3000))
+
+
+def test_view_cache_expires_and_evicts(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr('src.spatial_index.time.monotonic', lambda: clock[0])
+    cache = ViewCache(ttl=10, max_entries=2)
+    projection = make_projection(3)
+
+    cache.set((1, 'saved'), projection)
+    assert cache.get((1, 'saved')) is projection
+    clock[0] = 10.0
+    assert cache.get((1, 'saved')) is None
+
+    for user in (1, 2, 3):
+        cache.set((user, 'saved'), projection)
+    assert cache.get((1, 'saved')) is None
+    assert cache.get((3, 'saved')) is projection
+
+
+def test_library_viewport_queries_reuse_the_built_nebula(monkeypatch):
+    from src.routers import spotify
+
+    library_tracks = [models.Track(name=f'name{i}', artist=['artist'], spotify_id=f'id{i}') for i in range(3)]
+    projection = make_projection(3)
+    pages = []
+
+    async def get_library_tracks(access_token, source, playlist_ids):
+        pages.append((source, playlist_ids))
+        return library_tracks
+
+    async def get_access_token(user):
+        return 'token'
+
+    async def touch(nebula_user_id):
+        pass
+
+    async def scenario():
+        result_cache = MemoryResultCache()
+        await result_cache.set(1, 'playlists:a,b', track_ids_hash(library_tracks), projection)
+        monkeypatch.setattr(spotify, 'result_cache', result_cache)
+        monkeypatch.setattr(spotify, 'library_views', ViewCache())
+        monkeypatch.setattr(spotify, 'get_library_tracks', get_library_tracks)
+        monkeypatch.setattr(spotify, 'get_access_token', get_access_token)
+        monkeypatch.setattr(spotify.last_seen, 'touch', touch)
+        user = {'nebula_user_id': 1}
+
+        assert await spotify.library_view(user, None, 'playlists', 'b,a') is projection
+        assert await spotify.library_view(user, None, 'playlists', 'a,b') is projection
+        assert pages == [('playlists', ['b', 'a'])]
+
+        # Loading the full nebula pages the library again
+        assert await spotify.library_nebula(user, None, 'playlists', 'a,b') is projection
+        assert len(pages) == 2
+
+        with pytest.raises(spotify.HTTPException) as error:
+            await spotify.library_view(user, None, 'playlists', '')
+        assert error.value.status_code == 400
+
+    asyncio.run(scenario())
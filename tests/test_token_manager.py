@@ -0,0 +1,114 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import httpx
+import pytest
+from fastapi import HTTPException
+from src.database import crud
+from src.token_manager import TokenManager
+
+
+async def create_user(session_factory, expires_in: int) -> int:
+    async with session_factory() as db_session:
+        user = await crud.create_nebula_user(db_session, 'spotify-user', 'Test User')
+        await crud.update_tokens(db_session, user.id, 'access-0', 'refresh-0', expires_in)
+    return user.id
+
+
+class FakeSpotify:
+    '''Token endpoint that rotates the refresh token on every exchange and rejects stale ones'''
+
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+        self.valid_refresh_token = 'refresh-0'
+        self.calls = []
+        self.exchanges = 0
+
+    async def refresh(self, refresh_token: str) -> dict:
+        self.calls.append(refresh_token)
+        await asyncio.sleep(self.delay)
+        if refresh_token != self.valid_refresh_token:
+            request = httpx.Request('POST', 'https://accounts.spotify.com/api/token')
+            raise httpx.HTTPStatusError('invalid_grant', request=request, response=httpx.Response(400, request=request))
+        self.exchanges += 1
+        self.valid_refresh_token = f'refresh-{self.exchanges}'
+        return {'access_token': f'access-{self.exchanges}', 'refresh_token': self.valid_refresh_token, 'expires_in': 3600}
+
+
+def test_concurrent_requests_share_one_refresh(session_factory):
+    async def scenario():
+        user_id = await create_user(session_factory, expires_in=0)
+        spotify = FakeSpotify()
+        manager = TokenManager(spotify.refresh)
+
+        tokens = await asyncio.gather(*(manager.get_access_token(user_id) for _ in range(20)))
+
+        assert set(tokens) == {'access-1'}
+        assert spotify.calls == ['refresh-0']
+        assert manager.stats()['renewing'] == 0
+        # Served from memory afterwards
+        assert await manager.get_access_token(user_id) == 'access-1'
+        assert manager.loads == 1
+
+    asyncio.run(scenario())
+
+
+def test_skips_refresh_done_by_another_process(session_factory):
+    async def scenario():
+        user_id = await create_user(session_factory, expires_in=3600)
+        spotify = FakeSpotify()
+        worker_a, worker_b = TokenManager(spotify.refresh), TokenManager(spotify.refresh)
+
+        # Both workers cache the token, then it nears expiry
+        assert await worker_a.get_access_token(user_id) == 'access-0'
+        assert await worker_b.get_access_token(user_id) == 'access-0'
+        for worker in (worker_a, worker_b):
+            worker._tokens[user_id].expires_at = datetime.now(timezone.utc)
+        async with session_factory() as db_session:
+            await crud.update_tokens(db_session, user_id, 'access-0', 'refresh-0', 0)
+
+        # A refreshes and rotates the refresh token, B then finds the new row instead of sending the stale token
+        assert await worker_a.get_access_token(user_id) == 'access-1'
+        assert await worker_b.get_access_token(user_id) == 'access-1'
+        assert spotify.calls == ['refresh-0']
+
+    asyncio.run(scenario())
+
+
+def test_rotated_token_during_exchange_is_picked_up(session_factory):
+    async def scenario():
+        user_id = await create_user(session_factory, expires_in=0)
+        spotify = FakeSpotify(delay=0.05)
+        worker_a, worker_b = TokenManager(spotify.refresh), TokenManager(spotify.refresh)
+
+        # Both read the expiring row before either exchange finishes, B's exchange is rejected as stale
+        tokens = await asyncio.gather(worker_a.get_access_token(user_id), worker_b.get_access_token(user_id))
+
+        assert tokens == ['access-1', 'access-1']
+        assert spotify.calls == ['refresh-0', 'refresh-0']
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize('status_code, expected', [(400, 401), (503, 502)])
+def test_refresh_errors_become_http_exceptions(session_factory, monkeypatch, status_code, expected):
+    monkeypatch.setattr('src.token_manager.TOKEN_ROTATION_WAIT', 0.2)
+    async def failing_refresh(refresh_token: str) -> dict:
+        request = httpx.Request('POST', 'https://accounts.spotify.com/api/token')
+        raise httpx.HTTPStatusError('error', request=request, response=httpx.Response(status_code, request=request))
+
+    async def scenario():
+        user_id = await create_user(session_factory, expires_in=0)
+        manager = TokenManager(failing_refresh)
+        with pytest.raises(HTTPException) as raised:
+            await manager.get_access_token(user_id)
+        assert raised.value.status_code == expected
+        assert user_id not in manager._tokens
+
+    asyncio.run(scenario())
+
+
+def test_missing_token_is_unauthorized(session_factory):
+    manager = TokenManager(FakeSpotify().refresh)
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(manager.get_access_token(12345))
+    assert raised.value.status_code == 401